@@ -9,7 +9,6 @@ import vtk
 
 import qt
 import slicer
-import requests
 
 from slicer.i18n import tr as _
 from slicer.i18n import translate
@@ -17,8 +16,10 @@ from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 from MONAIAuto3DSegLib.model_database import ModelDatabase
 from MONAIAuto3DSegLib.utils import humanReadableTimeFromSec
+from MONAIAuto3DSegLib.probabilities import PROBABILITIES_FILE_EXTENSION
 from MONAIAuto3DSegLib.dependency_handler import SlicerPythonDependencies, RemotePythonDependencies
-from MONAIAuto3DSegLib.process import InferenceServer, LocalInference, BackgroundProcess, EventCode, ExitCode, SegmentationTaskListInfo, SegmentationTaskInfo
+from MONAIAuto3DSegLib.process import InferenceServer, LocalInference, RemoteInference, RemoteSequenceInference, RemoteSequenceItemInference, EventCode, ExitCode, SegmentationTaskListInfo, SegmentationTaskInfo
+from MONAIAuto3DSegLib.tracing import JsonFileSpanExporter, Tracer, childSpan
 
 
 
@@ -196,6 +197,9 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         PROCESSING_FAILED: _("Processing Failed")
     }
 
+    # Progress bar units per processing step, for showing progress within a step
+    PROGRESS_STEP_SIZE = 100
+
     @staticmethod
     def getHumanReadableProcessingState(state):
         try:
@@ -225,7 +229,7 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self._webServer.killProcess()
 
         packageName ="MONAIAuto3DSegLib"
-        submoduleNames = ['dependency_handler', 'model_database', 'process', 'utils']
+        submoduleNames = ['compression', 'dependency_handler', 'label_runs', 'model_database', 'nrrd_io', 'postprocessing', 'probabilities', 'process', 'profiling', 'progress', 'server_client', 'tracing', 'upload', 'utils']
         import imp
         f, filename, description = imp.find_module(packageName)
         package = imp.load_module(packageName, f, filename, description)
@@ -298,6 +302,7 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.deleteAllModelsButton.connect("clicked(bool)", self.onClearModelsFolder)
 
         self.ui.serverComboBox.lineEdit().setPlaceholderText("Enter server address")
+        self.ui.serverComboBox.setToolTip(_("Address of the segmentation server. Multiple servers can be specified as a comma-separated list: each segmentation is sent to the least loaded server."))
         self.ui.serverComboBox.currentIndexChanged.connect(self.onRemoteServerButtonToggled)
         self.ui.remoteProcessingCheckBox.toggled.connect(self.onRemoteProcessingCheckBoxToggled)
         self.ui.remoteServerButton.toggled.connect(self.onRemoteServerButtonToggled)
@@ -605,7 +610,7 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     sequenceItemsCompleted = sum(task.resultsImported for task in self._segmentationTaskListInfo.segmentationTasks)
 
                 # Progress steps: initialize + 2 (process, import results) for each sequence item
-                self.ui.progressBar.setRange(0, sequenceItemsTotal * 2 + 1)
+                self.ui.progressBar.setRange(0, (sequenceItemsTotal * 2 + 1) * self.PROGRESS_STEP_SIZE)
                 progressValue = 2 * sequenceItemsCompleted + 1
                 if state == self.PROCESSING_IMPORT_RESULTS:
                     progressValue += 1
@@ -614,10 +619,31 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     displayedText += f" ({sequenceItemsCompleted + 1}/{sequenceItemsTotal})"
 
             self.ui.progressBar.show()
-            self.ui.progressBar.value = progressValue
+            self.ui.progressBar.value = progressValue * self.PROGRESS_STEP_SIZE
             self.ui.progressBar.setFormat(text := displayedText)
             self.addLog(text)
 
+    def updateJobProgress(self, segmentationTaskInfo):
+        """Show status of processing on the server (waiting in the queue or processing progress) in the progress bar.
+        Unlike processing state changes, these frequent updates are not logged."""
+        jobProgress = segmentationTaskInfo.jobProgress
+        if self._processingState != self.PROCESSING_IN_PROGRESS or not jobProgress:
+            return
+        if jobProgress.status == "queued":
+            details = _("waiting in server queue, position {position}").format(position=jobProgress.queuePosition + 1)
+        else:
+            details = f"{jobProgress.stage or _('starting')}, {round(jobProgress.progress * 100)}%"
+            # Show processing progress within the processing step of the sequence item
+            processingStepStart = self.ui.progressBar.value - self.ui.progressBar.value % self.PROGRESS_STEP_SIZE
+            self.ui.progressBar.value = processingStepStart + round(jobProgress.progress * (self.PROGRESS_STEP_SIZE - 1))
+        if jobProgress.eta is not None:
+            details += ", " + _("{time} remaining").format(time=humanReadableTimeFromSec(jobProgress.eta))
+        text = self.getHumanReadableProcessingState(self._processingState)
+        sequenceBrowserNode = self._segmentationTaskListInfo.sequenceBrowserNode if self._segmentationTaskListInfo else None
+        if sequenceBrowserNode and sequenceBrowserNode.GetNumberOfItems() > 1:
+            text += f" ({segmentationTaskInfo.sequenceItemIndex + 1}/{sequenceBrowserNode.GetNumberOfItems()})"
+        self.ui.progressBar.setFormat(f"{text}: {details}")
+
     def addServerLog(self, *args):
         for arg in args:
             if self.ui.logConsoleCheckBox.checked:
@@ -693,6 +719,11 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         elif eventCode == EventCode.TASK_PROCESSING_ENDED:
             #self.setProcessingState(MONAIAuto3DSegWidget.PROCESSING_IN_PROGRESS)
             pass
+        elif eventCode == EventCode.TASK_PROGRESS_UPDATED:
+            # Only the latest update is shown, the task that it belongs to is the one with the most recent update
+            updatedTasks = [task for task in segmentationTaskInfo.segmentationTasks if task.jobProgress and not task.resultsImported]
+            if updatedTasks:
+                self.updateJobProgress(updatedTasks[-1])
         elif eventCode == EventCode.TASK_IMPORTING_RESULTS_STARTED:
             self.setProcessingState(MONAIAuto3DSegWidget.PROCESSING_IMPORT_RESULTS)
             qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
@@ -826,7 +857,7 @@ class MONAIAuto3DSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 if not self._webServer or not self._webServer.isRunning() :
                     import platform
                     from pathlib import Path
-                    slicer.util.pip_install("psutil python-multipart fastapi slowapi uvicorn[standard]")
+                    slicer.util.pip_install("psutil python-multipart fastapi uvicorn[standard]")
 
                     hostName = platform.node()
                     port = str(self.ui.portSpinBox.value)
@@ -921,6 +952,10 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
 
     DEPENDENCY_HANDLER = SlicerPythonDependencies()
 
+    # Segmentation node attributes for re-labelling the segmentation from saved probabilities
+    PROBABILITIES_FILE_ATTRIBUTE_NAME = "MONAIAuto3DSeg.ProbabilitiesFile"
+    MODEL_ATTRIBUTE_NAME = "MONAIAuto3DSeg.Model"
+
     @staticmethod
     def assignInputNodesByName(inputs, loadedSampleNodes):
 
@@ -1079,6 +1114,40 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         self.useStandardSegmentNames = True
         self.autoShow3D = False
 
+        # Encoding of the segmentation result file written by the inference script ("raw" or "gzip").
+        # Raw is the fastest when the result is read from local disk.
+        self.outputEncoding = "raw"
+        self.outputCompressionLevel = 1
+        # Only write the bounding box of non-zero labels, which makes writing and importing the result faster
+        self.cropOutput = True
+
+        # Save class probabilities computed by the model, which allows changing threshold or post-processing
+        # (see relabelSegmentation) without running the model again. Probabilities are stored as "uint8" or "float16".
+        self.saveProbabilities = False
+        self.probabilitiesDtype = "uint8"
+
+        # If a file path is set then the time spent in each processing step (writing or uploading the input,
+        # waiting in the server queue, each stage of the inference, importing the result) is recorded as trace spans
+        # in this file (JSON Lines, see MONAIAuto3DSegLib.tracing). The trace id is propagated to the inference script
+        # and the server, which can record their spans in the same trace.
+        self.traceFile = None
+        self._tracer = None
+
+        # Profile each stage of local inference using "torch" profiler, "cprofile", or both ("torch,cprofile").
+        # Chrome trace, pstats, and summary of top operators of each stage are saved in a subfolder of
+        # the "MONAIAuto3DSeg/profiles" folder in the Slicer temporary folder. Profiling slows down processing.
+        # For processing on a server, profiling is enabled by the server's --profile option.
+        self.profile = None
+
+        # Process sequence items in a pipeline: the input of the next item is written and the result of the previous
+        # item is imported while the current item is segmented. Only used if processing does not wait for completion.
+        self.pipelineSequenceProcessing = True
+        # Number of sequence items that are segmented at the same time when processing on CPU. The CPU threads
+        # (cpuThreadBudget, by default all CPU cores) are shared equally between the inference processes.
+        # On GPU, items are segmented one at a time.
+        self.maximumConcurrentSequenceItemsOnCpu = 2
+        self.cpuThreadBudget = None
+
         # For testing the logic without actually running inference, set self.debugSkipInferenceTempDir to the location
         # where inference result is stored and set self.debugSkipInference to True.
         # Disabling this flag preserves input and output data after execution is completed,
@@ -1087,6 +1156,24 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         self.debugSkipInference = False
         self.debugSkipInferenceTempDir = r"c:\Users\andra\AppData\Local\Temp\Slicer\__SlicerTemp__2024-01-16_15+26+25.624"
 
+    @property
+    def tracer(self):
+        """Tracer that records spans in traceFile, None if tracing is disabled"""
+        if not self.traceFile:
+            return None
+        if self._tracer is None or self._tracer.exporter.path != str(self.traceFile):
+            self._tracer = Tracer("Slicer", JsonFileSpanExporter(self.traceFile))
+        return self._tracer
+
+    def _startTrace(self, segmentationTaskListInfo, sequenceItemIndex):
+        """Start the span that records processing of a segmentation task item, None if tracing is disabled"""
+        if not self.tracer:
+            return None
+        traceSpan = self.tracer.startSpan("segmentation", attributes={"model": segmentationTaskListInfo.model,
+                                                                       "sequenceItemIndex": sequenceItemIndex})
+        logging.info(f"Recording trace {traceSpan.traceId} in {self.traceFile}")
+        return traceSpan
+
     def log(self, text):
         logging.info(text)
         if self.logCallback:
@@ -1268,6 +1355,7 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
     def _processSingle(self, segmentationTaskListInfo, completedCallback=None):
         """
         Run the processing algorithm on a single item of a sequence.
+        If sequence processing is pipelined then the next items are started as well (see _updateSequencePipeline).
         Can be used without GUI widget.
         :param segmentationTaskListInfo: SegmentationTaskListInfo object, describing the segmentation task
         :param completedCallback: function to call when processing is completed
@@ -1277,6 +1365,25 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
             with slicer.util.tryWithErrorDisplay("Failed to install required dependencies.", waitCursor=True):
                 self.DEPENDENCY_HANDLER.setupPythonRequirements()
 
+        if self._isSequenceProcessingPipelined(segmentationTaskListInfo):
+            self._updateSequencePipeline(segmentationTaskListInfo)
+            return
+
+        segmentationTaskInfo = self._prepareLocalInference(segmentationTaskListInfo)
+
+        if self.debugSkipInference:
+            segmentationTaskInfo.processingStarted = True
+            segmentationTaskInfo.backgroundProcess.procReturnCode = 0
+            self.onSegmentationProcessCompleted(segmentationTaskInfo)
+            return
+
+        self._startLocalInference(segmentationTaskInfo)
+
+    def _prepareLocalInference(self, segmentationTaskListInfo):
+        """
+        Write the input of the next sequence item (or the only item) and create the inference command for it.
+        Returns the SegmentationTaskInfo of the item, which is added to the task list.
+        """
         sequenceItemIndex = self._prepareProcessSingle(segmentationTaskListInfo)
 
         model = segmentationTaskListInfo.model
@@ -1286,6 +1393,7 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         modelPath = self.modelPath(model)
 
         logging.info("Processing started")
+        traceSpan = self._startTrace(segmentationTaskListInfo, sequenceItemIndex)
 
         if self.debugSkipInference:
             self.clearOutputFolder = False
@@ -1303,18 +1411,19 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
 
         # Write input volume to file
         inputFiles = []
-        for inputIndex, inputNode in enumerate(segmentationTaskListInfo.inputNodes):
-            if inputNode.IsA('vtkMRMLScalarVolumeNode'):
-                inputImageFile = tempDir + f"/input-volume{inputIndex}.nrrd"
-                logging.info(f"Writing input file to {inputImageFile}")
-                volumeStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
-                volumeStorageNode.SetFileName(inputImageFile)
-                volumeStorageNode.UseCompressionOff()
-                volumeStorageNode.WriteData(inputNode)
-                slicer.mrmlScene.RemoveNode(volumeStorageNode)
-                inputFiles.append(inputImageFile)
-            else:
-                raise ValueError(f"Input node type {inputNode.GetClassName()} is not supported")
+        with childSpan("write input", parent=traceSpan):
+            for inputIndex, inputNode in enumerate(segmentationTaskListInfo.inputNodes):
+                if inputNode.IsA('vtkMRMLScalarVolumeNode'):
+                    inputImageFile = tempDir + f"/input-volume{inputIndex}.nrrd"
+                    logging.info(f"Writing input file to {inputImageFile}")
+                    volumeStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
+                    volumeStorageNode.SetFileName(inputImageFile)
+                    volumeStorageNode.UseCompressionOff()
+                    volumeStorageNode.WriteData(inputNode)
+                    slicer.mrmlScene.RemoveNode(volumeStorageNode)
+                    inputFiles.append(inputImageFile)
+                else:
+                    raise ValueError(f"Input node type {inputNode.GetClassName()} is not supported")
 
         outputSegmentationFile = tempDir + "/output-segmentation.nrrd"
         modelPtFile = modelPath.joinpath("model.pt")
@@ -1322,10 +1431,31 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         auto3DSegCommand = [ pythonSlicerExecutablePath, str(inferenceScriptPyFile),
             "--model-file", str(modelPtFile),
             "--image-file", inputFiles[0],
-            "--result-file", str(outputSegmentationFile) ]
+            "--result-file", str(outputSegmentationFile),
+            "--output-encoding", self.outputEncoding,
+            "--compression-level", str(self.outputCompressionLevel) ]
+        if self.cropOutput:
+            auto3DSegCommand.append("--crop-output")
+        postProcessing = self.model(model).get("postProcessing")
+        if postProcessing:
+            auto3DSegCommand.extend(["--post-processing", json.dumps(postProcessing)])
+        probabilitiesFile = ""
+        if self.saveProbabilities:
+            # Probabilities are kept after the temporary folder is cleaned up (until next segmentation to the same node)
+            probabilitiesFile = self._probabilitiesFilePath(segmentationTaskListInfo.outputSegmentation, sequenceItemIndex)
+            auto3DSegCommand.extend(["--probabilities-file", probabilitiesFile, "--probabilities-dtype", self.probabilitiesDtype])
         for inputIndex in range(1, len(inputFiles)):
             auto3DSegCommand.append(f"--image-file-{inputIndex+1}")
             auto3DSegCommand.append(inputFiles[inputIndex])
+        if traceSpan:
+            # Stages of the inference script are recorded as children of the segmentation span
+            auto3DSegCommand.extend(["--trace-file", str(self.traceFile), "--traceparent", traceSpan.traceparent])
+        if self.profile:
+            # Profiling results are kept after the temporary folder is cleaned up
+            profileDir = os.path.join(slicer.app.temporaryPath, "MONAIAuto3DSeg", "profiles",
+                                      time.strftime("%Y%m%d-%H%M%S") + f"-{sequenceItemIndex}")
+            logging.info(f"Profiling results will be saved in {profileDir}")
+            auto3DSegCommand.extend(["--profile", self.profile, "--profile-dir", profileDir])
 
         logging.info("Creating segmentations with MONAIAuto3DSeg AI...")
         logging.info(f"Auto3DSeg command: {auto3DSegCommand}")
@@ -1333,30 +1463,91 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         additionalEnvironmentVariables = None
         if segmentationTaskListInfo.cpu:
             additionalEnvironmentVariables = {"CUDA_VISIBLE_DEVICES": "-1"}
+            maximumConcurrentItems = self._maximumConcurrentSequenceItems(segmentationTaskListInfo)
+            if maximumConcurrentItems > 1:
+                # Concurrent inference processes share the CPU threads, instead of each using all CPU cores
+                numberOfThreads = max(1, (self.cpuThreadBudget or os.cpu_count() or 1) // maximumConcurrentItems)
+                additionalEnvironmentVariables["OMP_NUM_THREADS"] = str(numberOfThreads)
+                additionalEnvironmentVariables["MKL_NUM_THREADS"] = str(numberOfThreads)
             logging.info(f"Additional environment variables: {additionalEnvironmentVariables}")
 
         segmentationTaskInfo = SegmentationTaskInfo()
         segmentationTaskInfo.tempDir = tempDir
         segmentationTaskInfo.outputSegmentationFile = outputSegmentationFile
         segmentationTaskInfo.sequenceItemIndex = sequenceItemIndex
+        segmentationTaskInfo.probabilitiesFile = probabilitiesFile
+        segmentationTaskInfo.traceSpan = traceSpan
+        segmentationTaskInfo.inferenceCommand = auto3DSegCommand
+        segmentationTaskInfo.additionalEnvironmentVariables = additionalEnvironmentVariables
         segmentationTaskInfo.segmentationTaskListInfo = segmentationTaskListInfo
         segmentationTaskListInfo.segmentationTasks.append(segmentationTaskInfo)
 
         segmentationTaskInfo.backgroundProcess = LocalInference(taskInfo=segmentationTaskInfo, logCallback=self.log, completedCallback=self.onSegmentationProcessCompleted)
-
-        if self.debugSkipInference:
-            segmentationTaskInfo.backgroundProcess.procReturnCode = 0
-            self.onSegmentationProcessCompleted(segmentationTaskInfo)
+        return segmentationTaskInfo
+
+    def _startLocalInference(self, segmentationTaskInfo):
+        """Start the inference process of a sequence item whose input has been written by _prepareLocalInference."""
+        segmentationTaskInfo.processingStarted = True
+        # Input may have been written well before the item is started, only measure the time of the segmentation
+        segmentationTaskInfo.backgroundProcess.startTime = time.time()
+        segmentationTaskInfo.backgroundProcess.run(segmentationTaskInfo.inferenceCommand,
+            additionalEnvironmentVariables=segmentationTaskInfo.additionalEnvironmentVariables,
+            waitForCompletion=segmentationTaskInfo.segmentationTaskListInfo.waitForCompletion)
+
+    def _isSequenceProcessingPipelined(self, segmentationTaskListInfo):
+        """Sequence items are processed in a pipeline if the caller does not wait for completion of each item."""
+        return (self.pipelineSequenceProcessing and segmentationTaskListInfo.sequenceBrowserNode is not None
+                and not segmentationTaskListInfo.waitForCompletion and not self.debugSkipInference)
+
+    def _maximumConcurrentSequenceItems(self, segmentationTaskListInfo):
+        """Number of sequence items that may be segmented at the same time."""
+        if not segmentationTaskListInfo.cpu or not self._isSequenceProcessingPipelined(segmentationTaskListInfo):
+            return 1
+        return max(1, min(self.maximumConcurrentSequenceItemsOnCpu, segmentationTaskListInfo.sequenceBrowserNode.GetNumberOfItems()))
+
+    def _updateSequencePipeline(self, segmentationTaskListInfo, prepareNextItem=True):
+        """
+        Start segmentation of sequence items whose input is written, as long as fewer than the maximum number
+        of items are being segmented, and write the input of the next item in advance (if prepareNextItem is True),
+        so that it can be started as soon as a running item is completed.
+        """
+        if segmentationTaskListInfo.pipelineUpdateInProgress:
+            # Called from an event callback of an ongoing update, which will take care of the new state
             return
+        segmentationTaskListInfo.pipelineUpdateInProgress = True
+        try:
+            maximumConcurrentItems = self._maximumConcurrentSequenceItems(segmentationTaskListInfo)
+            numberOfItems = segmentationTaskListInfo.sequenceBrowserNode.GetNumberOfItems()
+            while not self._isCancelled(segmentationTaskListInfo):
+                tasks = segmentationTaskListInfo.segmentationTasks
+                preparedTasks = [task for task in tasks if not task.processingStarted]
+                numberOfRunningTasks = len([task for task in tasks if task.processingStarted and not task.processingEnded])
+                if preparedTasks and numberOfRunningTasks < maximumConcurrentItems:
+                    self.log(_("Segmenting sequence item {item_number}/{number_of_items}").format(
+                        item_number=preparedTasks[0].sequenceItemIndex+1, number_of_items=numberOfItems))
+                    self._startLocalInference(preparedTasks[0])
+                elif prepareNextItem and not preparedTasks and len(tasks) < numberOfItems:
+                    self._prepareLocalInference(segmentationTaskListInfo)
+                else:
+                    break
+        finally:
+            segmentationTaskListInfo.pipelineUpdateInProgress = False
 
-        segmentationTaskInfo.backgroundProcess.run(auto3DSegCommand, additionalEnvironmentVariables=additionalEnvironmentVariables, waitForCompletion=segmentationTaskListInfo.waitForCompletion)
-
+    @staticmethod
+    def _isCancelled(segmentationTaskListInfo):
+        return any(task.backgroundProcess and task.backgroundProcess.procReturnCode == ExitCode.USER_CANCELLED
+                   for task in segmentationTaskListInfo.segmentationTasks)
 
     def onSegmentationProcessCompleted(self, segmentationTaskInfo: SegmentationTaskInfo):
+        segmentationTaskInfo.processingEnded = True
         if segmentationTaskInfo.segmentationTaskListInfo.eventCallback:
             segmentationTaskInfo.segmentationTaskListInfo.eventCallback(EventCode.TASK_PROCESSING_ENDED, segmentationTaskInfo.segmentationTaskListInfo)
         procReturnCode = segmentationTaskInfo.backgroundProcess.procReturnCode
         cancelRequested = procReturnCode == ExitCode.USER_CANCELLED
+        pipelined = self._isSequenceProcessingPipelined(segmentationTaskInfo.segmentationTaskListInfo)
+        if pipelined and not cancelRequested:
+            # Start segmenting the next item (its input is already written) before importing the result of this item
+            self._updateSequencePipeline(segmentationTaskInfo.segmentationTaskListInfo, prepareNextItem=False)
         if not cancelRequested:
             if procReturnCode == 0:
                 outputSegmentation = segmentationTaskInfo.segmentationTaskListInfo.outputSegmentation
@@ -1372,14 +1563,18 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
                         sequenceBrowserNode.PlaybackActiveOff()
                         sequenceBrowserNode.SetSelectedItemNumber(segmentationTaskInfo.sequenceItemIndex)
 
-                    self.readSegmentation(outputSegmentation, segmentationTaskInfo.outputSegmentationFile, segmentationTaskInfo.segmentationTaskListInfo.model)
-
-                    # Set source volume - required for DICOM Segmentation export
                     inputVolume = segmentationTaskInfo.segmentationTaskListInfo.inputNodes[0]
                     if not inputVolume.IsA('vtkMRMLScalarVolumeNode'):
                         raise ValueError("First input node must be a scalar volume")
-                    outputSegmentation.SetNodeReferenceID(outputSegmentation.GetReferenceImageGeometryReferenceRole(), inputVolume.GetID())
-                    outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+                    with childSpan("import result", parent=segmentationTaskInfo.traceSpan):
+                        self.readSegmentation(outputSegmentation, segmentationTaskInfo.outputSegmentationFile, segmentationTaskInfo.segmentationTaskListInfo.model, inputVolume)
+
+                    # Store information for re-labelling
+                    outputSegmentation.SetAttribute(self.MODEL_ATTRIBUTE_NAME, segmentationTaskInfo.segmentationTaskListInfo.model)
+                    if segmentationTaskInfo.probabilitiesFile and os.path.exists(segmentationTaskInfo.probabilitiesFile):
+                        outputSegmentation.SetAttribute(self.PROBABILITIES_FILE_ATTRIBUTE_NAME, segmentationTaskInfo.probabilitiesFile)
+                    else:
+                        outputSegmentation.RemoveAttribute(self.PROBABILITIES_FILE_ATTRIBUTE_NAME)
 
                     # Place segmentation node in the same place as the input volume
                     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
@@ -1399,6 +1594,11 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
             else:
                 logging.info(f"Processing failed with return code {procReturnCode}")
 
+        if segmentationTaskInfo.traceSpan:
+            segmentationTaskInfo.traceSpan.setAttribute("cancelled", cancelRequested)
+            segmentationTaskInfo.traceSpan.end(error=f"Processing failed with return code {procReturnCode}"
+                                               if procReturnCode != 0 and not cancelRequested else None)
+
         tempDir = segmentationTaskInfo.tempDir
         if self.clearOutputFolder:
             logging.info("Cleaning up temporary folder.")
@@ -1412,6 +1612,10 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
         elapsedTime = time.time() - segmentationTaskInfo.backgroundProcess.startTime
         if cancelRequested:
             logging.info(f"Processing was cancelled after {elapsedTime:.2f} seconds.")
+            if pipelined:
+                self._cancelPreparedSequenceItems(segmentationTaskInfo.segmentationTaskListInfo)
+            elif segmentationTaskInfo.segmentationTaskListInfo.remoteSequenceInference:
+                self._removeNotStartedSequenceItemFolders(segmentationTaskInfo.segmentationTaskListInfo)
         else:
             if procReturnCode == 0:
                 logging.info(f"Processing was completed in {elapsedTime:.2f} seconds.")
@@ -1419,7 +1623,10 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
                 logging.info(f"Processing failed after {elapsedTime:.2f} seconds.")
 
             sequenceBrowserNode = segmentationTaskInfo.segmentationTaskListInfo.sequenceBrowserNode
-            if sequenceBrowserNode:
+            if pipelined:
+                # Write the input of the next item while the current items are segmented
+                self._updateSequencePipeline(segmentationTaskInfo.segmentationTaskListInfo)
+            elif sequenceBrowserNode:
                 # We are segmenting a sequence
                 numberOfProcessedItems = len(segmentationTaskInfo.segmentationTaskListInfo.segmentationTasks)
                 numberOfItems = sequenceBrowserNode.GetNumberOfItems()
@@ -1429,16 +1636,107 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
                     self._processSingle(segmentationTaskInfo.segmentationTaskListInfo)
                     return
 
+        if pipelined and not self._isSequencePipelineCompleted(segmentationTaskInfo.segmentationTaskListInfo):
+            # Other sequence items are still being processed
+            return
+
         # We are done with the entire task list
         if segmentationTaskInfo.segmentationTaskListInfo.eventCallback:
             segmentationTaskInfo.segmentationTaskListInfo.eventCallback(EventCode.TASKLIST_PROCESSING_ENDED, segmentationTaskInfo.segmentationTaskListInfo)
 
+    def _isSequencePipelineCompleted(self, segmentationTaskListInfo):
+        """All sequence items are processed (or processing was cancelled) and no item is being processed."""
+        tasks = segmentationTaskListInfo.segmentationTasks
+        if any(not task.processingEnded for task in tasks):
+            return False
+        return self._isCancelled(segmentationTaskListInfo) or len(tasks) >= segmentationTaskListInfo.sequenceBrowserNode.GetNumberOfItems()
+
+    def _cancelPreparedSequenceItems(self, segmentationTaskListInfo):
+        """Clean up sequence items whose input has been written, but their segmentation has not been started."""
+        for task in segmentationTaskListInfo.segmentationTasks:
+            if task.processingStarted or task.processingEnded:
+                continue
+            task.backgroundProcess.stop()
+            task.processingEnded = True
+            if task.traceSpan:
+                task.traceSpan.setAttribute("cancelled", True)
+                task.traceSpan.end()
+            if self.clearOutputFolder and os.path.isdir(task.tempDir):
+                import shutil
+                shutil.rmtree(task.tempDir)
+
+    def _removeNotStartedSequenceItemFolders(self, segmentationTaskListInfo):
+        """Remove temporary folders of sequence items that are processed in a single server job (see
+        _startSequenceInference), but were not started because processing was cancelled."""
+        if not self.clearOutputFolder:
+            return
+        import shutil
+        startedItemIndices = {task.sequenceItemIndex for task in segmentationTaskListInfo.segmentationTasks}
+        for itemIndex, outputFile in enumerate(segmentationTaskListInfo.remoteSequenceInference.itemOutputFiles):
+            if itemIndex not in startedItemIndices:
+                # Input files may still be open for uploading if the job was cancelled during upload
+                shutil.rmtree(os.path.dirname(outputFile), ignore_errors=True)
+
+    def _probabilitiesFilePath(self, outputSegmentation, sequenceItemIndex):
+        probabilitiesDir = os.path.join(slicer.app.temporaryPath, "MONAIAuto3DSeg", "probabilities")
+        os.makedirs(probabilitiesDir, exist_ok=True)
+        return os.path.join(probabilitiesDir, f"{outputSegmentation.GetID()}-{sequenceItemIndex}{PROBABILITIES_FILE_EXTENSION}")
+
+    def relabelSegmentation(self, outputSegmentation, threshold=None, postProcessing=None, confidenceVolumeNode=None):
+        """
+        Recompute the segmentation from the probabilities that were saved when the segmentation was computed
+        (requires saveProbabilities to be enabled), without running the model again.
+        :param outputSegmentation: segmentation node that was computed by this module
+        :param threshold: minimum probability (0.0-1.0) of foreground classes. If None then the most probable class is used.
+        :param postProcessing: list of post-processing steps (same format as in Models.json). If None then the
+          post-processing steps of the model are used.
+        :param confidenceVolumeNode: if a scalar volume node is specified then the probability of the chosen class (0-255)
+          is written into it, which can be used for displaying a confidence overlay.
+        """
+        probabilitiesFile = outputSegmentation.GetAttribute(self.PROBABILITIES_FILE_ATTRIBUTE_NAME)
+        if not probabilitiesFile or not os.path.exists(probabilitiesFile):
+            raise ValueError("Probabilities are not available for this segmentation. Enable saving of probabilities and segment again.")
+        model = outputSegmentation.GetAttribute(self.MODEL_ATTRIBUTE_NAME)
+        referenceVolumeNode = outputSegmentation.GetNodeReference(outputSegmentation.GetReferenceImageGeometryReferenceRole())
+        if postProcessing is None:
+            postProcessing = self.model(model).get("postProcessing")
+
+        from MONAIAuto3DSegLib.probabilities import loadProbabilities, relabel
+        from MONAIAuto3DSegLib.nrrd_io import writeNrrd, cropToNonZero
+        startTime = time.time()
+        labelmap, header, confidence = relabel(loadProbabilities(probabilitiesFile), threshold, postProcessing,
+                                               computeConfidence=confidenceVolumeNode is not None)
+
+        tempDir = slicer.util.tempDirectory()
+        try:
+            outputSegmentationFile = os.path.join(tempDir, "output-segmentation.nrrd")
+            labelmap, header = cropToNonZero(labelmap, header)
+            writeNrrd(outputSegmentationFile, labelmap, header)
+            self.readSegmentation(outputSegmentation, outputSegmentationFile, model, referenceVolumeNode)
+        finally:
+            import shutil
+            shutil.rmtree(tempDir)
+
+        if confidenceVolumeNode:
+            # numpy array axis order in Slicer is KJI
+            slicer.util.updateVolumeFromArray(confidenceVolumeNode, confidence.transpose(2, 1, 0))
+            if referenceVolumeNode:
+                confidenceVolumeNode.CopyOrientation(referenceVolumeNode)
+
+        logging.info(f"Relabelling was completed in {time.time() - startTime:.2f} seconds.")
+
     def cancelProcessing(self, segmentationTaskListInfo):
         for segmentationTaskInfo in segmentationTaskListInfo.segmentationTasks:
             if segmentationTaskInfo.backgroundProcess:
                 segmentationTaskInfo.backgroundProcess.stop()
 
-    def readSegmentation(self, outputSegmentation, outputSegmentationFile, model):
+    def readSegmentation(self, outputSegmentation, outputSegmentationFile, model, referenceVolumeNode=None):
+        """Load segmentation result file into the output segmentation node.
+        :param referenceVolumeNode: volume that the segmentation was computed from. The result file is read first
+          (in the geometry stored in the file) and then the reference volume is set as the reference geometry.
+          The result file may only contain the bounding box of non-zero labels, but that block lies on the voxel grid
+          of the reference volume, therefore changing the reference geometry does not require resampling the labels.
+        """
         labelValueToDescription = self.labelDescriptions(model)
 
         # Get label descriptions
@@ -1470,6 +1768,11 @@ class MONAIAuto3DSegLogic(ScriptedLoadableModuleLogic, ModelDatabase):
 
         slicer.mrmlScene.RemoveNode(colorTableNode)
 
+        if referenceVolumeNode:
+            # Set source volume - required for DICOM Segmentation export
+            outputSegmentation.SetNodeReferenceID(outputSegmentation.GetReferenceImageGeometryReferenceRole(), referenceVolumeNode.GetID())
+            outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
+
         # Set terminology and color
         for labelValue in labelValueToDescription:
             terminologyEntryStr = labelValueToDescription[labelValue]["terminology"]
@@ -1496,6 +1799,9 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
 
     DEPENDENCY_HANDLER = RemotePythonDependencies()
 
+    # Inputs are only downsampled if it reduces the number of voxels at least by this factor
+    PRE_RESAMPLING_MINIMUM_REDUCTION = 2.0
+
     @property
     def server_address(self):
         return self._server_address
@@ -1505,11 +1811,35 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
         self.DEPENDENCY_HANDLER.server_address = address
         self._server_address = address
         self._models = []
+        self._modelPreprocessing = {}
+
+    @property
+    def serverClient(self):
+        """ServerClient object that is used for requests that any of the servers can answer (model list, etc.)"""
+        return self.DEPENDENCY_HANDLER.serverClient
+
+    @property
+    def serverPool(self):
+        """ServerPool object that distributes segmentation jobs between the servers. Multiple servers can be used
+        by setting server_address to a comma-separated list of addresses."""
+        return self.DEPENDENCY_HANDLER.serverPool
 
     def __init__(self):
         self._server_address = None
         MONAIAuto3DSegLogic.__init__(self)
         self._models = []
+        self._modelPreprocessing = {}  # model name -> preprocessing information received from the server
+
+        # Downsample input images to the resolution of the model before uploading (the server returns the segmentation
+        # in the voxel grid of the original image). Reduces upload size and time for low-resolution ("quick") models.
+        self.preResampleInputs = False
+
+        # Segment all items of a sequence in a single job on the server, so that the model is only loaded once.
+        # Results are imported item by item, as they are completed. Servers that cannot process sequences
+        # get a separate job for each item.
+        self.processSequenceInSingleJob = True
+        # Items are not written and segmented locally, so the local sequence processing pipeline is not used
+        self.pipelineSequenceProcessing = False
 
     def getMONAIPythonPackageInfo(self):
         return self.DEPENDENCY_HANDLER.installedMONAIPythonPackageInfo()
@@ -1522,7 +1852,7 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
         if not self._server_address:
             return []
         else:
-            response = requests.get(self._server_address + "/models")
+            response = self.serverClient.get("/models")
             json_data = json.loads(response.text)
             return json_data
 
@@ -1539,7 +1869,7 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
             tempDir = slicer.util.tempDirectory()
             tempDir = Path(tempDir)
             outfile = tempDir / "labelDescriptions.csv"
-            with requests.get(self._server_address + f"/labelDescriptions?id={modelName}", stream=True) as r:
+            with self.serverClient.get("/labelDescriptions", params={"id": modelName}, stream=True) as r:
                 r.raise_for_status()
 
                 with open(outfile, 'wb') as f:
@@ -1552,6 +1882,163 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
             shutil.rmtree(tempDir)
             return labelDescriptions
 
+    def modelPreprocessing(self, modelName):
+        """Get how the model preprocesses input images ("resampleResolution", "orientationRas", "cropForeground").
+        Returns None if the server does not provide this information.
+        """
+        if modelName not in self._modelPreprocessing:
+            response = self.serverClient.get("/modelinfo", params={"id": modelName})
+            response.raise_for_status()
+            self._modelPreprocessing[modelName] = response.json().get("preprocessing")
+        return self._modelPreprocessing[modelName]
+
+    def _preResampledSpacing(self, inputNode, preprocessing):
+        """Get the spacing that the input volume can be downsampled to before uploading, None if the volume
+        should be uploaded at its original resolution.
+        """
+        resampleResolution = preprocessing.get("resampleResolution") if preprocessing else None
+        if not resampleResolution:
+            return None
+        ijkToRas = vtk.vtkMatrix4x4()
+        inputNode.GetIJKToRASMatrix(ijkToRas)
+        spacing = inputNode.GetSpacing()
+        resampledSpacing = []
+        for axis in range(3):
+            if preprocessing.get("orientationRas"):
+                # Resolution is specified along RAS axes, find the RAS axis that is the closest to the IJK axis
+                modelAxis = max(range(3), key=lambda rasAxis: abs(ijkToRas.GetElement(rasAxis, axis)))
+            else:
+                modelAxis = axis
+            # Never upsample, the server resamples to the model resolution anyway
+            resampledSpacing.append(max(spacing[axis], float(resampleResolution[modelAxis])))
+        reduction = (resampledSpacing[0] * resampledSpacing[1] * resampledSpacing[2]) / (spacing[0] * spacing[1] * spacing[2])
+        if reduction < self.PRE_RESAMPLING_MINIMUM_REDUCTION:
+            return None
+        return resampledSpacing
+
+    @staticmethod
+    def _resampleVolume(inputNode, spacing=None, referenceNode=None):
+        """Create a resampled copy of the volume, with the specified spacing or in the voxel grid of referenceNode"""
+        resampledNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputNode.GetName() + " resampled")
+        if referenceNode:
+            parameters = {"inputVolume": inputNode.GetID(), "outputVolume": resampledNode.GetID(),
+                          "referenceVolume": referenceNode.GetID(), "interpolationType": "linear"}
+            cliNode = slicer.cli.runSync(slicer.modules.resamplescalarvectordwivolume, None, parameters)
+        else:
+            parameters = {"InputVolume": inputNode.GetID(), "OutputVolume": resampledNode.GetID(),
+                          "outputPixelSpacing": ",".join(str(axisSpacing) for axisSpacing in spacing),
+                          "interpolationType": "linear"}
+            cliNode = slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, parameters)
+        slicer.mrmlScene.RemoveNode(cliNode)
+        return resampledNode
+
+    def onJobProgress(self, segmentationTaskInfo, jobProgress):
+        """Forward status updates of processing on the server (queue position, processing stage, progress)."""
+        segmentationTaskInfo.jobProgress = jobProgress
+        segmentationTaskListInfo = segmentationTaskInfo.segmentationTaskListInfo
+        if segmentationTaskListInfo.eventCallback:
+            segmentationTaskListInfo.eventCallback(EventCode.TASK_PROGRESS_UPDATED, segmentationTaskListInfo)
+
+    @staticmethod
+    def _volumeGeometry(volumeNode):
+        """Get voxel grid of the volume as it is written to NRRD file (see MONAIAuto3DSegLib.nrrd_io.parseImageGeometry)"""
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        # NRRD files are written in LPS coordinate system
+        rasToLps = [-1.0, -1.0, 1.0]
+        return {
+            "space": "left-posterior-superior",
+            "sizes": list(volumeNode.GetImageData().GetDimensions()),
+            "space directions": [[rasToLps[row] * ijkToRas.GetElement(row, axis) for row in range(3)] for axis in range(3)],
+            "space origin": [rasToLps[row] * ijkToRas.GetElement(row, 3) for row in range(3)],
+        }
+
+    def _prepareInputFiles(self, inputNodes, model, traceSpan=None):
+        """Get in-memory input files for uploading the input volumes (optionally downsampled, see preResampleInputs).
+        Returns the list of input files and the voxel grid that the server should return the segmentation in
+        (None if the segmentation is returned in the voxel grid of the input file).
+        """
+        # Low-resolution models do not need the full resolution image, therefore the input can be downsampled
+        # before uploading. The server returns the segmentation in the voxel grid of the original image.
+        resampledInputNodes = []
+        outputGeometry = None
+        if self.preResampleInputs:
+            try:
+                preprocessing = self.modelPreprocessing(model)
+            except Exception as e:
+                logging.warning(f"Failed to get model preprocessing information from the server: {e}")
+                preprocessing = None
+            resampledSpacing = self._preResampledSpacing(inputNodes[0], preprocessing)
+            if resampledSpacing:
+                self.log(_("Downsampling input to {spacing} mm spacing before uploading").format(
+                    spacing="x".join(f"{axisSpacing:.2f}" for axisSpacing in resampledSpacing)))
+                with childSpan("downsample input", parent=traceSpan):
+                    resampledInputNodes.append(self._resampleVolume(inputNodes[0], spacing=resampledSpacing))
+                    for inputNode in inputNodes[1:]:
+                        # All inputs must have the same voxel grid
+                        resampledInputNodes.append(self._resampleVolume(inputNode, referenceNode=resampledInputNodes[0]))
+                outputGeometry = self._volumeGeometry(inputNodes[0])
+                inputNodes = resampledInputNodes
+
+        # Input volumes are uploaded directly from memory (as NRRD files generated on the fly) in the background.
+        # Voxels are copied, because the volume may be modified or removed while the upload is in progress.
+        from MONAIAuto3DSegLib.upload import InMemoryNrrdFile
+        inputFiles = []
+        try:
+            with childSpan("prepare input", parent=traceSpan):
+                for inputIndex, inputNode in enumerate(inputNodes):
+                    # arrayFromVolume returns KJI axis order, NRRD axis order is IJK
+                    voxels = slicer.util.arrayFromVolume(inputNode).copy().T
+                    inputFiles.append(InMemoryNrrdFile(voxels, self._volumeGeometry(inputNode), f"input-volume{inputIndex}.nrrd"))
+        finally:
+            for resampledInputNode in resampledInputNodes:
+                slicer.mrmlScene.RemoveNode(resampledInputNode)
+        return inputFiles, outputGeometry
+
+    def _startSequenceInference(self, segmentationTaskListInfo, segmentationTaskInfo):
+        """Upload all items of the sequence and start processing them in a single job on the server
+        (see RemoteSequenceInference). Results are saved into a temporary folder of each item.
+        Input of each item is written into its temporary folder and uploaded from there, as keeping the input of all
+        items in memory until they are uploaded would need as much memory as the whole sequence."""
+        import shutil
+        import tempfile
+        sequenceBrowserNode = segmentationTaskListInfo.sequenceBrowserNode
+        itemInputFiles = []
+        itemOutputFiles = []
+        outputGeometry = None
+        try:
+            for itemIndex in range(sequenceBrowserNode.GetNumberOfItems()):
+                # Unique folder for each item (temporary folder of the item is removed when its results are imported)
+                itemDir = tempfile.mkdtemp(prefix="MONAIAuto3DSeg-", dir=slicer.app.temporaryPath)
+                itemOutputFiles.append(os.path.join(itemDir, "output-segmentation.nrrd"))
+                # Input nodes are proxy nodes, they contain the volumes of the selected item
+                sequenceBrowserNode.SetSelectedItemNumber(itemIndex)
+                inputFiles, outputGeometry = self._prepareInputFiles(segmentationTaskListInfo.inputNodes,
+                                                                     segmentationTaskListInfo.model, segmentationTaskInfo.traceSpan)
+                inputFilePaths = []
+                for inputFile in inputFiles:
+                    inputFilePath = os.path.join(itemDir, inputFile.filename)
+                    inputFile.save(inputFilePath)
+                    inputFilePaths.append(inputFilePath)
+                itemInputFiles.append(inputFilePaths)
+        except Exception:
+            for outputFile in itemOutputFiles:
+                shutil.rmtree(os.path.dirname(outputFile), ignore_errors=True)
+            raise
+        finally:
+            sequenceBrowserNode.SetSelectedItemNumber(segmentationTaskInfo.sequenceItemIndex)
+
+        def onProgress(taskInfo, jobProgress):
+            # Progress is shown for the last item that has been started
+            self.onJobProgress(segmentationTaskListInfo.segmentationTasks[-1], jobProgress)
+
+        logging.info(f"Initiating inference of {len(itemInputFiles)} sequence items on {self._server_address}")
+        sequenceInference = RemoteSequenceInference(self.serverPool, taskInfo=segmentationTaskInfo, logCallback=self.log,
+            completedCallback=lambda taskInfo: logging.debug("Sequence processing on the server ended"), progressCallback=onProgress)
+        segmentationTaskListInfo.remoteSequenceInference = sequenceInference
+        sequenceInference.run(segmentationTaskListInfo.model, itemInputFiles, itemOutputFiles,
+                              waitForCompletion=segmentationTaskListInfo.waitForCompletion, outputGeometry=outputGeometry)
+
     def _processSingle(self, segmentationTaskListInfo: SegmentationTaskListInfo):
         """
         Run the processing algorithm on a single item of a sequence.
@@ -1563,66 +2050,45 @@ class RemoteMONAIAuto3DSegLogic(MONAIAuto3DSegLogic):
         sequenceItemIndex = self._prepareProcessSingle(segmentationTaskListInfo)
 
         logging.info("Processing started")
+        traceSpan = self._startTrace(segmentationTaskListInfo, sequenceItemIndex)
 
-        tempDir = slicer.util.tempDirectory()
-        outputSegmentationFile = tempDir + "/output-segmentation.nrrd"
+        for inputNode in segmentationTaskListInfo.inputNodes:
+            if not inputNode.IsA('vtkMRMLScalarVolumeNode'):
+                raise ValueError(f"Input node type {inputNode.GetClassName()} is not supported")
 
-        from tempfile import TemporaryDirectory
-        with TemporaryDirectory(dir=tempDir) as temp_dir:
-            # Write input volume to file
-            from pathlib import Path
-            tempDir = Path(temp_dir)
-            inputFiles = []
-            for inputIndex, inputNode in enumerate(segmentationTaskListInfo.inputNodes):
-                if inputNode.IsA('vtkMRMLScalarVolumeNode'):
-                    inputImageFile = tempDir / f"input-volume{inputIndex}.nrrd"
-                    logging.info(f"Writing input file to {inputImageFile}")
-                    volumeStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
-                    volumeStorageNode.SetFileName(inputImageFile)
-                    volumeStorageNode.UseCompressionOff()
-                    volumeStorageNode.WriteData(inputNode)
-                    slicer.mrmlScene.RemoveNode(volumeStorageNode)
-                    inputFiles.append(inputImageFile)
-                else:
-                    raise ValueError(f"Input node type {inputNode.GetClassName()} is not supported")
+        segmentationTaskInfo = SegmentationTaskInfo()
+        segmentationTaskInfo.sequenceItemIndex = sequenceItemIndex
+        segmentationTaskInfo.traceSpan = traceSpan
+        segmentationTaskInfo.segmentationTaskListInfo = segmentationTaskListInfo
 
-            logging.info(f"Initiating Inference on {self._server_address}")
-            files = {}
-
-            for idx, inputFile in enumerate(inputFiles, start=1):
-                name = "image_file"
-                if idx > 1:
-                    name = f"{name}_{idx}"
-                files[name] = open(inputFile, 'rb')
-
-            segmentationTaskInfo = SegmentationTaskInfo()
-            segmentationTaskInfo.tempDir = tempDir
-            segmentationTaskInfo.sequenceItemIndex = sequenceItemIndex
-            segmentationTaskInfo.outputSegmentationFile = outputSegmentationFile
-            segmentationTaskInfo.segmentationTaskListInfo = segmentationTaskListInfo
-            segmentationTaskInfo.backgroundProcess = BackgroundProcess()  # we don't actually start a new process (we could do it in the future for background processing)
+        sequenceBrowserNode = segmentationTaskListInfo.sequenceBrowserNode
+        if sequenceBrowserNode and sequenceBrowserNode.GetNumberOfItems() > 1 and self.processSequenceInSingleJob:
+            # All items are processed by one job on the server, which is started when the first item is processed.
+            # Each item waits for its result, so that results are imported while the server processes the next items.
+            if not segmentationTaskListInfo.remoteSequenceInference:
+                self._startSequenceInference(segmentationTaskListInfo, segmentationTaskInfo)
+            sequenceInference = segmentationTaskListInfo.remoteSequenceInference
+            segmentationTaskInfo.outputSegmentationFile = sequenceInference.itemOutputFiles[sequenceItemIndex]
+            segmentationTaskInfo.tempDir = os.path.dirname(segmentationTaskInfo.outputSegmentationFile)
             segmentationTaskListInfo.segmentationTasks.append(segmentationTaskInfo)
+            segmentationTaskInfo.backgroundProcess = RemoteSequenceItemInference(sequenceInference, sequenceItemIndex,
+                taskInfo=segmentationTaskInfo, logCallback=self.log, completedCallback=self.onSegmentationProcessCompleted)
+            segmentationTaskInfo.backgroundProcess.run(waitForCompletion=segmentationTaskListInfo.waitForCompletion)
+            return
 
-            r = None
-            try:
+        segmentationTaskInfo.tempDir = slicer.util.tempDirectory()
+        segmentationTaskInfo.outputSegmentationFile = segmentationTaskInfo.tempDir + "/output-segmentation.nrrd"
+        inputFiles, outputGeometry = self._prepareInputFiles(segmentationTaskListInfo.inputNodes, segmentationTaskListInfo.model, traceSpan)
 
-                with requests.post(self._server_address + f"/infer?model_name={segmentationTaskListInfo.model}", files=files) as r:
-                    r.raise_for_status()
-                    with open(outputSegmentationFile, "wb") as binary_file:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            binary_file.write(chunk)
-
-                    segmentationTaskInfo.backgroundProcess.procReturnCode = 0
-            except requests.exceptions.HTTPError as e:
-                from http import HTTPStatus
-                status = HTTPStatus(e.response.status_code)
-                logging.debug(f"Server response content: {r.content}")
-                raise RuntimeError(status.description)
-            finally:
-                for f in files.values():
-                    f.close()
+        logging.info(f"Initiating Inference on {self._server_address}")
+
+        segmentationTaskListInfo.segmentationTasks.append(segmentationTaskInfo)
 
-        self.onSegmentationProcessCompleted(segmentationTaskInfo)
+        # Submit the job, poll its status, and download the result without blocking the application
+        segmentationTaskInfo.backgroundProcess = RemoteInference(self.serverPool, taskInfo=segmentationTaskInfo,
+            logCallback=self.log, completedCallback=self.onSegmentationProcessCompleted, progressCallback=self.onJobProgress)
+        segmentationTaskInfo.backgroundProcess.run(segmentationTaskListInfo.model, inputFiles, segmentationTaskInfo.outputSegmentationFile,
+            waitForCompletion=segmentationTaskListInfo.waitForCompletion, outputGeometry=outputGeometry)
 
 
 #
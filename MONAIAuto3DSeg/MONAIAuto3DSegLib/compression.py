@@ -0,0 +1,94 @@
+import zlib
+
+
+# Chunk size used for reading files that are sent over the network
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# Compression level used for data sent over the network: fast compression, as network transfer is only worth
+# compressing if compression is faster than transferring the data
+GZIP_TRANSFER_COMPRESSION_LEVEL = 1
+ZSTD_TRANSFER_COMPRESSION_LEVEL = 3
+
+
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def supportedContentEncodings():
+    """ Get HTTP content encodings that can be used for compressing data sent over the network (most preferred first).
+    zstd is only available if the zstandard Python package is installed.
+    """
+    encodings = ["gzip"]
+    if _zstandard():
+        encodings.insert(0, "zstd")
+    return encodings
+
+
+def selectContentEncoding(acceptedEncodings):
+    """ Get the most preferred content encoding that is supported by both sides, None if there is no common encoding.
+    :param acceptedEncodings: encodings supported by the other side, as a list or as an Accept-Encoding header value
+    """
+    if isinstance(acceptedEncodings, str):
+        acceptedEncodings = [encoding.split(";")[0].strip().lower() for encoding in acceptedEncodings.split(",")]
+    for encoding in supportedContentEncodings():
+        if encoding in acceptedEncodings:
+            return encoding
+    return None
+
+
+def compressor(encoding):
+    """ Get a streaming compressor object (with compress(data) and flush() methods) for the content encoding. """
+    if encoding == "gzip":
+        return zlib.compressobj(GZIP_TRANSFER_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "zstd" and _zstandard():
+        return _zstandard().ZstdCompressor(level=ZSTD_TRANSFER_COMPRESSION_LEVEL).compressobj()
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def decompressor(encoding):
+    """ Get a streaming decompressor object (with decompress(data) and flush() methods) for the content encoding. """
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "zstd" and _zstandard():
+        return _zstandard().ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def readFileChunks(filename, chunkSize=TRANSFER_CHUNK_SIZE):
+    """ Generator that reads a file in chunks, so that the file does not have to be loaded into memory. """
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            yield chunk
+
+
+def compressChunks(chunks, encoding):
+    """ Generator that compresses a stream of data chunks. """
+    streamCompressor = compressor(encoding)
+    for chunk in chunks:
+        compressedChunk = streamCompressor.compress(chunk)
+        if compressedChunk:
+            yield compressedChunk
+    compressedChunk = streamCompressor.flush()
+    if compressedChunk:
+        yield compressedChunk
+
+
+def decompressChunks(chunks, encoding):
+    """ Generator that decompresses a stream of data chunks. """
+    streamDecompressor = decompressor(encoding)
+    for chunk in chunks:
+        if not chunk:
+            # zstd decompressor does not accept any input after the end of the compressed data
+            continue
+        decompressedChunk = streamDecompressor.decompress(chunk)
+        if decompressedChunk:
+            yield decompressedChunk
+    decompressedChunk = streamDecompressor.flush()
+    if decompressedChunk:
+        yield decompressedChunk
+    if not getattr(streamDecompressor, "eof", True):
+        raise ValueError("Compressed data is incomplete")
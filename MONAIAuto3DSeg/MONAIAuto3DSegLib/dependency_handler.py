@@ -28,6 +28,7 @@ class RemotePythonDependencies(DependenciesBase):
     def __init__(self):
         super().__init__()
         self._server_address = None
+        self.serverPool = None  # ServerPool object, shared by all requests to the servers
 
     @property
     def server_address(self):
@@ -35,15 +36,27 @@ class RemotePythonDependencies(DependenciesBase):
 
     @server_address.setter
     def server_address(self, address):
+        """ Address of the server, or comma-separated list of addresses if multiple servers share the load. """
+        if address == self._server_address:
+            return
+        if self.serverPool:
+            self.serverPool.close()
+        from MONAIAuto3DSegLib.server_client import ServerPool
+        serverAddresses = ServerPool.parseServerAddresses(address) if address else []
+        self.serverPool = ServerPool(serverAddresses) if serverAddresses else None
         self._server_address = address
 
+    @property
+    def serverClient(self):
+        """ Client for requests that any of the servers can answer. """
+        return self.serverPool.preferredClient() if self.serverPool else None
+
     def installedMONAIPythonPackageInfo(self):
         if not self._server_address:
             return []
         else:
             import json
-            import requests
-            response = requests.get(self._server_address + "/monaiinfo")
+            response = self.serverClient.get("/monaiinfo")
             json_data = json.loads(response.text)
             return json_data
 
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+
+from MONAIAuto3DSegLib.nrrd_io import cropToNonZero
+
+
+# Media type of segmentation results in label runs format
+LABEL_RUNS_MEDIA_TYPE = "application/x-monaiauto3dseg-label-runs"
+
+LABEL_RUNS_MAGIC = b"MONAIAuto3DSegLabelRuns1\n"
+
+
+def encodeLabelRuns(data, header):
+    """Encode a labelmap as runs of non-zero voxels within the bounding box of non-zero labels.
+
+    Segmentations of small structures (e.g., aorta) fill a small fraction of the image, and even within the bounding
+    box most voxels are in long runs of the same label, therefore the encoded size is typically a small fraction of
+    the size of the voxel array.
+
+    Format: LABEL_RUNS_MAGIC, a JSON header line (voxel type, bounding box sizes, geometry, number of runs),
+    then three little-endian arrays: start index and length of each run (linear voxel index within the bounding box,
+    in NRRD axis order) and label value of each run. Background (zero) runs are not stored.
+
+    :param data: labelmap array in NRRD axis order (fastest axis first)
+    :param header: header dict, geometry information is copied from here
+    :return: bytes
+    """
+    croppedData, croppedHeader = cropToNonZero(data, header)
+    voxels = np.ravel(croppedData, order="F")
+    # Runs start where the label value changes
+    runStarts = np.concatenate(([0], np.flatnonzero(voxels[1:] != voxels[:-1]) + 1))
+    runLengths = np.diff(np.append(runStarts, len(voxels)))
+    runValues = voxels[runStarts]
+    foreground = runValues != 0
+    indexType = np.dtype("<u4") if len(voxels) < 2 ** 32 else np.dtype("<u8")
+    runStarts = runStarts[foreground].astype(indexType)
+    runLengths = runLengths[foreground].astype(indexType)
+    runValues = runValues[foreground].astype(runValues.dtype.newbyteorder("<"))
+
+    runsHeader = {
+        "type": runValues.dtype.str,
+        "indexType": indexType.str,
+        "sizes": list(croppedData.shape),
+        "runs": len(runValues),
+        "labels": [label.item() for label in np.unique(runValues)],
+    }
+    for field in ["space", "space directions", "space origin"]:
+        if croppedHeader.get(field) is not None:
+            value = croppedHeader[field]
+            runsHeader[field] = value if isinstance(value, str) else np.asarray(value, dtype=float).tolist()
+    return b"".join([LABEL_RUNS_MAGIC, json.dumps(runsHeader).encode("ascii"), b"\n",
+                     runStarts.tobytes(), runLengths.tobytes(), runValues.tobytes()])
+
+
+def decodeLabelRuns(content):
+    """Decode a labelmap that was encoded by encodeLabelRuns.
+    :param content: bytes
+    :return: labelmap array of the bounding box in NRRD axis order, header dict (space, space directions,
+      space origin of the bounding box)
+    :raises ValueError: if the content is not in label runs format
+    """
+    if not content.startswith(LABEL_RUNS_MAGIC):
+        raise ValueError("Not a label runs file")
+    headerEnd = content.index(b"\n", len(LABEL_RUNS_MAGIC))
+    try:
+        runsHeader = json.loads(content[len(LABEL_RUNS_MAGIC):headerEnd])
+        dtype = np.dtype(runsHeader["type"])
+        indexType = np.dtype(runsHeader["indexType"])
+        sizes = [int(size) for size in runsHeader["sizes"]]
+        numberOfRuns = int(runsHeader["runs"])
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid label runs header: {e}")
+    offset = headerEnd + 1
+    runStarts = np.frombuffer(content, dtype=indexType, count=numberOfRuns, offset=offset).astype(np.int64)
+    offset += numberOfRuns * indexType.itemsize
+    runLengths = np.frombuffer(content, dtype=indexType, count=numberOfRuns, offset=offset).astype(np.int64)
+    offset += numberOfRuns * indexType.itemsize
+    runValues = np.frombuffer(content, dtype=dtype, count=numberOfRuns, offset=offset)
+
+    numberOfVoxels = int(np.prod(sizes))
+    if np.issubdtype(dtype, np.integer):
+        # Label value changes by +value at the start and by -value at the end of each run, the labelmap is the
+        # cumulative sum of the changes. Runs do not overlap and integer overflow wraps around, therefore the sum is
+        # exact in the voxel type and no larger temporary array is needed.
+        changes = np.zeros(numberOfVoxels + 1, dtype=dtype.newbyteorder("="))
+        changes[runStarts] += runValues
+        changes[runStarts + runLengths] -= runValues
+        np.cumsum(changes, out=changes)
+        data = changes[:numberOfVoxels].reshape(sizes, order="F")
+    else:
+        # Sums of floating point values are not exact, therefore the cumulative sum is computed for the run index
+        # (0 = background) and the label value of each voxel is looked up from that
+        runIndices = np.arange(1, numberOfRuns + 1)
+        changes = np.zeros(numberOfVoxels + 1, dtype=np.int64)
+        changes[runStarts] += runIndices
+        changes[runStarts + runLengths] -= runIndices
+        np.cumsum(changes, out=changes)
+        labelValues = np.concatenate(([0], runValues)).astype(dtype.newbyteorder("="))
+        data = labelValues[changes[:numberOfVoxels]].reshape(sizes, order="F")
+
+    header = {field: runsHeader[field] for field in ["space", "space directions", "space origin"] if field in runsHeader}
+    return data, header
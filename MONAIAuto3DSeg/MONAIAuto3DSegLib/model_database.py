@@ -85,6 +85,9 @@ class ModelDatabase:
                         "description": model["description"],
                         "sampleData": model.get("sampleData"),
                         "segmentNames": model.get("segmentNames"),
+                        "postProcessing": model.get("postProcessing"),
+                        "segmentationTimeSecGPU": model.get("segmentationTimeSecGPU"),
+                        "segmentationTimeSecCPU": model.get("segmentationTimeSecCPU"),
                         "details":
                             f"<p><b>Model:</b> {model['title']} (v{version})"
                             f"<p><b>Description:</b> {model['description']}\n"
@@ -145,6 +148,32 @@ class ModelDatabase:
             return path.parent
         raise RuntimeError(f"Model {modelName} path not found")
 
+    def modelConfig(self, modelName):
+        """ Get training configuration of the model (resample_resolution, roi_size, output_classes, ...).
+        The configuration is extracted from the model checkpoint the first time and then cached in a json file
+        in the model folder, so that it can be retrieved quickly and without requiring torch.
+        """
+        modelPath = self.modelPath(modelName)
+        configFile = modelPath.joinpath("model_config.json")
+        if configFile.exists():
+            with open(configFile) as f:
+                return json.load(f)
+        import torch
+        try:
+            # Memory-map the file to avoid reading all the weights into memory
+            checkpoint = torch.load(modelPath.joinpath("model.pt"), map_location="cpu", mmap=True)
+        except TypeError:
+            # mmap is not supported by PyTorch < 2.1
+            checkpoint = torch.load(modelPath.joinpath("model.pt"), map_location="cpu")
+        # Convert to json-compatible types, to return the same content as what is read from the file next time
+        config = json.loads(json.dumps(checkpoint["config"], default=str))
+        # Write to a temporary file first so that a partially written file is never read
+        temporaryConfigFile = configFile.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporaryConfigFile, "w", newline="\n") as f:
+            json.dump(config, f, indent=2)
+        os.replace(temporaryConfigFile, configFile)
+        return config
+
     def deleteAllModels(self):
         if self.modelsPath.exists():
             import shutil
@@ -0,0 +1,353 @@
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Encodings that can be read by both pynrrd and 3D Slicer's NRRD reader (teem/ITK).
+# "gzip" is written as a single gzip member that is compressed in parallel blocks (similarly to pigz),
+# therefore any gzip reader can decompress it.
+OUTPUT_ENCODINGS = ["raw", "gzip"]
+
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# Size of independently compressed blocks. Smaller blocks allow more parallelism, larger blocks give slightly
+# better compression ratio (the difference is negligible above a few hundred KB).
+DEFAULT_COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+NRRD_TYPES = {
+    np.dtype("int8"): "signed char",
+    np.dtype("uint8"): "unsigned char",
+    np.dtype("int16"): "short",
+    np.dtype("uint16"): "unsigned short",
+    np.dtype("int32"): "int",
+    np.dtype("uint32"): "unsigned int",
+    np.dtype("int64"): "long long",
+    np.dtype("uint64"): "unsigned long long",
+    np.dtype("float32"): "float",
+    np.dtype("float64"): "double",
+}
+
+# gzip member header: magic, deflate, no flags, no modification time, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def _formatVector(vector):
+    if vector is None or np.any(np.isnan(np.asarray(vector, dtype=float))):
+        return "none"
+    return "(" + ",".join(repr(float(value)) for value in vector) + ")"
+
+
+def formatNrrdHeader(data, header, encoding="raw"):
+    """Create NRRD header text for writing the data array with the geometry of the provided header.
+    :param data: numpy array in NRRD axis order (fastest axis first)
+    :param header: header dict, as returned by pynrrd (only space, space directions, space origin, and kinds are used)
+    :param encoding: one of OUTPUT_ENCODINGS
+    """
+    if encoding not in OUTPUT_ENCODINGS:
+        raise ValueError(f"Unsupported NRRD encoding: {encoding}. Supported encodings: {', '.join(OUTPUT_ENCODINGS)}")
+    try:
+        nrrdType = NRRD_TYPES[data.dtype.newbyteorder("=")]
+    except KeyError:
+        raise ValueError(f"Unsupported voxel type for NRRD writing: {data.dtype}")
+
+    lines = [
+        "NRRD0004",
+        "# Complete NRRD file format specification at:",
+        "# http://teem.sourceforge.net/nrrd/format.html",
+        f"type: {nrrdType}",
+        f"dimension: {data.ndim}",
+    ]
+    if header.get("space"):
+        lines.append(f"space: {header['space']}")
+    lines.append("sizes: " + " ".join(str(size) for size in data.shape))
+
+    spaceDirections = header.get("space directions")
+    if spaceDirections is not None:
+        spaceDirections = list(spaceDirections)
+        # Non-spatial axes (e.g., list of components) precede the spatial axes
+        spaceDirections = [None] * (data.ndim - len(spaceDirections)) + spaceDirections
+        lines.append("space directions: " + " ".join(_formatVector(direction) for direction in spaceDirections))
+        numberOfNonSpatialAxes = sum(1 for direction in spaceDirections if _formatVector(direction) == "none")
+        kinds = header.get("kinds")
+        if kinds is None or len(kinds) != data.ndim:
+            kinds = ["list"] * numberOfNonSpatialAxes + ["domain"] * (data.ndim - numberOfNonSpatialAxes)
+        lines.append("kinds: " + " ".join(kinds))
+
+    if data.dtype.itemsize > 1:
+        lines.append("endian: little")
+    lines.append(f"encoding: {encoding}")
+
+    spaceOrigin = header.get("space origin")
+    if spaceOrigin is not None:
+        lines.append(f"space origin: {_formatVector(spaceOrigin)}")
+
+    return "\n".join(lines) + "\n\n"
+
+
+def voxelBytes(data):
+    """Get voxels of a numpy array (in NRRD axis order) as a flat byte buffer, in the order they are stored in a NRRD file.
+    The array memory is referenced, not copied, if the array is Fortran-ordered.
+    """
+    # NRRD stores fastest axis first, which is Fortran order in numpy.
+    # Transposing a Fortran-ordered array gives a C-contiguous view of the same memory buffer.
+    # The view is flattened before casting, as memoryview cannot cast multidimensional views with zero size.
+    return memoryview(np.asfortranarray(data).T.reshape(-1)).cast("B")
+
+
+def compressGzipBlocks(buffer, compressionLevel=DEFAULT_COMPRESSION_LEVEL, numberOfThreads=None,
+                       blockSize=DEFAULT_COMPRESSION_BLOCK_SIZE):
+    """Compress a buffer into a single gzip member, using multiple threads.
+    Each block is compressed independently into a raw deflate stream that ends on a byte boundary (sync flush),
+    so the streams can be simply concatenated. zlib releases the GIL while compressing, therefore
+    threads run truly in parallel.
+    Yields chunks of compressed data.
+    """
+    view = memoryview(buffer)
+    view = view.cast("B") if view.nbytes else memoryview(b"")
+    blocks = [view[start:start + blockSize] for start in range(0, len(view), blockSize)] or [view]
+    lastBlockIndex = len(blocks) - 1
+
+    def compressBlock(blockIndex):
+        compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        flushMode = zlib.Z_FINISH if blockIndex == lastBlockIndex else zlib.Z_SYNC_FLUSH
+        return compressor.compress(blocks[blockIndex]) + compressor.flush(flushMode)
+
+    if numberOfThreads is None:
+        numberOfThreads = os.cpu_count() or 1
+
+    yield GZIP_HEADER
+    with ThreadPoolExecutor(max_workers=max(1, numberOfThreads)) as executor:
+        crcFuture = executor.submit(zlib.crc32, view)
+        for compressedBlock in executor.map(compressBlock, range(len(blocks))):
+            yield compressedBlock
+        crc = crcFuture.result()
+    yield struct.pack("<II", crc & 0xffffffff, len(view) & 0xffffffff)
+
+
+def writeNrrd(filename, data, header, encoding="raw", compressionLevel=DEFAULT_COMPRESSION_LEVEL,
+              numberOfThreads=None):
+    """Write numpy array (in NRRD axis order, fastest axis first) to NRRD file.
+    :param filename: output file path
+    :param data: numpy array
+    :param header: header dict as returned by pynrrd, geometry information is copied from here
+    :param encoding: one of OUTPUT_ENCODINGS
+    :param compressionLevel: compression level (1-9) for gzip encoding
+    :param numberOfThreads: number of threads for gzip compression (all CPU cores if None)
+    """
+    if data.dtype.itemsize > 1:
+        data = data.astype(data.dtype.newbyteorder("<"), copy=False)
+    headerText = formatNrrdHeader(data, header, encoding)
+    voxels = voxelBytes(data)
+    with open(filename, "wb") as f:
+        f.write(headerText.encode("ascii"))
+        if encoding == "raw":
+            f.write(voxels)
+        else:
+            for chunk in compressGzipBlocks(voxels, compressionLevel, numberOfThreads):
+                f.write(chunk)
+
+
+def parseNrrdHeader(data):
+    """Parse NRRD header from the beginning of a NRRD file (the data may contain only the first part of the file).
+    Only basic fields are interpreted: "sizes" (list of int), "space directions" (list of vectors, None for
+    non-spatial axes), and "spacings" (list of float); other fields are returned as strings.
+    :param data: bytes, starting with the NRRD magic
+    :return: header dict
+    :raises ValueError: if the data is not a valid NRRD header or the header is incomplete
+    """
+    if not data.startswith(b"NRRD000"):
+        raise ValueError("Not a NRRD file")
+    headerEnd = data.find(b"\n\n")
+    if headerEnd < 0:
+        headerEnd = data.find(b"\r\n\r\n")
+    if headerEnd < 0:
+        raise ValueError("NRRD header is incomplete")
+    header = {}
+    for line in data[:headerEnd].decode("ascii", errors="replace").splitlines()[1:]:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if ":" not in line:
+            raise ValueError(f"Invalid NRRD header line: {line}")
+        field, value = line.split(":", 1)
+        if value.startswith("="):
+            # key/value pair (key:=value), not a field
+            continue
+        header[field.strip()] = value.strip()
+    try:
+        if "sizes" in header:
+            header["sizes"] = [int(size) for size in header["sizes"].split()]
+        if "spacings" in header:
+            header["spacings"] = [float(spacing) for spacing in header["spacings"].split()]
+        if "space directions" in header:
+            spaceDirections = []
+            for direction in header["space directions"].split():
+                if direction == "none":
+                    spaceDirections.append(None)
+                else:
+                    spaceDirections.append([float(component) for component in direction.strip("()").split(",")])
+            header["space directions"] = spaceDirections
+    except ValueError as e:
+        raise ValueError(f"Invalid NRRD header: {e}")
+    if "sizes" not in header or "type" not in header:
+        raise ValueError("Required NRRD header fields (sizes, type) are missing")
+    return header
+
+
+def readNrrdHeader(filename, maximumHeaderSize=65536):
+    """Read and parse header of a NRRD file. See parseNrrdHeader."""
+    with open(filename, "rb") as f:
+        return parseNrrdHeader(f.read(maximumHeaderSize))
+
+
+def readNrrd(filename):
+    """Read a NRRD file with attached data in raw or gzip encoding (such as the files written by writeNrrd).
+    :return: numpy array in NRRD axis order (fastest axis first), header dict (see parseNrrdHeader) with
+      "space origin" as a list of floats
+    :raises ValueError: if the file is not a supported NRRD file
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    header = parseNrrdHeader(content[:65536])
+    headerEnd = content.find(b"\n\n")
+    dataStart = headerEnd + 2 if headerEnd >= 0 else content.find(b"\r\n\r\n") + 4
+    if "data file" in header or "datafile" in header:
+        raise ValueError("NRRD files with detached data are not supported")
+    nrrdTypeToDtype = {nrrdType: dtype for dtype, nrrdType in NRRD_TYPES.items()}
+    if header["type"] not in nrrdTypeToDtype:
+        raise ValueError(f"Unsupported NRRD voxel type: {header['type']}")
+    dtype = nrrdTypeToDtype[header["type"]].newbyteorder(">" if header.get("endian") == "big" else "<")
+    encoding = header.get("encoding", "raw")
+    if encoding == "raw":
+        voxelData = memoryview(content)[dataStart:]
+    elif encoding in ["gz", "gzip"]:
+        import gzip
+        voxelData = gzip.decompress(content[dataStart:])
+    else:
+        raise ValueError(f"Unsupported NRRD encoding: {encoding}")
+    numberOfVoxels = int(np.prod(header["sizes"]))
+    data = np.frombuffer(voxelData, dtype=dtype, count=numberOfVoxels).reshape(header["sizes"], order="F")
+    if "space origin" in header:
+        header["space origin"] = [float(component) for component in header["space origin"].strip("()").split(",")]
+    return data, header
+
+
+def nrrdVoxelSpacing(header):
+    """Get voxel spacing along the spatial axes from a header returned by parseNrrdHeader (None if not available)."""
+    if isinstance(header.get("space directions"), list):
+        return [float(np.linalg.norm(direction)) for direction in header["space directions"] if direction is not None]
+    if "spacings" in header:
+        return [spacing for spacing in header["spacings"] if not np.isnan(spacing)]
+    return None
+
+
+def nonZeroBoundingBox(data):
+    """Get bounding box of non-zero voxels as a list of (start, stop) index ranges, one for each axis.
+    Returns None if all voxels are zero.
+    """
+    ranges = []
+    for axis in range(data.ndim):
+        otherAxes = tuple(otherAxis for otherAxis in range(data.ndim) if otherAxis != axis)
+        nonZeroIndices = np.flatnonzero(np.any(data, axis=otherAxes))
+        if len(nonZeroIndices) == 0:
+            return None
+        ranges.append((int(nonZeroIndices[0]), int(nonZeroIndices[-1]) + 1))
+    return ranges
+
+
+def cropToNonZero(data, header):
+    """Crop data array (in NRRD axis order) to the bounding box of non-zero voxels.
+    Space origin is adjusted so that the cropped voxels remain at the exact same physical position,
+    in the voxel grid of the original image.
+    :return: cropped data array, updated header
+    """
+    boundingBox = nonZeroBoundingBox(data)
+    if boundingBox is None:
+        # Empty segmentation, keep a single voxel to have a valid image
+        boundingBox = [(0, 1)] * data.ndim
+    croppedData = data[tuple(slice(start, stop) for start, stop in boundingBox)]
+
+    croppedHeader = dict(header)
+    spaceOrigin = header.get("space origin")
+    spaceDirections = header.get("space directions")
+    if spaceOrigin is not None and spaceDirections is not None:
+        startIndex = np.array([start for start, stop in boundingBox], dtype=float)
+        croppedHeader["space origin"] = np.asarray(spaceOrigin, dtype=float) + startIndex @ np.asarray(spaceDirections, dtype=float)
+    return croppedData, croppedHeader
+
+
+def parseImageGeometry(geometry):
+    """Validate and convert a voxel grid description, for example received as JSON from a client.
+    :param geometry: dict (or JSON string) with "sizes" (number of voxels along the three axes), "space directions"
+      (one vector for each axis, length is the voxel spacing), "space origin" (position of the first voxel center),
+      and optionally "space" (default: "left-posterior-superior").
+    :return: geometry dict, directions and origin as numpy arrays
+    :raises ValueError: if the geometry is invalid
+    """
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    try:
+        sizes = [int(size) for size in geometry["sizes"]]
+        spaceDirections = np.asarray(geometry["space directions"], dtype=float)
+        spaceOrigin = np.asarray(geometry["space origin"], dtype=float)
+        space = str(geometry.get("space", "left-posterior-superior"))
+    except (TypeError, KeyError, AttributeError, ValueError) as e:
+        raise ValueError(f"Invalid image geometry: {e}")
+    if len(sizes) != 3 or min(sizes) < 1 or spaceDirections.shape != (3, 3) or spaceOrigin.shape != (3,):
+        raise ValueError("Invalid image geometry: three sizes, 3x3 space directions, and 3 origin coordinates are required")
+    if not np.all(np.isfinite(spaceDirections)) or not np.all(np.isfinite(spaceOrigin)) or abs(np.linalg.det(spaceDirections)) < 1e-12:
+        raise ValueError("Invalid image geometry: space directions and origin must be finite and non-degenerate")
+    return {"space": space, "sizes": sizes, "space directions": spaceDirections, "space origin": spaceOrigin}
+
+
+def _ijkToSpace(spaceDirections, spaceOrigin):
+    """Get homogeneous transformation matrix from voxel indices to physical coordinates."""
+    ijkToSpace = np.eye(4)
+    ijkToSpace[:3, :3] = np.asarray(spaceDirections, dtype=float).T
+    ijkToSpace[:3, 3] = np.asarray(spaceOrigin, dtype=float)
+    return ijkToSpace
+
+
+def resampleLabels(data, header, geometry):
+    """Resample a label image to a different voxel grid using nearest neighbor interpolation.
+    Used for returning segmentations in the voxel grid of the original image when a downsampled image was segmented.
+    Voxels outside the source image are set to 0.
+    :param data: label image array in NRRD axis order (three spatial axes)
+    :param header: header dict (as returned by pynrrd) describing the voxel grid of data
+    :param geometry: target voxel grid, see parseImageGeometry
+    :return: resampled data array, updated header
+    """
+    geometry = parseImageGeometry(geometry)
+    if header.get("space") and header["space"] != geometry["space"]:
+        raise ValueError(f"Image geometry space ({geometry['space']}) does not match the image space ({header['space']})")
+    targetToSource = np.linalg.inv(_ijkToSpace(header["space directions"], header["space origin"])) @ _ijkToSpace(
+        geometry["space directions"], geometry["space origin"])
+    matrix, offset = targetToSource[:3, :3], targetToSource[:3, 3]
+    sizes = geometry["sizes"]
+
+    if np.allclose(matrix, np.diag(np.diag(matrix)), atol=1e-4):
+        # Voxel grid axes are parallel (typical for downsampled images): source indices can be computed separately
+        # for each axis, which is much faster than computing them for each voxel
+        axisIndices = []
+        outsideIndices = []
+        for axis in range(3):
+            sourceIndices = np.floor(matrix[axis, axis] * np.arange(sizes[axis]) + offset[axis] + 0.5).astype(np.int64)
+            outsideIndices.append((sourceIndices < 0) | (sourceIndices >= data.shape[axis]))
+            axisIndices.append(np.clip(sourceIndices, 0, data.shape[axis] - 1))
+        resampledData = data[np.ix_(*axisIndices)]
+        for axis in range(3):
+            resampledData[(slice(None),) * axis + (outsideIndices[axis],)] = 0
+    else:
+        from scipy import ndimage
+        # "grid-constant" mode: voxels that are within half voxel from the edge are still inside the image
+        resampledData = ndimage.affine_transform(data, matrix=matrix, offset=offset, output_shape=tuple(sizes),
+                                                 order=0, mode="grid-constant", cval=0)
+
+    resampledHeader = dict(header)
+    resampledHeader["space directions"] = geometry["space directions"]
+    resampledHeader["space origin"] = geometry["space origin"]
+    return resampledData, resampledHeader
@@ -0,0 +1,117 @@
+import math
+
+import numpy as np
+
+
+def applyPostProcessing(labelmap, steps, voxelVolumeMm3=1.0, stepCompletedCallback=None):
+    """Apply post-processing steps on a label map, in place.
+
+    Steps are specified in Models.json ("postProcessing" list of the model). Each step is a dict with an "operation"
+    and optional operation parameters. All operations accept an optional "labels" list (all labels are processed
+    by default). Connected component operations accept "connectivity" (1, 2, or 3 - number of dimensions in which
+    neighbors are considered connected, 3 by default, i.e., 26-connectivity).
+
+    Supported operations:
+    - keepLargestComponents: keep only the "numberOfComponents" (default: 1) largest connected components of each label
+    - removeIslands: remove connected components that are smaller than "minimumSizeMm3"
+    - fillHoles: fill background regions that are fully enclosed by a label
+
+    Connected components are computed using compiled labelling (scipy.ndimage), only within the bounding box
+    of each label, therefore the cost is proportional to the size of the structures and not the image size.
+
+    :param labelmap: numpy array of label values, it is modified in place
+    :param steps: list of post-processing step descriptions
+    :param voxelVolumeMm3: volume of a voxel, used for converting physical size thresholds to number of voxels
+    :param stepCompletedCallback: function that is called with the operation name after each step is completed
+    :return: the processed labelmap
+    """
+    for step in steps or []:
+        operation = step["operation"]
+        try:
+            operationFunction = POSTPROCESSING_OPERATIONS[operation]
+        except KeyError:
+            raise ValueError(f"Unsupported post-processing operation: {operation}. "
+                             f"Supported operations: {', '.join(POSTPROCESSING_OPERATIONS.keys())}")
+        operationFunction(labelmap, step, voxelVolumeMm3)
+        if stepCompletedCallback:
+            stepCompletedCallback(operation)
+    return labelmap
+
+
+def _structure(step, ndim):
+    from scipy import ndimage
+    return ndimage.generate_binary_structure(ndim, step.get("connectivity", ndim))
+
+
+def _labelBoundingBoxes(labelmap, labels=None):
+    """Get list of (label, bounding box) for all labels (or the specified labels) that are present in the labelmap.
+    Bounding boxes are computed for all labels in a single pass.
+    """
+    from scipy import ndimage
+    boundingBoxes = ndimage.find_objects(labelmap)
+    labelBoundingBoxes = []
+    for labelIndex, boundingBox in enumerate(boundingBoxes):
+        label = labelIndex + 1
+        if boundingBox is None:
+            # label is not present
+            continue
+        if labels is not None and label not in labels:
+            continue
+        labelBoundingBoxes.append((label, boundingBox))
+    return labelBoundingBoxes
+
+
+def _connectedComponents(mask, structure):
+    """Returns connected component label image and voxel count of each component (index 0 is background)"""
+    from scipy import ndimage
+    components, numberOfComponents = ndimage.label(mask, structure)
+    componentSizes = np.bincount(components.ravel(), minlength=numberOfComponents + 1)
+    componentSizes[0] = 0
+    return components, componentSizes
+
+
+def _keepLargestComponents(labelmap, step, voxelVolumeMm3):
+    numberOfComponentsToKeep = step.get("numberOfComponents", 1)
+    structure = _structure(step, labelmap.ndim)
+    for label, boundingBox in _labelBoundingBoxes(labelmap, step.get("labels")):
+        region = labelmap[boundingBox]  # view, modifying it changes the labelmap
+        mask = region == label
+        components, componentSizes = _connectedComponents(mask, structure)
+        if len(componentSizes) - 1 <= numberOfComponentsToKeep:
+            continue
+        keepComponent = np.zeros(len(componentSizes), dtype=bool)
+        keepComponent[np.argsort(componentSizes)[::-1][:numberOfComponentsToKeep]] = True
+        keepComponent[0] = False
+        region[mask & ~keepComponent[components]] = 0
+
+
+def _removeIslands(labelmap, step, voxelVolumeMm3):
+    minimumSizeVoxels = math.ceil(step["minimumSizeMm3"] / voxelVolumeMm3)
+    structure = _structure(step, labelmap.ndim)
+    for label, boundingBox in _labelBoundingBoxes(labelmap, step.get("labels")):
+        region = labelmap[boundingBox]
+        mask = region == label
+        components, componentSizes = _connectedComponents(mask, structure)
+        removeComponent = componentSizes < minimumSizeVoxels
+        removeComponent[0] = False
+        if np.any(removeComponent):
+            region[removeComponent[components]] = 0
+
+
+def _fillHoles(labelmap, step, voxelVolumeMm3):
+    from scipy import ndimage
+    for label, boundingBox in _labelBoundingBoxes(labelmap, step.get("labels")):
+        # A hole cannot reach the boundary of the tight bounding box of the label, so it is enough to fill the holes
+        # within the bounding box.
+        region = labelmap[boundingBox]
+        mask = region == label
+        filled = ndimage.binary_fill_holes(mask)
+        # Only fill background voxels (do not overwrite other structures that are enclosed by this label)
+        region[filled & (region == 0)] = label
+
+
+POSTPROCESSING_OPERATIONS = {
+    "keepLargestComponents": _keepLargestComponents,
+    "removeIslands": _removeIslands,
+    "fillHoles": _fillHoles,
+}
@@ -0,0 +1,164 @@
+import numpy as np
+
+
+# Data types for storing probabilities. uint8 stores probabilities quantized to 1/255 steps.
+PROBABILITIES_DTYPES = ["uint8", "float16"]
+
+PROBABILITIES_FILE_EXTENSION = ".npz"
+
+UINT8_SCALE = 255.0
+
+
+def saveProbabilities(filename, probabilities, labels, cropStart, modelAffine, originalAffine, header,
+                      sigmoid=False, labelMerge=None):
+    """Save per-class probabilities that were computed by the model, for re-labelling without re-running inference.
+
+    Probabilities are stored in the voxel grid of the model (typically much lower resolution than the input),
+    cropped to the region around the segmented structures, and only for the classes that are present.
+
+    :param filename: output file path (.npz)
+    :param probabilities: numpy array of shape (classes, i, j, k), uint8 (0-255) or float16
+    :param labels: label value of each stored class (for softmax models the first one must be 0, the background),
+      or the channel index for sigmoid models
+    :param cropStart: index of the first stored voxel in the model voxel grid
+    :param modelAffine: 4x4 matrix, mapping model voxel index to physical (RAS) coordinates
+    :param originalAffine: 4x4 matrix, mapping input image voxel index to physical (RAS) coordinates
+    :param header: NRRD header of the input image (pynrrd dict), the result label map is written in this geometry
+    :param sigmoid: True if classes are independent (sigmoid), False if they are mutually exclusive (softmax)
+    :param labelMerge: name of the method to merge independent classes into a label map ("brats" or None)
+    """
+    if probabilities.dtype.name not in PROBABILITIES_DTYPES:
+        raise ValueError(f"Unsupported probabilities data type: {probabilities.dtype}")
+    np.savez(filename,
+             probabilities=probabilities,
+             labels=np.asarray(labels, dtype=np.int32),
+             cropStart=np.asarray(cropStart, dtype=np.int64),
+             modelAffine=np.asarray(modelAffine, dtype=float),
+             originalAffine=np.asarray(originalAffine, dtype=float),
+             outputShape=np.asarray(header["sizes"], dtype=np.int64),
+             space=np.asarray(header.get("space", "")),
+             spaceDirections=np.asarray(header["space directions"], dtype=float),
+             spaceOrigin=np.asarray(header["space origin"], dtype=float),
+             sigmoid=np.asarray(sigmoid),
+             labelMerge=np.asarray(labelMerge or ""))
+
+
+def loadProbabilities(filename):
+    """Load probabilities file saved by saveProbabilities into a dict"""
+    with np.load(filename) as data:
+        probabilitiesData = {key: data[key] for key in data.files}
+    probabilitiesData["sigmoid"] = bool(probabilitiesData["sigmoid"])
+    probabilitiesData["space"] = str(probabilitiesData["space"])
+    probabilitiesData["labelMerge"] = str(probabilitiesData["labelMerge"])
+    return probabilitiesData
+
+
+def _probabilityValue(probabilities, probability):
+    """Convert probability (0.0-1.0) to the unit in which the probabilities are stored"""
+    return probability * UINT8_SCALE if probabilities.dtype == np.uint8 else probability
+
+
+def _labelsFromProbabilities(probabilitiesData, threshold):
+    probabilities = probabilitiesData["probabilities"]
+    labels = probabilitiesData["labels"]
+    if probabilitiesData["sigmoid"]:
+        channels = probabilities >= _probabilityValue(probabilities, 0.5 if threshold is None else threshold)
+        labelMap = np.zeros(probabilities.shape[1:], dtype=np.uint8)
+        if probabilitiesData["labelMerge"] == "brats":
+            # Same as in the inference script: enhancing tumour (ET), tumour core (TC), whole tumour (WT)
+            labelMap[channels.any(0)] = 2
+            labelMap[channels[1:].any(0)] = 1
+            labelMap[channels[2:].any(0)] = 3
+        else:
+            labelMap[channels[0]] = 1
+        return labelMap
+    if threshold is None:
+        return labels[np.argmax(probabilities, axis=0)].astype(np.uint8)
+    if len(labels) == 1:
+        # Only the background is stored (nothing was segmented)
+        return np.zeros(probabilities.shape[1:], dtype=np.uint8)
+    # Assign the most probable foreground class if its probability is above the threshold
+    foregroundProbabilities = probabilities[1:]
+    mostProbableForeground = np.argmax(foregroundProbabilities, axis=0)
+    maximumProbability = np.take_along_axis(foregroundProbabilities, mostProbableForeground[np.newaxis], axis=0)[0]
+    foregroundLabels = labels[1:].astype(np.uint8)
+    return np.where(maximumProbability >= _probabilityValue(probabilities, threshold),
+                    foregroundLabels[mostProbableForeground], 0).astype(np.uint8)
+
+
+def _outputGridBoundingBox(modelGridShape, probabilitiesData):
+    """Get the region of the input image voxel grid that the (cropped) model voxel grid covers, as a list of
+    (start, stop) index ranges, one for each axis. Returns None if the regions do not overlap.
+    """
+    modelToOutput = np.linalg.inv(probabilitiesData["originalAffine"]) @ probabilitiesData["modelAffine"]
+    # Corners of the model grid region, with one voxel margin to include all voxels that interpolation may reach
+    cropStart = np.asarray(probabilitiesData["cropStart"], dtype=float)
+    cornerRanges = [(start - 1.0, start + size) for start, size in zip(cropStart, modelGridShape)]
+    corners = np.array([[i, j, k, 1.0] for i in cornerRanges[0] for j in cornerRanges[1] for k in cornerRanges[2]])
+    outputCorners = (corners @ modelToOutput.T)[:, :3]
+    outputShape = probabilitiesData["outputShape"]
+    boundingBox = []
+    for axis in range(3):
+        start = max(0, int(np.floor(outputCorners[:, axis].min())) - 1)
+        stop = min(int(outputShape[axis]), int(np.ceil(outputCorners[:, axis].max())) + 2)
+        if start >= stop:
+            return None
+        boundingBox.append((start, stop))
+    return boundingBox
+
+
+def _resampleToOutputGrid(modelGridImage, probabilitiesData, order):
+    """Resample image from the (cropped) model voxel grid to the voxel grid of the input image.
+    Only the region that the model grid covers is resampled, the rest of the output is set to 0.
+    """
+    from scipy import ndimage
+    outputImage = np.zeros(tuple(probabilitiesData["outputShape"]), dtype=modelGridImage.dtype)
+    boundingBox = _outputGridBoundingBox(modelGridImage.shape, probabilitiesData)
+    if boundingBox is None:
+        return outputImage
+    outputToModel = np.linalg.inv(probabilitiesData["modelAffine"]) @ probabilitiesData["originalAffine"]
+    boundingBoxStart = np.array([start for start, stop in boundingBox], dtype=float)
+    outputImage[tuple(slice(start, stop) for start, stop in boundingBox)] = ndimage.affine_transform(
+        modelGridImage,
+        matrix=outputToModel[:3, :3],
+        offset=outputToModel[:3, :3] @ boundingBoxStart + outputToModel[:3, 3] - probabilitiesData["cropStart"],
+        output_shape=tuple(stop - start for start, stop in boundingBox),
+        order=order, mode="constant", cval=0)
+    return outputImage
+
+
+def relabel(probabilitiesData, threshold=None, postProcessing=None, computeConfidence=False, stepCompletedCallback=None):
+    """Compute label map from saved probabilities.
+
+    :param probabilitiesData: dict returned by loadProbabilities
+    :param threshold: minimum probability (0.0-1.0) of a foreground class. If None then the most probable class is
+      chosen (same as the result of inference).
+    :param postProcessing: list of post-processing steps (see MONAIAuto3DSegLib.postprocessing), applied in the model
+      voxel grid, before resampling to the input image geometry
+    :param computeConfidence: compute the probability of the chosen class in each voxel (as uint8, 255 = 1.0)
+    :param stepCompletedCallback: called with the operation name after each post-processing step is completed
+    :return: label map, NRRD header (pynrrd dict), confidence map (None if computeConfidence is False)
+    """
+    labelMap = _labelsFromProbabilities(probabilitiesData, threshold)
+
+    if postProcessing:
+        from MONAIAuto3DSegLib.postprocessing import applyPostProcessing
+        voxelVolumeMm3 = abs(np.linalg.det(probabilitiesData["modelAffine"][:3, :3]))
+        applyPostProcessing(labelMap, postProcessing, voxelVolumeMm3, stepCompletedCallback)
+
+    header = {
+        "space": probabilitiesData["space"],
+        "space directions": probabilitiesData["spaceDirections"],
+        "space origin": probabilitiesData["spaceOrigin"],
+    }
+    outputLabelMap = _resampleToOutputGrid(labelMap, probabilitiesData, order=0)
+
+    confidence = None
+    if computeConfidence:
+        probabilities = probabilitiesData["probabilities"]
+        maximumProbability = probabilities.max(axis=0)
+        if probabilities.dtype != np.uint8:
+            maximumProbability = np.round(maximumProbability.astype(np.float32) * UINT8_SCALE).astype(np.uint8)
+        confidence = _resampleToOutputGrid(maximumProbability, probabilitiesData, order=1)
+
+    return outputLabelMap, header, confidence
@@ -2,6 +2,7 @@ import subprocess
 
 import slicer
 
+import json
 import sys
 import logging
 import queue
@@ -15,6 +16,15 @@ from dataclasses import dataclass, field
 
 from enum import Enum
 
+@dataclass
+class JobProgress:
+    """ Status of a segmentation job that is processed on a server """
+    status: str = ""  # queued, running, succeeded, failed, cancelled
+    stage: str = ""  # processing stage (see MONAIAuto3DSegLib.progress)
+    progress: float = 0.0  # fraction of the processing that is completed (0.0-1.0)
+    queuePosition: int = None  # number of jobs ahead in the queue (only for queued jobs)
+    eta: float = None  # estimated remaining time in seconds, including waiting in the queue
+
 @dataclass
 class SegmentationTaskInfo:
     tempDir: str = ""
@@ -23,6 +33,13 @@ class SegmentationTaskInfo:
     segmentationTaskListInfo = None
     sequenceItemIndex: int = 0
     resultsImported: bool = False
+    probabilitiesFile: str = ""
+    jobProgress: JobProgress = None  # last status update of remote processing
+    traceSpan: Any = None  # span that records processing of this item (see MONAIAuto3DSegLib.tracing), None if not traced
+    inferenceCommand: list = None  # command line of local inference, set when the input of the item is written
+    additionalEnvironmentVariables: dict = None  # environment variables of local inference
+    processingStarted: bool = False
+    processingEnded: bool = False
 
 class EventCode(Enum):
     TASKLIST_PROCESSING_STARTED = 1
@@ -31,10 +48,12 @@ class EventCode(Enum):
     TASK_IMPORTING_RESULTS_STARTED = 4
     TASK_IMPORTING_RESULTS_ENDED = 5
     TASKLIST_PROCESSING_ENDED = 6
+    TASK_PROGRESS_UPDATED = 7
 
 class ExitCode(Enum):
     USER_CANCELLED = 1001
     DID_NOT_RUN = 1002
+    REMOTE_PROCESSING_FAILED = 1003
 
 @dataclass
 class SegmentationTaskListInfo:
@@ -45,6 +64,8 @@ class SegmentationTaskListInfo:
     waitForCompletion: bool = False
     sequenceBrowserNode: slicer.vtkMRMLSequenceBrowserNode = None
     segmentationTasks: list = field(default_factory=list) # list of SegmentationTaskInfo objects, one for each sequence item
+    remoteSequenceInference: Any = None  # processes all sequence items in a single server job (see RemoteSequenceInference)
+    pipelineUpdateInProgress: bool = False  # sequence items are being started (see MONAIAuto3DSegLogic._updateSequencePipeline)
     eventCallback: Callable = None
     customEventCallbackData: Any = None
 
@@ -146,8 +167,7 @@ class BackgroundProcess:
                 self.completedCallback(self.taskInfo)
                 return
 
-        psProcess = self.getPSProcess(self.proc.pid)
-        if psProcess and psProcess.is_running(): # No more outputs to process now, check again later
+        if self.isRunning(): # No more outputs to process now, check again later
             qt.QTimer.singleShot(self.CHECK_TIMER_INTERVAL, self.checkProcessOutput)
         else:
             self.cleanup()
@@ -259,3 +279,608 @@ class LocalInference(BackgroundProcess):
         if retcode != 0:
             from subprocess import CalledProcessError
             raise CalledProcessError(proc.returncode, proc.args, output=proc.stdout, stderr=proc.stderr)
+
+
+class RemoteInference(BackgroundProcess):
+    """ Running inference on a remote server until finished or cancelled.
+
+        The job is submitted to the server, then its status is polled until it is completed and finally the result
+        is downloaded. Network communication is performed in a background thread, therefore the application
+        remains responsive.
+    """
+
+    # Time between job status requests (in seconds), if the server does not send status updates
+    POLL_INTERVAL = 1.0
+
+    # Maximum time (in seconds) without receiving a job status update before the connection is considered lost
+    EVENT_STREAM_TIMEOUT = 30.0
+
+    # Size of the chunks of resumable uploads (in bytes, before compression). If the connection is lost,
+    # at most this much data has to be sent again.
+    RESUMABLE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+    # Maximum number of input files that are hashed or uploaded at the same time (e.g., frames of a sequence)
+    MAXIMUM_CONCURRENT_UPLOADS = 4
+
+    def __init__(self,
+                 server,
+                 taskInfo: SegmentationTaskInfo = None,
+                 logCallback: Callable = None,
+                 completedCallback: Callable = None,
+                 progressCallback: Callable = None):
+        """
+        :param server: ServerPool, ServerClient, or server address. Using the same object for multiple jobs allows
+          reusing connections. If a ServerPool is specified then the job is sent to the least loaded server, and if
+          that server becomes unavailable then the job is sent to another server.
+        :param progressCallback: called with taskInfo and a JobProgress object when the status of the job on the
+          server changes (in the main thread)
+        """
+        super().__init__(taskInfo, logCallback, completedCallback)
+        self.progressCallback = progressCallback
+        from MONAIAuto3DSegLib.server_client import ServerClient, ServerPool
+        if isinstance(server, str):
+            server = ServerClient(server)
+        self.serverPool = server if isinstance(server, ServerPool) else None
+        # Server that processes the job
+        self.serverClient = self.serverPool.preferredClient() if self.serverPool else server
+        self.serverAddress = self.serverClient.serverAddress
+        self.jobId = None
+        self.jobInfo = None  # last job status information received from the server
+        self._statusMessage = None  # last logged job status
+        # If specified, the server resamples the segmentation to this voxel grid (see nrrd_io.parseImageGeometry)
+        self.outputGeometry = None
+        self._cancelRequested = threading.Event()
+
+    def run(self, modelName, inputFiles, outputFile, waitForCompletion=True, outputGeometry=None):
+        """ Process the inputs on the server and save the segmentation result to outputFile.
+        :param inputFiles: list of input files, either file paths or in-memory files (see MONAIAuto3DSegLib.upload)
+        """
+        from MONAIAuto3DSegLib.upload import UploadFile
+        inputFiles = [UploadFile(inputFile) if isinstance(inputFile, (str, Path)) else inputFile for inputFile in inputFiles]
+        self.outputGeometry = outputGeometry
+        self._start((modelName, inputFiles, outputFile), waitForCompletion)
+
+    def _start(self, jobArguments, waitForCompletion):
+        """ Process the job (see _processJob) in this thread or in a background thread. """
+        if waitForCompletion:
+            self._processJob(*jobArguments)
+            self._logQueuedOutput()
+            self.completedCallback(self.taskInfo)
+        else:
+            self.procThread = threading.Thread(target=self._processJob, args=jobArguments)
+            self.procThread.start()
+            self.checkProcessOutput()
+
+    def isRunning(self):
+        return self.procThread is not None and self.procThread.is_alive()
+
+    def stop(self):
+        self._cancelRequested.set()
+        self._setProcReturnCode(ExitCode.USER_CANCELLED)
+
+    def handleSubProcessLogging(self, text):
+        if isinstance(text, JobProgress):
+            # Progress updates are passed through the output queue, so that the callback is called in the main thread
+            if self.progressCallback:
+                self.progressCallback(self.taskInfo, text)
+            return
+        self.addLog(text)
+        logging.info(text)
+
+    def _logQueuedOutput(self):
+        while True:
+            try:
+                self.handleSubProcessLogging(self.procOutputQueue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _processJob(self, modelName, inputFiles, outputFile):
+        import requests
+        from MONAIAuto3DSegLib.tracing import activateSpan
+        unavailableClients = []
+        try:
+            # Requests and spans of the job are recorded in the trace of the segmentation task
+            with activateSpan(self.taskInfo.traceSpan if self.taskInfo else None):
+                while True:
+                    if self.serverPool:
+                        self.serverClient = self.serverPool.selectClient(unavailableClients)
+                        self.serverAddress = self.serverClient.serverAddress
+                    try:
+                        completed = self._processJobOnServer(modelName, inputFiles, outputFile)
+                        break
+                    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                        if not self.serverPool:
+                            raise
+                        # Server stopped responding (even after retries), process the job on another server
+                        self.serverPool.markUnavailable(self.serverClient)
+                        unavailableClients.append(self.serverClient)
+                        self.procOutputQueue.put(f"Server {self.serverAddress} is not available ({e}), trying another server")
+            if completed:
+                self._setProcReturnCode(0)
+        except Exception as e:
+            self.procOutputQueue.put(f"Remote processing failed: {e}")
+            self._setProcReturnCode(ExitCode.REMOTE_PROCESSING_FAILED)
+        finally:
+            # Statistics of all requests sent by this client (including previous jobs, such as other sequence items)
+            self.procOutputQueue.put(self.serverClient.latencySummary())
+
+    def _processJobOnServer(self, modelName, inputFiles, outputFile):
+        """ Submit the job to the current server, wait for completion, and download the result.
+        Returns False if processing was cancelled.
+        """
+        self.jobId = None
+        self.jobInfo = None
+        self._statusMessage = None
+        from MONAIAuto3DSegLib.tracing import childSpan
+        with childSpan("upload input", server=self.serverAddress):
+            self._submitJob(modelName, inputFiles)
+        with childSpan("wait for job", job=self.jobId):
+            completed = self._waitForJobCompletion()
+        if not completed:
+            # cancelled
+            self.serverClient.delete(f"/jobs/{self.jobId}").close()
+            self.procOutputQueue.put("Processing on the server was cancelled")
+            return False
+        if self.jobInfo["status"] != "succeeded":
+            raise RuntimeError(f"Processing on the server {self.jobInfo['status']}: {self.jobInfo.get('error', '')}")
+        with childSpan("download result"):
+            self._downloadResult(outputFile)
+        # Result is downloaded, it can be removed from the server
+        self.serverClient.delete(f"/jobs/{self.jobId}").close()
+        return True
+
+    @staticmethod
+    def _inputFieldName(inputIndex):
+        """ Name of the request field of the input file (inputIndex starts from 0). """
+        return "image_file" if inputIndex == 0 else f"image_file_{inputIndex + 1}"
+
+    def _jobParameters(self, modelName):
+        """ Query parameters of the job submission request. """
+        params = {"model_name": modelName}
+        if self.outputGeometry:
+            params["output_geometry"] = json.dumps(self.outputGeometry)
+        return params
+
+    def _submitJob(self, modelName, inputFiles):
+        inputReferences = self._uploadInputBlobs(inputFiles)
+        if inputReferences is not None:
+            # Input files are already on the server, only references are sent
+            r = self.serverClient.post("/jobs", params=self._jobParameters(modelName), json=inputReferences)
+            if r.status_code == 409:
+                # Blobs have been removed from the server since the upload, upload them again
+                r.close()
+                inputReferences = self._uploadInputBlobs(inputFiles)
+                r = self.serverClient.post("/jobs", params=self._jobParameters(modelName), json=inputReferences)
+            with r:
+                self._raiseForStatus(r)
+                self.jobInfo = r.json()
+                self.jobId = self.jobInfo["id"]
+            return
+
+        # Server does not store input files, send them in the request
+        from MONAIAuto3DSegLib.upload import MultipartFormData
+        body = MultipartFormData({self._inputFieldName(inputIndex): inputFile for inputIndex, inputFile in enumerate(inputFiles)},
+                                 progress=self._uploadProgress(inputFiles))
+        self.procOutputQueue.put(f"Uploading input to {self.serverAddress}")
+        with self.serverClient.post("/jobs", params=self._jobParameters(modelName), data=body,
+                           headers={"Content-Type": body.contentType}) as r:
+            self._raiseForStatus(r)
+            self.jobInfo = r.json()
+            self.jobId = self.jobInfo["id"]
+
+    def _uploadProgress(self, inputFiles):
+        """ Get object that logs progress of uploading the input files. """
+        from MONAIAuto3DSegLib.upload import TransferProgress
+        return TransferProgress(sum(inputFile.size for inputFile in inputFiles), self.procOutputQueue.put, "Uploading input")
+
+    def _uploadInputBlobs(self, inputFiles):
+        """ Upload input files that are not yet available on the server (identified by their content hash).
+        Multiple inputs are hashed and uploaded concurrently.
+        Returns references to the uploaded files that can be used in the job request, None if the server does not store
+        input files.
+        """
+        blobHashes = self._uploadBlobs(inputFiles)
+        if blobHashes is None:
+            return None
+        return self._inputReferences(inputFiles, blobHashes)
+
+    def _inputReferences(self, inputFiles, blobHashes):
+        """ Get references to uploaded input files (of a single image) that can be used in the job request. """
+        return {self._inputFieldName(inputIndex): {"blob": blobHash, "filename": inputFile.filename}
+                for inputIndex, (inputFile, blobHash) in enumerate(zip(inputFiles, blobHashes))}
+
+    def _uploadBlobs(self, inputFiles):
+        """ Upload the files that are not yet available on the server, see _uploadInputBlobs.
+        Returns the content hashes of the files, None if the server does not store input files.
+        """
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(len(inputFiles), self.MAXIMUM_CONCURRENT_UPLOADS)) as executor:
+            blobHashes = list(executor.map(lambda inputFile: inputFile.sha256(), inputFiles))
+        with self.serverClient.post("/blobs/missing", json={"blobs": blobHashes}, retry=True) as r:
+            if r.status_code == 404:
+                return None
+            self._raiseForStatus(r)
+            missingBlobs = set(r.json()["missingBlobs"])
+        missingInputFiles = {blobHash: inputFile for inputFile, blobHash in zip(inputFiles, blobHashes) if blobHash in missingBlobs}
+        if len(missingInputFiles) < len(set(blobHashes)):
+            self.procOutputQueue.put(f"Input is already available on {self.serverAddress}, not uploading it again")
+        if missingInputFiles:
+            from MONAIAuto3DSegLib.compression import selectContentEncoding
+            capabilities = self._serverCapabilities()
+            contentEncoding = selectContentEncoding(capabilities.get("contentEncodings", []))
+            uploadInputBlob = self._uploadInputBlobResumable if capabilities.get("resumableUploads") else self._uploadInputBlob
+            compressionInfo = f" ({contentEncoding} compressed)" if contentEncoding else ""
+            self.procOutputQueue.put(f"Uploading input to {self.serverAddress}{compressionInfo}")
+            progress = self._uploadProgress(missingInputFiles.values())
+            with ThreadPoolExecutor(max_workers=min(len(missingInputFiles), self.MAXIMUM_CONCURRENT_UPLOADS)) as executor:
+                # Upload requests are sent in the trace context of this thread
+                uploads = [executor.submit(contextvars.copy_context().run, uploadInputBlob, blobHash, inputFile, contentEncoding, progress)
+                           for blobHash, inputFile in missingInputFiles.items()]
+                for upload in uploads:
+                    upload.result()
+        return blobHashes
+
+    def _uploadInputBlob(self, blobHash, inputFile, contentEncoding, progress):
+        """ Upload a single input file. The file is read, compressed, and sent in chunks, therefore it is never fully
+        loaded into memory.
+        """
+        from MONAIAuto3DSegLib.compression import compressChunks
+        headers = {"Content-Type": "application/octet-stream"}
+        data = progress.trackChunks(inputFile.chunks())
+        if contentEncoding:
+            headers["Content-Encoding"] = contentEncoding
+            data = compressChunks(data, contentEncoding)
+        with self.serverClient.put(f"/blobs/{blobHash}", data=data, headers=headers) as r:
+            self._raiseForStatus(r)
+
+    def _uploadInputBlobResumable(self, blobHash, inputFile, contentEncoding, progress):
+        """ Upload a single input file in chunks. If the connection is lost then the upload is continued
+        from the last chunk that the server has received, instead of sending the whole file again.
+        Progress is only updated with the data that the server has confirmed.
+        """
+        import requests
+        from MONAIAuto3DSegLib.compression import compressChunks
+        with self.serverClient.post("/uploads", json={"blob": blobHash, "size": inputFile.size}, retry=True) as r:
+            self._raiseForStatus(r)
+            upload = r.json()
+        if upload["complete"]:
+            # the same file has been uploaded since the list of missing blobs was queried
+            progress.update(inputFile.size)
+            return
+        uploadId = upload["upload"]
+        offset = upload["offset"]  # number of bytes received by the server, None if unknown
+        confirmedOffset = 0
+        failures = 0
+        while True:
+            try:
+                if offset is None:
+                    with self.serverClient.get(f"/uploads/{uploadId}") as r:
+                        if r.status_code == 404 and self._blobAvailable(blobHash):
+                            # The upload session has ended, but the blob is stored (e.g., the response to the last
+                            # chunk was lost and the completed session has expired since then)
+                            progress.update(inputFile.size - confirmedOffset)
+                            return
+                        self._raiseForStatus(r)
+                        offset = r.json()["offset"]
+                progress.update(offset - confirmedOffset)
+                confirmedOffset = offset
+                if offset >= inputFile.size:
+                    return
+                headers = {"Content-Type": "application/octet-stream", "Upload-Offset": str(offset)}
+                data = inputFile.read(offset, self.RESUMABLE_UPLOAD_CHUNK_SIZE)
+                if contentEncoding:
+                    headers["Content-Encoding"] = contentEncoding
+                    data = b"".join(compressChunks([data], contentEncoding))
+                # The request is not retried automatically: the offset has to be checked first
+                with self.serverClient.request("PATCH", f"/uploads/{uploadId}", data=data, headers=headers, retry=False) as r:
+                    if r.status_code != 409:
+                        # 409 means that the server has received a different amount of data (for example, the response
+                        # to the previous chunk was lost), the upload is continued from the offset in the response
+                        self._raiseForStatus(r)
+                    offset = r.json()["offset"]
+                failures = 0
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                failures += 1
+                if failures > self.serverClient.maximumRetries:
+                    raise
+                self.procOutputQueue.put(f"Upload to {self.serverAddress} was interrupted ({e}), resuming")
+                time.sleep(self.serverClient.RETRY_BACKOFF * 2 ** (failures - 1))
+                offset = None
+
+    def _blobAvailable(self, blobHash):
+        """ Check if the blob is stored on the server. """
+        with self.serverClient.post("/blobs/missing", json={"blobs": [blobHash]}, retry=True) as r:
+            self._raiseForStatus(r)
+            return blobHash not in r.json()["missingBlobs"]
+
+    def _serverCapabilities(self):
+        """ Get optional features that the server supports (see /capabilities endpoint).
+        Returns an empty dict if the server does not report its capabilities.
+        """
+        with self.serverClient.get("/capabilities") as r:
+            if r.status_code == 404:
+                # server does not support any optional features (compressed or resumable uploads)
+                return {}
+            self._raiseForStatus(r)
+            return r.json()
+
+    def _waitForJobCompletion(self):
+        """ Wait until the job is finished, while reporting its status. Status updates are received as a stream of
+        server-sent events. If the server does not support it or the stream is interrupted then the status is polled.
+        Returns False if cancelled.
+        """
+        import requests
+        try:
+            completed = self._receiveJobEvents()
+            if completed is not None:
+                return completed
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            logging.debug(f"Job status stream was interrupted ({e}), polling job status")
+        while not self._cancelRequested.is_set():
+            with self.serverClient.get(f"/jobs/{self.jobId}") as r:
+                self._raiseForStatus(r)
+                if self._updateJobInfo(r.json()):
+                    return True
+            self._cancelRequested.wait(self.POLL_INTERVAL)
+        return False
+
+    def _receiveJobEvents(self):
+        """ Receive job status updates from the server as server-sent events until the job is finished.
+        Returns False if cancelled, None if the server does not support job status events.
+        """
+        import requests
+        # Server sends an event at least every few seconds, therefore a short read timeout can detect lost connections
+        with self.serverClient.get(f"/jobs/{self.jobId}/events", stream=True, timeout=(self.serverClient.connectTimeout, self.EVENT_STREAM_TIMEOUT),
+                                   headers={"Accept": "text/event-stream"}) as r:
+            if r.status_code == 404:
+                try:
+                    content = r.json()
+                except ValueError:
+                    # not a response of the server application (e.g., error page of a proxy)
+                    content = None
+                if not isinstance(content, dict) or "error" not in content:
+                    # server does not have job status events (the job exists, the endpoint does not)
+                    return None
+            self._raiseForStatus(r)
+            eventData = []
+            for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+                if self._cancelRequested.is_set():
+                    return False
+                if line.startswith("data:"):
+                    eventData.append(line[len("data:"):].strip())
+                elif not line and eventData:
+                    # empty line terminates the event
+                    if self._updateJobInfo(json.loads("\n".join(eventData))):
+                        return True
+                    eventData = []
+        # Stream ended without reporting completion
+        raise requests.exceptions.ConnectionError("Job status stream ended unexpectedly")
+
+    def _updateJobInfo(self, jobInfo):
+        """ Store and report job status received from the server. Returns True if the job is finished. """
+        from MONAIAuto3DSegLib.utils import humanReadableTimeFromSec
+        previousJobInfo = self.jobInfo or {}
+        self.jobInfo = jobInfo
+        status = jobInfo["status"]
+        if status in ["succeeded", "failed", "cancelled"]:
+            return True
+        if status == "queued":
+            statusMessage = f"Waiting in queue on the server (position: {jobInfo['queuePosition'] + 1})"
+        else:
+            # Stage may contain sliding window progress, only log the stage name
+            statusMessage = f"Processing on the server: {(jobInfo['stage'] or 'Starting').split(' (')[0]}"
+        previousStatusMessage = self._statusMessage
+        if statusMessage != previousStatusMessage:
+            # Only log status changes (but not each progress update) to avoid flooding the log
+            self.procOutputQueue.put(f"{statusMessage} (remaining time: {humanReadableTimeFromSec(jobInfo.get('eta'))})")
+            self._statusMessage = statusMessage
+        if any(jobInfo.get(key) != previousJobInfo.get(key) for key in ["status", "stage", "progress", "queuePosition", "eta"]):
+            self.procOutputQueue.put(JobProgress(status, jobInfo["stage"], jobInfo["progress"] or 0.0,
+                                                 jobInfo["queuePosition"], jobInfo.get("eta")))
+        return False
+
+    def _downloadResult(self, outputFile, resultPath=None):
+        """ Download the segmentation result and save it as a NRRD file.
+        The result is requested in label runs format, which is typically much smaller than the labelmap image.
+        Servers that do not support it (or when it would not be smaller) send the NRRD file instead.
+        :param resultPath: path of the result on the server, by default the result of the current job
+        """
+        from MONAIAuto3DSegLib.compression import TRANSFER_CHUNK_SIZE, decompressChunks, supportedContentEncodings
+        from MONAIAuto3DSegLib.label_runs import LABEL_RUNS_MEDIA_TYPE, decodeLabelRuns
+        from MONAIAuto3DSegLib.nrrd_io import writeNrrd
+        headers = {"Accept-Encoding": ", ".join(supportedContentEncodings())}
+        with self.serverClient.get(resultPath or f"/jobs/{self.jobId}/result", params={"result_format": "runs"}, headers=headers, stream=True) as r:
+            self._raiseForStatus(r)
+            # Decompress here (instead of relying on requests) to support all encodings that the client accepts
+            chunks = r.raw.stream(TRANSFER_CHUNK_SIZE, decode_content=False)
+            contentEncoding = r.headers.get("Content-Encoding")
+            if contentEncoding:
+                chunks = decompressChunks(chunks, contentEncoding)
+            if r.headers.get("Content-Type", "").startswith(LABEL_RUNS_MEDIA_TYPE):
+                labelmap, header = decodeLabelRuns(b"".join(chunks))
+                writeNrrd(outputFile, labelmap, header)
+                return
+            with open(outputFile, "wb") as binary_file:
+                for chunk in chunks:
+                    binary_file.write(chunk)
+
+    @staticmethod
+    def _raiseForStatus(response):
+        import requests
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            from http import HTTPStatus
+            status = HTTPStatus(e.response.status_code)
+            logging.debug(f"Server response content: {response.content}")
+            try:
+                message = response.json()["message"]
+            except Exception:
+                message = status.description
+            raise RuntimeError(f"{status.phrase}: {message}")
+
+
+class RemoteSequenceInference(RemoteInference):
+    """ Segmenting all items of an image sequence (such as a cardiac or perfusion time series) on a remote server.
+
+        Input files of all items are uploaded and processed in a single job (see /sequences endpoint), therefore
+        the model is only loaded once. The result of each item is downloaded as soon as the server completes it,
+        so results can be imported while the server processes the next items (see RemoteSequenceItemInference).
+
+        If the server cannot process sequences then the items are processed in separate jobs, one after the other.
+    """
+
+    def __init__(self,
+                 server,
+                 taskInfo: SegmentationTaskInfo = None,
+                 logCallback: Callable = None,
+                 completedCallback: Callable = None,
+                 progressCallback: Callable = None):
+        super().__init__(server, taskInfo, logCallback, completedCallback, progressCallback)
+        self.numberOfItems = 0
+        self.numberOfCompletedItems = 0  # results are downloaded in the order of items
+        self.itemOutputFiles = []  # result file of each item
+        self._jobItems = (0, 1)  # index of the first item and number of items in the job that is being processed
+        self._itemCompleted = threading.Condition()
+
+    def run(self, modelName, itemInputFiles, itemOutputFiles, waitForCompletion=True, outputGeometry=None):
+        """ Process the sequence items on the server and save the result of each item to itemOutputFiles.
+        :param itemInputFiles: list of the input files of each item, either file paths or in-memory files
+          (see MONAIAuto3DSegLib.upload)
+        :param outputGeometry: voxel grid of the results, the same for all items (see RemoteInference.run)
+        """
+        from MONAIAuto3DSegLib.upload import UploadFile
+        itemInputFiles = [[UploadFile(inputFile) if isinstance(inputFile, (str, Path)) else inputFile for inputFile in inputFiles]
+                          for inputFiles in itemInputFiles]
+        self.numberOfItems = len(itemInputFiles)
+        self.itemOutputFiles = itemOutputFiles
+        self.outputGeometry = outputGeometry
+        self._start((modelName, itemInputFiles, itemOutputFiles), waitForCompletion)
+
+    def waitForItem(self, itemIndex):
+        """ Wait until the result of the item is downloaded or processing ends. Can be called from any thread.
+        Returns 0 if the result is available, otherwise the return code of processing (see ExitCode).
+        """
+        with self._itemCompleted:
+            while itemIndex >= self.numberOfCompletedItems and self.procReturnCode == ExitCode.DID_NOT_RUN:
+                self._itemCompleted.wait()
+            return 0 if itemIndex < self.numberOfCompletedItems else self.procReturnCode
+
+    def _setProcReturnCode(self, rcode):
+        # Items that are waited for will not be completed anymore
+        with self._itemCompleted:
+            super()._setProcReturnCode(rcode)
+            self._itemCompleted.notify_all()
+
+    def _onItemCompleted(self):
+        with self._itemCompleted:
+            self.numberOfCompletedItems += 1
+            self._itemCompleted.notify_all()
+
+    def _processJobOnServer(self, modelName, itemInputFiles, itemOutputFiles):
+        """ Process the items that are not completed yet on the current server. If processing was interrupted on
+        another server, the completed items are not processed again. Returns False if processing was cancelled.
+        """
+        if not self._serverCapabilities().get("sequences"):
+            # Server cannot process sequences, process the remaining items one by one
+            for itemIndex in range(self.numberOfCompletedItems, self.numberOfItems):
+                self._jobItems = (itemIndex, 1)
+                if not super()._processJobOnServer(modelName, itemInputFiles[itemIndex], itemOutputFiles[itemIndex]):
+                    return False
+                self._onItemCompleted()
+            return True
+
+        firstItemIndex = self.numberOfCompletedItems
+        self._jobItems = (firstItemIndex, self.numberOfItems - firstItemIndex)
+        self.jobId = None
+        self.jobInfo = None
+        self._statusMessage = None
+        from MONAIAuto3DSegLib.tracing import childSpan
+        with childSpan("upload input", server=self.serverAddress, items=self._jobItems[1]):
+            self._submitSequenceJob(modelName, itemInputFiles[firstItemIndex:])
+        # Results are downloaded while waiting, as the server completes the items (see _updateJobInfo)
+        with childSpan("wait for job", job=self.jobId):
+            completed = self._waitForJobCompletion()
+        if not completed:
+            # cancelled
+            self.serverClient.delete(f"/jobs/{self.jobId}").close()
+            self.procOutputQueue.put("Processing on the server was cancelled")
+            return False
+        if self.jobInfo["status"] != "succeeded":
+            raise RuntimeError(f"Processing on the server {self.jobInfo['status']}: {self.jobInfo.get('error', '')}")
+        # All results are downloaded, the job can be removed from the server
+        self.serverClient.delete(f"/jobs/{self.jobId}").close()
+        return True
+
+    def _submitSequenceJob(self, modelName, itemInputFiles):
+        """ Upload input files of the items (files that are already on the server are not uploaded again)
+        and submit a job that processes all of them.
+        """
+        for attempt in range(2):
+            blobHashes = iter(self._uploadBlobs([inputFile for inputFiles in itemInputFiles for inputFile in inputFiles]))
+            frames = [self._inputReferences(inputFiles, [next(blobHashes) for _ in inputFiles]) for inputFiles in itemInputFiles]
+            with self.serverClient.post("/sequences", params=self._jobParameters(modelName), json={"frames": frames}) as r:
+                if r.status_code == 409 and attempt == 0:
+                    # Blobs have been removed from the server since the upload, upload them again
+                    continue
+                self._raiseForStatus(r)
+                self.jobInfo = r.json()
+                self.jobId = self.jobInfo["id"]
+                return
+
+    def _updateJobInfo(self, jobInfo):
+        firstItemIndex, numberOfJobItems = self._jobItems
+        # Report progress of the whole sequence, not only of the items in the current job
+        jobInfo = {**jobInfo, "progress": (firstItemIndex + (jobInfo["progress"] or 0.0) * numberOfJobItems) / self.numberOfItems}
+        finished = super()._updateJobInfo(jobInfo)
+        if "completedFrames" in jobInfo:
+            self._downloadCompletedItems(firstItemIndex, jobInfo["completedFrames"])
+        return finished
+
+    def _downloadCompletedItems(self, firstItemIndex, completedFrames):
+        """ Download results of the frames that the server has completed since the last status update. """
+        from MONAIAuto3DSegLib.tracing import childSpan
+        while self.numberOfCompletedItems < firstItemIndex + completedFrames and not self._cancelRequested.is_set():
+            itemIndex = self.numberOfCompletedItems
+            with childSpan("download result", item=itemIndex):
+                self._downloadResult(self.itemOutputFiles[itemIndex], f"/jobs/{self.jobId}/frames/{itemIndex - firstItemIndex}/result")
+            self._onItemCompleted()
+
+
+class RemoteSequenceItemInference(BackgroundProcess):
+    """ Waiting for the result of a sequence item that is processed by a RemoteSequenceInference.
+
+        Each sequence item has its own background process, so that results are imported item by item, in the same
+        way as when each item is processed in a separate job.
+    """
+
+    def __init__(self,
+                 sequenceInference: RemoteSequenceInference,
+                 itemIndex: int,
+                 taskInfo: SegmentationTaskInfo = None,
+                 logCallback: Callable = None,
+                 completedCallback: Callable = None):
+        super().__init__(taskInfo, logCallback, completedCallback)
+        self.sequenceInference = sequenceInference
+        self.itemIndex = itemIndex
+
+    def run(self, waitForCompletion=True):
+        if waitForCompletion:
+            self._waitForResult()
+            self.completedCallback(self.taskInfo)
+        else:
+            self.procThread = threading.Thread(target=self._waitForResult)
+            self.procThread.start()
+            self.checkProcessOutput()
+
+    def _waitForResult(self):
+        self._setProcReturnCode(self.sequenceInference.waitForItem(self.itemIndex))
+
+    def isRunning(self):
+        return self.procThread is not None and self.procThread.is_alive()
+
+    def stop(self):
+        # Processing of the remaining items is cancelled as well
+        self.sequenceInference.stop()
+        self._setProcReturnCode(ExitCode.USER_CANCELLED)
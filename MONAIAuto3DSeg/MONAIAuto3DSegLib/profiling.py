@@ -0,0 +1,142 @@
+import io
+import logging
+import os
+import re
+
+
+# Profilers that can be used for profiling the processing stages of the inference
+PROFILERS = ["torch", "cprofile"]
+
+# Number of operators (torch profiler) or functions (cProfile) that are listed for each stage in the summary
+DEFAULT_NUMBER_OF_TOP_OPERATORS = 15
+
+
+def parseProfilers(profile):
+    """Get list of profilers from the value of a profile option.
+    :param profile: True (torch profiler), "all", a profiler name (see PROFILERS), or a comma-separated list or
+      a list/tuple of profiler names. None, False, or empty string means no profiling.
+    :raises ValueError: if a profiler name is unknown
+    """
+    if not profile:
+        return []
+    if profile is True:
+        return ["torch"]
+    if isinstance(profile, str):
+        profile = profile.split(",")
+    profilers = [str(name).strip().lower() for name in profile if str(name).strip()]
+    if "all" in profilers:
+        return list(PROFILERS)
+    for name in profilers:
+        if name not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {name} (supported profilers: {', '.join(PROFILERS)}, all)")
+    return [name for name in PROFILERS if name in profilers]
+
+
+def stageFileName(stage):
+    """Get a file name component from a stage name (e.g., "Post-processing" -> "post_processing")."""
+    return re.sub(r"[^0-9a-z]+", "_", stage.lower()).strip("_")
+
+
+class StageProfiler:
+    """Profiles each processing stage separately, using torch profiler (CPU and, if available, CUDA activities)
+        and/or cProfile.
+
+        For each stage, the following files are written into outputDir:
+
+        - profile-<stage>.trace.json: torch profiler trace, can be opened in chrome://tracing or https://ui.perfetto.dev
+        - profile-<stage>.pstats: cProfile statistics, can be inspected using pstats or snakeviz
+
+        The top operators of each stage (by self time) are listed in profile-summary.txt.
+
+        Example::
+
+            profiler = StageProfiler(["torch"], "/tmp/profile")
+            profiler.startStage("Preprocessing")
+            ...
+            profiler.startStage("Inference")
+            ...
+            profiler.stop()
+            print(profiler.summary())
+    """
+
+    def __init__(self, profilers, outputDir, numberOfTopOperators=DEFAULT_NUMBER_OF_TOP_OPERATORS):
+        """
+        :param profilers: profile option value (see parseProfilers)
+        """
+        self.profilers = parseProfilers(profilers)
+        self.outputDir = str(outputDir)
+        self.numberOfTopOperators = numberOfTopOperators
+        self.outputFiles = []
+        self._stage = None
+        self._torchProfiler = None
+        self._cProfiler = None
+        self._summaries = []  # (stage, summary text) of completed stages
+        os.makedirs(self.outputDir, exist_ok=True)
+
+    def startStage(self, stage):
+        """Stop profiling the current stage (if any) and start profiling the new stage."""
+        self._stopStage()
+        self._stage = stage
+        if "torch" in self.profilers:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torchProfiler = torch.profiler.profile(activities=activities)
+            self._torchProfiler.start()
+        if "cprofile" in self.profilers:
+            import cProfile
+            self._cProfiler = cProfile.Profile()
+            self._cProfiler.enable()
+
+    def stop(self):
+        """Stop profiling the current stage and write the summary file. Has no effect if no stage is being profiled."""
+        if self._stage is None:
+            return
+        self._stopStage()
+        summaryFile = os.path.join(self.outputDir, "profile-summary.txt")
+        with open(summaryFile, "w", encoding="utf-8") as file:
+            file.write(self.summary() + "\n")
+        self.outputFiles.append(summaryFile)
+
+    def summary(self):
+        """Get top operators of each profiled stage as human-readable text."""
+        return "\n\n".join(f"=== {stage} ===\n{stageSummary}" for stage, stageSummary in self._summaries)
+
+    def _stopStage(self):
+        """Stop profilers of the current stage and save the results."""
+        if self._stage is None:
+            return
+        fileNamePrefix = os.path.join(self.outputDir, f"profile-{stageFileName(self._stage)}")
+        stageSummaries = []
+        if self._cProfiler:
+            # Stop cProfile first, so that it does not include saving the torch profiler results
+            self._cProfiler.disable()
+        if self._torchProfiler:
+            self._torchProfiler.stop()
+            stageSummaries.append(self._torchProfilerSummary(self._torchProfiler))
+            try:
+                self._torchProfiler.export_chrome_trace(fileNamePrefix + ".trace.json")
+                self.outputFiles.append(fileNamePrefix + ".trace.json")
+            except Exception as e:
+                # e.g., no events were recorded
+                logging.warning(f"Failed to save torch profiler trace of stage {self._stage}: {e}")
+            self._torchProfiler = None
+        if self._cProfiler:
+            self._cProfiler.dump_stats(fileNamePrefix + ".pstats")
+            self.outputFiles.append(fileNamePrefix + ".pstats")
+            stageSummaries.append(self._cProfileSummary(self._cProfiler))
+            self._cProfiler = None
+        self._summaries.append((self._stage, "\n".join(stageSummaries)))
+        self._stage = None
+
+    def _torchProfilerSummary(self, profiler):
+        import torch
+        sortBy = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        return "Top operators (torch profiler):\n" + profiler.key_averages().table(sort_by=sortBy, row_limit=self.numberOfTopOperators)
+
+    def _cProfileSummary(self, profiler):
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("tottime").print_stats(self.numberOfTopOperators)
+        return "Top functions (cProfile):\n" + stream.getvalue().strip()
@@ -0,0 +1,67 @@
+import re
+
+
+# Processing stages of the inference script and the approximate fraction of the total processing time that
+# is completed when the stage starts. Used for progress reporting and remaining time estimation.
+PROCESSING_STAGES = {
+    "Loading model": 0.0,
+    "Preprocessing": 0.1,
+    "Inference": 0.2,
+    "Post-processing": 0.8,
+    "Saving": 0.9,
+    "Completed": 1.0,
+}
+
+# Stage messages are human-readable (they appear in the processing log), but they can also be parsed by the
+# process that runs the inference script (e.g., the inference server).
+STAGE_MESSAGE_PREFIX = "Processing stage: "
+STAGE_MESSAGE_PATTERN = re.compile(re.escape(STAGE_MESSAGE_PREFIX) + r"(.+) \((\d+)%\)$")
+
+
+def formatStageMessage(stage, progress=None):
+    """Get a log message that reports the start of a processing stage.
+    :param stage: stage name, typically one of PROCESSING_STAGES
+    :param progress: fraction of processing completed (0.0-1.0), if not specified then it is taken from PROCESSING_STAGES
+    """
+    if progress is None:
+        progress = PROCESSING_STAGES.get(stage, 0.0)
+    return f"{STAGE_MESSAGE_PREFIX}{stage} ({round(progress * 100)}%)"
+
+
+def parseStageMessage(text):
+    """Get (stage, progress) from a log message created by formatStageMessage. Returns None for other messages."""
+    match = STAGE_MESSAGE_PATTERN.match(text.strip())
+    if not match:
+        return None
+    return match.group(1), int(match.group(2)) / 100.0
+
+
+# When frames of an image sequence are segmented by a single process, completion of each frame is reported,
+# so that the result of the frame can be used while the next frames are processed.
+FRAME_MESSAGE_PREFIX = "Frame completed: "
+FRAME_MESSAGE_PATTERN = re.compile(re.escape(FRAME_MESSAGE_PREFIX) + r"(\d+)/(\d+)$")
+
+
+def formatFrameMessage(frameIndex, numberOfFrames):
+    """Get a log message that reports that the result of a frame is saved.
+    :param frameIndex: index of the completed frame (starting from 0)
+    """
+    return f"{FRAME_MESSAGE_PREFIX}{frameIndex + 1}/{numberOfFrames}"
+
+
+def parseFrameMessage(text):
+    """Get index of the completed frame (starting from 0) from a log message created by formatFrameMessage.
+    Returns None for other messages."""
+    match = FRAME_MESSAGE_PATTERN.match(text.strip())
+    if not match:
+        return None
+    return int(match.group(1)) - 1
+
+
+def estimateRemainingTime(elapsedTime, progress):
+    """Estimate remaining processing time (in seconds) from elapsed time and progress (0.0-1.0).
+    Returns None if there is not enough information for an estimate.
+    """
+    if not progress or progress <= 0.0:
+        return None
+    return max(0.0, elapsedTime * (1.0 - progress) / progress)
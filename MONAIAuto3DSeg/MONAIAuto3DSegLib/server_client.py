@@ -0,0 +1,257 @@
+import logging
+import re
+import threading
+import time
+
+from MONAIAuto3DSegLib.tracing import TRACEPARENT_HEADER, currentSpan
+
+
+class ServerClient:
+    """ HTTP client for communicating with a MONAIAuto3DSeg inference server.
+
+        A single client object should be used for all requests to the same server: connections are kept alive and
+        reused (also across sequence items), all requests have timeouts, idempotent requests are retried with
+        exponential backoff if the server cannot be reached or it is temporarily unavailable, and the latency of
+        requests is measured for each endpoint. Requests that are sent while a trace span is active
+        (see MONAIAuto3DSegLib.tracing) carry its trace context, so that the server can record its spans in the same trace.
+
+        Example::
+
+            client = ServerClient("http://localhost:8891")
+            models = client.get("/models").json()
+            logging.info(client.latencySummary())
+    """
+
+    # Timeout (in seconds) for establishing a connection and for waiting for data from the server.
+    # The read timeout must be long enough for the server to receive the input and create a job (which may require
+    # downloading the model on first use).
+    CONNECT_TIMEOUT = 10.0
+    READ_TIMEOUT = 300.0
+
+    # Number of times a failed idempotent request is sent again and the base waiting time before retrying
+    # (doubled after each attempt)
+    MAXIMUM_RETRIES = 3
+    RETRY_BACKOFF = 0.5
+
+    # Responses with these status codes mean that the server is temporarily unavailable
+    RETRY_STATUS_CODES = [502, 503, 504]
+
+    # Requests with these methods can be safely sent again (repeating them has the same effect as sending them once)
+    IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+    # Maximum number of connections kept open (concurrent uploads use multiple connections)
+    MAXIMUM_CONNECTIONS = 8
+
+    def __init__(self, serverAddress, connectTimeout=None, readTimeout=None, maximumRetries=None):
+        import requests
+        self.serverAddress = serverAddress.rstrip("/")
+        self.connectTimeout = connectTimeout if connectTimeout is not None else self.CONNECT_TIMEOUT
+        self.readTimeout = readTimeout if readTimeout is not None else self.READ_TIMEOUT
+        self.maximumRetries = maximumRetries if maximumRetries is not None else self.MAXIMUM_RETRIES
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.MAXIMUM_CONNECTIONS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._latencies = {}  # endpoint -> [number of requests, total time, maximum time, number of failures]
+        self._latenciesLock = threading.Lock()
+
+    def close(self):
+        """ Close all connections. """
+        self.session.close()
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def request(self, method, path, retry=None, **kwargs):
+        """ Send a request to the server.
+        :param method: HTTP method
+        :param path: path on the server, starting with "/"
+        :param retry: send the request again if it fails because the server cannot be reached or it is temporarily
+          unavailable. By default, only idempotent requests are retried. Requests with a body that can only be
+          read once (generator) are never retried.
+        :param kwargs: additional arguments for requests.Session.request (params, json, data, headers, stream, timeout)
+        :return: requests.Response object
+        """
+        import requests
+        method = method.upper()
+        if retry is None:
+            retry = method in self.IDEMPOTENT_METHODS
+        data = kwargs.get("data")
+        if data is not None and hasattr(data, "__next__"):
+            retry = False
+        kwargs.setdefault("timeout", (self.connectTimeout, self.readTimeout))
+        span = currentSpan()
+        if span is not None:
+            kwargs["headers"] = {TRACEPARENT_HEADER: span.traceparent, **(kwargs.get("headers") or {})}
+        url = self.serverAddress + path
+        endpoint = self._endpointName(method, path)
+        attempt = 0
+        while True:
+            startTime = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._addLatency(endpoint, time.perf_counter() - startTime, failed=True)
+                if not retry or attempt >= self.maximumRetries:
+                    raise
+                logging.debug(f"Request {method} {url} failed ({e}), retrying")
+            else:
+                self._addLatency(endpoint, time.perf_counter() - startTime, failed=response.status_code >= 500)
+                if not retry or attempt >= self.maximumRetries or response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                logging.debug(f"Request {method} {url} failed (status {response.status_code}), retrying")
+                response.close()
+            time.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    @staticmethod
+    def _endpointName(method, path):
+        """ Get name of the endpoint for latency statistics. Path parameters (job ids, blob hashes) are omitted,
+        so that all requests to the same endpoint are counted together.
+        """
+        pathComponents = path.split("?")[0].strip("/").split("/")
+        pathComponents = ["{id}" if re.fullmatch(r"[0-9a-fA-F-]{16,}", component) else component for component in pathComponents]
+        return f"{method} /{'/'.join(pathComponents)}"
+
+    def _addLatency(self, endpoint, duration, failed=False):
+        with self._latenciesLock:
+            statistics = self._latencies.setdefault(endpoint, [0, 0.0, 0.0, 0])
+            statistics[0] += 1
+            statistics[1] += duration
+            statistics[2] = max(statistics[2], duration)
+            if failed:
+                statistics[3] += 1
+
+    def latencyStatistics(self):
+        """ Get number of requests, failed requests, mean and maximum latency (in seconds) for each endpoint.
+        Latency is the time until the response headers are received (for downloads, it does not include
+        receiving the response body).
+        """
+        with self._latenciesLock:
+            return {endpoint: {"requests": count, "failures": failures, "mean": totalTime / count, "maximum": maximumTime}
+                    for endpoint, (count, totalTime, maximumTime, failures) in self._latencies.items()}
+
+    def latencySummary(self):
+        """ Get latency statistics as a human-readable text. """
+        lines = []
+        for endpoint, statistics in sorted(self.latencyStatistics().items()):
+            failures = f", {statistics['failures']} failed" if statistics["failures"] else ""
+            lines.append(f"{endpoint}: {statistics['requests']} requests{failures}, "
+                         f"mean {statistics['mean'] * 1000:.0f} ms, max {statistics['maximum'] * 1000:.0f} ms")
+        return "Server request latency: " + ("; ".join(lines) if lines else "no requests")
+
+
+class ServerPool:
+    """ Set of inference servers that share the processing load.
+
+        Each job is sent to the least loaded available server. Load is queried from the servers (/queue endpoint)
+        at most every HEALTH_CHECK_INTERVAL seconds, servers that do not respond are considered unavailable until
+        the next check. Jobs that are assigned to a server since the last check are counted as additional load,
+        so that jobs that are submitted in quick succession (e.g., sequence items) are distributed between servers.
+
+        Example::
+
+            pool = ServerPool(ServerPool.parseServerAddresses("http://server1:8891, http://server2:8891"))
+            client = pool.selectClient()
+    """
+
+    HEALTH_CHECK_INTERVAL = 10.0
+    # Servers that do not respond within this time (in seconds) are considered unavailable
+    HEALTH_CHECK_TIMEOUT = 3.0
+
+    def __init__(self, serverAddresses):
+        if not serverAddresses:
+            raise ValueError("At least one server address is required")
+        self.clients = [ServerClient(serverAddress) for serverAddress in serverAddresses]
+        self._load = {client: {} for client in self.clients}  # last /queue response of each available server
+        self._assignedJobs = {client: 0 for client in self.clients}  # jobs assigned since the last health check
+        self._lastHealthCheckTime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parseServerAddresses(text):
+        """ Get list of server addresses from a comma-separated list. """
+        return [serverAddress.strip().rstrip("/") for serverAddress in text.split(",") if serverAddress.strip()]
+
+    @property
+    def serverAddresses(self):
+        return [client.serverAddress for client in self.clients]
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def preferredClient(self):
+        """ Get the first server that was available at the last health check. Used for requests that any of the
+        servers can answer (model list, label descriptions). No health check is performed.
+        """
+        with self._lock:
+            for client in self.clients:
+                if client in self._load:
+                    return client
+        return self.clients[0]
+
+    def markUnavailable(self, client):
+        """ Do not use the server until the next health check (e.g., because it stopped responding). """
+        with self._lock:
+            self._load.pop(client, None)
+
+    def checkHealth(self):
+        """ Query the load of all servers (concurrently). """
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(self.clients)) as executor:
+            loads = list(executor.map(self._queryLoad, self.clients))
+        with self._lock:
+            self._load = {client: load for client, load in zip(self.clients, loads) if load is not None}
+            self._assignedJobs = {client: 0 for client in self.clients}
+            self._lastHealthCheckTime = time.monotonic()
+
+    def _queryLoad(self, client):
+        """ Get load information of the server, None if the server is not available. """
+        try:
+            with client.get("/queue", retry=False, timeout=(self.HEALTH_CHECK_TIMEOUT, self.HEALTH_CHECK_TIMEOUT)) as r:
+                if r.status_code == 404:
+                    # server does not report its load
+                    return {}
+                r.raise_for_status()
+                return r.json()
+        except Exception as e:
+            logging.warning(f"Server {client.serverAddress} is not available: {e}")
+            return None
+
+    def selectClient(self, excludedClients=None):
+        """ Get the least loaded available server and count the job that will be sent to it.
+        :param excludedClients: servers that must not be used (e.g., because a job failed on them)
+        :raises RuntimeError: if no server is available
+        """
+        excludedClients = excludedClients or []
+        candidates = [client for client in self.clients if client not in excludedClients]
+        if len(self.clients) == 1:
+            # Only one server, no need to check the load
+            if not candidates:
+                raise RuntimeError(f"Server {self.clients[0].serverAddress} is not available")
+            return candidates[0]
+        if self._lastHealthCheckTime is None or time.monotonic() - self._lastHealthCheckTime > self.HEALTH_CHECK_INTERVAL:
+            self.checkHealth()
+        with self._lock:
+            candidates = [client for client in candidates if client in self._load]
+            if not candidates:
+                raise RuntimeError(f"None of the servers are available: {', '.join(self.serverAddresses)}")
+            client = min(candidates, key=self._loadKey)
+            self._assignedJobs[client] += 1
+        return client
+
+    def _loadKey(self, client):
+        """ Servers are compared by the number of jobs per processing slot, then by the estimated queue time. """
+        load = self._load[client]
+        numberOfJobs = load.get("queuedJobs", 0) + load.get("runningJobs", 0) + self._assignedJobs[client]
+        return numberOfJobs / max(1, load.get("maxConcurrentJobs") or 1), load.get("estimatedQueueTime") or 0.0
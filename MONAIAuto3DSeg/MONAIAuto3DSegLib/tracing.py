@@ -0,0 +1,311 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Lightweight tracing in the style of OpenTelemetry, without external dependencies.
+#
+# A trace records the time spent in each step of processing a segmentation request, across processes: Slicer client,
+# inference server, and inference worker or script. Each step is a span that has a name, start and end time, and
+# attributes. Spans are organized into a tree by their parent span. Trace context is propagated between processes
+# as a W3C traceparent string (HTTP header, command-line argument).
+#
+# Spans are written to JSON Lines files (one span per line), each process may write to its own file or to a shared
+# file. Traces can be printed as a tree without any external collector:
+#
+#   python MONAIAuto3DSegLib/tracing.py slicer-trace.jsonl server-trace.jsonl
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT_PATTERN = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+
+def newTraceId():
+    return os.urandom(16).hex()
+
+
+def newSpanId():
+    return os.urandom(8).hex()
+
+
+def parseTraceparent(traceparent):
+    """Get (trace id, parent span id) from a W3C traceparent string (e.g., "00-<trace id>-<span id>-01").
+    Returns None if the string is not a valid traceparent.
+    """
+    match = TRACEPARENT_PATTERN.fullmatch((traceparent or "").strip().lower())
+    if not match:
+        return None
+    version, traceId, spanId, _ = match.groups()
+    if version == "ff" or traceId == "0" * 32 or spanId == "0" * 16:
+        return None
+    return traceId, spanId
+
+
+class Span:
+    """Timed step of processing. Created by Tracer.startSpan, exported when end() is called."""
+
+    def __init__(self, tracer, name, traceId, parentSpanId=None, attributes=None, startTime=None):
+        self.tracer = tracer
+        self.name = name
+        self.traceId = traceId
+        self.spanId = newSpanId()
+        self.parentSpanId = parentSpanId
+        self.attributes = dict(attributes or {})
+        self.startTime = startTime if startTime is not None else time.time()
+        self.endTime = None
+        self.error = None
+
+    @property
+    def traceparent(self):
+        """Trace context of this span for propagating to other processes (child spans will have this span as parent)."""
+        return f"00-{self.traceId}-{self.spanId}-01"
+
+    @property
+    def ended(self):
+        return self.endTime is not None
+
+    def setAttribute(self, name, value):
+        self.attributes[name] = value
+
+    def end(self, endTime=None, error=None):
+        """Set end time and export the span. Subsequent calls have no effect.
+        :param error: error message if the step failed
+        """
+        if self.ended:
+            return
+        self.endTime = endTime if endTime is not None else time.time()
+        if error:
+            self.error = str(error)
+        self.tracer._export(self)
+
+    def toDict(self):
+        span = {
+            "traceId": self.traceId,
+            "spanId": self.spanId,
+            "parentSpanId": self.parentSpanId,
+            "name": self.name,
+            "service": self.tracer.serviceName,
+            "startTime": self.startTime,
+            "endTime": self.endTime,
+            "duration": self.endTime - self.startTime if self.ended else None,
+            "status": "error" if self.error else "ok",
+            "attributes": self.attributes,
+        }
+        if self.error:
+            span["error"] = self.error
+        return span
+
+
+class JsonFileSpanExporter:
+    """Appends finished spans to a file, one JSON object per line. Multiple processes can write to the same file,
+    as each span is written by a single append operation.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span.toDict(), default=str) + "\n" for span in spans)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as file:
+                file.write(lines)
+        except OSError as e:
+            # Tracing must not interfere with processing
+            logging.warning(f"Failed to write trace to {self.path}: {e}")
+
+
+class Tracer:
+    """Creates spans of a process (service) and exports them when they end.
+
+        Example::
+
+            tracer = Tracer("server", JsonFileSpanExporter("trace.jsonl"))
+            with tracer.span("receive input", parent=request.headers.get("traceparent")):
+                with childSpan("verify hash", blob=blobHash):
+                    ...
+    """
+
+    def __init__(self, serviceName, exporter=None):
+        """
+        :param serviceName: name of the process, stored in each span
+        :param exporter: object that has an export(spans) method. If None then tracing is disabled
+          (spans can still be created, but they are not exported).
+        """
+        self.serviceName = serviceName
+        self.exporter = exporter
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def startSpan(self, name, parent=None, attributes=None, startTime=None):
+        """Start a new span.
+        :param parent: parent Span, traceparent string received from another process, or None to use the current span
+          (see activateSpan). If there is no valid parent then a new trace is started.
+        :param startTime: start time (as returned by time.time()), for recording steps that have already started
+        """
+        if parent is None:
+            parent = currentSpan()
+        if isinstance(parent, Span):
+            traceId, parentSpanId = parent.traceId, parent.spanId
+        else:
+            traceId, parentSpanId = parseTraceparent(parent) or (newTraceId(), None)
+        return Span(self, name, traceId, parentSpanId, attributes, startTime)
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """Context manager that records a span while the block runs. The span is the current span within the block,
+        so that nested spans (see childSpan) and outgoing requests are associated with it.
+        """
+        span = self.startSpan(name, parent, attributes)
+        with activateSpan(span):
+            try:
+                yield span
+            except BaseException as e:
+                span.end(error=str(e) or type(e).__name__)
+                raise
+            finally:
+                span.end()
+
+    def _export(self, span):
+        if self.exporter is not None:
+            self.exporter.export([span])
+
+
+_currentSpan = contextvars.ContextVar("MONAIAuto3DSegCurrentSpan", default=None)
+
+
+def currentSpan():
+    """Get the span that is active in this thread or async task, None if there is no active span."""
+    return _currentSpan.get()
+
+
+@contextmanager
+def activateSpan(span):
+    """Make the span the current span within the block (in this thread or async task). None is ignored.
+    New threads start without a current span, use contextvars.copy_context() to pass it to worker threads.
+    """
+    if span is None:
+        yield None
+        return
+    token = _currentSpan.set(span)
+    try:
+        yield span
+    finally:
+        _currentSpan.reset(token)
+
+
+@contextmanager
+def childSpan(name, parent=None, **attributes):
+    """Record a span as a child of parent (Span) or of the current span. If there is no parent (tracing is disabled
+    or the caller is not part of a trace) then nothing is recorded.
+    """
+    parent = parent or currentSpan()
+    if parent is None:
+        yield None
+        return
+    with parent.tracer.span(name, parent, **attributes) as span:
+        yield span
+
+
+class TraceContextMiddleware:
+    """ASGI middleware that records a span for each HTTP request that carries a traceparent header (i.e., requests
+    that are part of a client trace). The span is the current span while the request is processed, so that spans
+    created by the endpoint become its children.
+    """
+
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(TRACEPARENT_HEADER.encode(), b"").decode("latin-1")
+        if not parseTraceparent(traceparent):
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def sendAndRecordStatus(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        with self.tracer.span(f"{scope['method']} {scope['path']}", traceparent) as span:
+            try:
+                await self.app(scope, receive, sendAndRecordStatus)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    # Name by route (e.g., /jobs/{job_id}) instead of path, so that requests to an endpoint can be grouped
+                    span.name = f"{scope['method']} {route.path}"
+                span.setAttribute("http.status_code", status["code"])
+                if status["code"] >= 500:
+                    span.error = f"HTTP status {status['code']}"
+
+
+def readSpans(paths, traceId=None):
+    """Read spans (as dicts) from JSON Lines trace files.
+    :param traceId: only return spans of this trace
+    """
+    spans = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # incomplete line (e.g., the process was terminated while writing)
+                    continue
+                if traceId is None or span.get("traceId") == traceId:
+                    spans.append(span)
+    return spans
+
+
+def formatTraces(spans):
+    """Get human-readable text of traces: spans are shown as a tree, with start time relative to the start of the
+    trace and duration (in seconds). Spans whose parent is not available (e.g., it was recorded in a file that is
+    not included) are shown at the top level.
+    """
+    spansByTrace = {}
+    for span in spans:
+        spansByTrace.setdefault(span["traceId"], []).append(span)
+    lines = []
+    for traceId, traceSpans in sorted(spansByTrace.items(), key=lambda item: min(span["startTime"] for span in item[1])):
+        traceStartTime = min(span["startTime"] for span in traceSpans)
+        spanIds = {span["spanId"] for span in traceSpans}
+        children = {}
+        for span in traceSpans:
+            parentSpanId = span.get("parentSpanId") if span.get("parentSpanId") in spanIds else None
+            children.setdefault(parentSpanId, []).append(span)
+        lines.append(f"Trace {traceId}")
+
+        def addSpan(span, depth):
+            error = f" ERROR: {span['error']}" if span.get("error") else ""
+            lines.append(f"{'  ' * depth}  {span['startTime'] - traceStartTime:8.3f}s {span['duration']:8.3f}s  "
+                         f"{span['name']} [{span['service']}]{error}")
+            for child in sorted(children.get(span["spanId"], []), key=lambda child: child["startTime"]):
+                addSpan(child, depth + 1)
+
+        for rootSpan in sorted(children.get(None, []), key=lambda span: span["startTime"]):
+            addSpan(rootSpan, 0)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Print traces recorded by MONAIAuto3DSeg client, server, and inference script")
+    parser.add_argument("trace_files", nargs="+", help="JSON Lines trace files")
+    parser.add_argument("--trace-id", type=str, default=None, help="only print this trace")
+    args = parser.parse_args()
+    print(formatTraces(readSpans(args.trace_files, args.trace_id)))
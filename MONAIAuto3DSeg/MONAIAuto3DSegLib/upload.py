@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from MONAIAuto3DSegLib.compression import TRANSFER_CHUNK_SIZE, readFileChunks
+from MONAIAuto3DSegLib.nrrd_io import formatNrrdHeader, voxelBytes
+
+
+class InMemoryNrrdFile:
+    """ NRRD file that is generated on the fly from a voxel array, so that an image can be uploaded without writing it
+        to disk first. The content is the same as what writeNrrd would write with raw encoding.
+    """
+
+    def __init__(self, data, header, filename="input-volume.nrrd"):
+        """
+        :param data: numpy array in NRRD axis order (fastest axis first). The array is referenced, not copied,
+          therefore it must not be modified while the file is being uploaded.
+        :param header: header dict, geometry information is copied from here (see formatNrrdHeader)
+        :param filename: file name that the server sees
+        """
+        if data.dtype.itemsize > 1:
+            data = data.astype(data.dtype.newbyteorder("<"), copy=False)
+        self.filename = filename
+        self._headerData = formatNrrdHeader(data, header).encode("ascii")
+        self._voxelData = voxelBytes(data)
+        self._sha256 = None
+
+    @property
+    def size(self):
+        return len(self._headerData) + len(self._voxelData)
+
+    def chunks(self, chunkSize=TRANSFER_CHUNK_SIZE):
+        """ Generator that yields the file content in chunks. """
+        yield self._headerData
+        for offset in range(0, len(self._voxelData), chunkSize):
+            yield bytes(self._voxelData[offset:offset + chunkSize])
+
+    def read(self, offset, size):
+        """ Get size bytes of the file content starting at offset (less at the end of the file). """
+        headerSize = len(self._headerData)
+        data = self._headerData[offset:offset + size]
+        voxelOffset = max(0, offset - headerSize)
+        return data + bytes(self._voxelData[voxelOffset:voxelOffset + size - len(data)])
+
+    def save(self, path):
+        """ Write the file content to disk (it can then be uploaded as an UploadFile). """
+        with open(path, "wb") as f:
+            f.write(self._headerData)
+            f.write(self._voxelData)
+
+    def sha256(self):
+        """ Get SHA-256 hash of the file content as a hexadecimal string. """
+        if self._sha256 is None:
+            sha256 = hashlib.sha256(self._headerData)
+            # hashlib releases the GIL for large buffers, therefore multiple files can be hashed in parallel
+            sha256.update(self._voxelData)
+            self._sha256 = sha256.hexdigest()
+        return self._sha256
+
+
+class UploadFile:
+    """ File on disk that is uploaded. Provides the same interface as InMemoryNrrdFile. """
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = Path(path).name
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def chunks(self, chunkSize=TRANSFER_CHUNK_SIZE):
+        return readFileChunks(self.path, chunkSize)
+
+    def read(self, offset, size):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def sha256(self):
+        from MONAIAuto3DSegLib.utils import fileSha256
+        return fileSha256(self.path)
+
+
+class MultipartFormData:
+    """ multipart/form-data request body that is generated while it is sent, so that the files do not have to be
+        loaded into memory (or written to disk). The length is known in advance, therefore requests sends it with
+        a Content-Length header (and not with chunked transfer encoding).
+
+        Example::
+
+            body = MultipartFormData({"image_file": InMemoryNrrdFile(data, header)})
+            requests.post(url, data=body, headers={"Content-Type": body.contentType})
+    """
+
+    def __init__(self, files, progress=None):
+        """
+        :param files: dict of form field name -> file (InMemoryNrrdFile, UploadFile, or any object with
+          filename, size, and chunks())
+        :param progress: optional TransferProgress object that is updated as the content is sent
+        """
+        self.files = files
+        self.progress = progress
+        self.boundary = uuid.uuid4().hex
+        self._partHeaders = {name: (f"--{self.boundary}\r\n"
+                                    f'Content-Disposition: form-data; name="{name}"; filename="{file.filename}"\r\n'
+                                    f"Content-Type: application/octet-stream\r\n\r\n").encode("utf-8")
+                             for name, file in files.items()}
+        self._closingBoundary = f"--{self.boundary}--\r\n".encode("ascii")
+
+    @property
+    def contentType(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return (sum(len(self._partHeaders[name]) + file.size + len(b"\r\n") for name, file in self.files.items())
+                + len(self._closingBoundary))
+
+    def __iter__(self):
+        for name, file in self.files.items():
+            yield self._partHeaders[name]
+            chunks = file.chunks()
+            if self.progress:
+                chunks = self.progress.trackChunks(chunks)
+            yield from chunks
+            yield b"\r\n"
+        yield self._closingBoundary
+
+
+class TransferProgress:
+    """ Reports progress of a data transfer, which may consist of multiple concurrent uploads.
+        The callback is called with a human-readable message each time the progress increases by reportingIncrement.
+        Thread-safe.
+    """
+
+    def __init__(self, totalSize, callback, description="Uploading", reportingIncrement=0.1):
+        """
+        :param totalSize: total number of bytes to transfer
+        :param callback: function that is called with a progress message
+        :param reportingIncrement: minimum progress (0.0-1.0) between two reports
+        """
+        self.totalSize = totalSize
+        self.transferredSize = 0
+        self.callback = callback
+        self.description = description
+        self.reportingIncrement = reportingIncrement
+        self._lastReportedProgress = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, size):
+        """ Add size (in bytes) to the transferred size. """
+        with self._lock:
+            self.transferredSize += size
+            transferredSize = self.transferredSize
+            progress = min(1.0, transferredSize / self.totalSize) if self.totalSize else 1.0
+            # Completion is always reported
+            completed = progress >= 1.0 and self._lastReportedProgress < 1.0
+            if progress - self._lastReportedProgress < self.reportingIncrement and not completed:
+                return
+            self._lastReportedProgress = progress
+        self.callback(f"{self.description}: {progress * 100:.0f}% "
+                      f"({transferredSize / 1024 / 1024:.1f}MB / {self.totalSize / 1024 / 1024:.1f}MB)")
+
+    def trackChunks(self, chunks):
+        """ Generator that passes through data chunks and updates the progress when a chunk has been consumed. """
+        for chunk in chunks:
+            yield chunk
+            self.update(len(chunk))
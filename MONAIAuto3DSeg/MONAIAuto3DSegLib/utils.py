@@ -12,3 +12,13 @@ def humanReadableTimeFromSec(seconds):
     return f"{math.ceil(seconds / 60)} min"
   # Otherwise round up to the nearest 0.1 hour
   return f"{seconds / 3600:.1f} h"
+
+
+def fileSha256(filename, chunkSize=1024 * 1024):
+  """Get SHA-256 hash of the file content as a hexadecimal string"""
+  import hashlib
+  sha256 = hashlib.sha256()
+  with open(filename, "rb") as f:
+    for chunk in iter(lambda: f.read(chunkSize), b""):
+      sha256.update(chunk)
+  return sha256.hexdigest()
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi.concurrency import run_in_threadpool
+
+from MONAIAuto3DSegServer.uploads import UploadError, requestBodyChunks
+
+
+def linkOrCopy(sourcePath, destinationPath):
+    """ Make the file available at destinationPath as a hard link (no data is copied) or as a copy. """
+    try:
+        os.link(sourcePath, destinationPath)
+    except OSError:
+        # file system does not support hard links
+        shutil.copyfile(sourcePath, destinationPath)
+
+
+class LruFileStore:
+    """ Stores files by key in a folder, up to a maximum total size. When the total size exceeds maximumSize,
+        the least recently used files are deleted.
+
+        Files are added and retrieved as hard links (or copies, if the file system does not support hard links),
+        therefore deleting a file from the store does not affect users of the file.
+    """
+
+    def __init__(self, directory, maximumSize=10 * 1024 * 1024 * 1024):
+        """
+        :param directory: folder where files are stored, files that are already in this folder are kept
+        :param maximumSize: maximum total size of files in bytes
+        """
+        self.directory = Path(directory)
+        self.maximumSize = maximumSize
+        self._files = OrderedDict()  # key -> size in bytes, most recently used is the last
+        self.directory.mkdir(parents=True, exist_ok=True)
+        existingFiles = [path for path in self.directory.iterdir() if path.is_file() and self.isValidKey(path.name)]
+        for path in sorted(existingFiles, key=lambda path: path.stat().st_mtime):
+            self._files[path.name] = path.stat().st_size
+        for path in self.directory.glob("*.partial"):
+            # incomplete upload
+            path.unlink()
+
+    @staticmethod
+    def isValidKey(key):
+        """ Keys are SHA-256 hashes (lowercase hexadecimal strings). """
+        return re.fullmatch(r"[0-9a-f]{64}", key) is not None
+
+    @property
+    def totalSize(self):
+        return sum(self._files.values())
+
+    @property
+    def numberOfFiles(self):
+        return len(self._files)
+
+    def contains(self, key):
+        return key in self._files
+
+    def missing(self, keys):
+        """ Get the list of keys that are not in the store. """
+        return [key for key in keys if not self.contains(key)]
+
+    def filePath(self, key):
+        return self.directory / key
+
+    def link(self, key, destinationPath):
+        """ Make the file available at destinationPath.
+        :raises KeyError: if the file is not in the store
+        """
+        if key not in self._files:
+            raise KeyError(key)
+        self._files.move_to_end(key)
+        linkOrCopy(self.filePath(key), destinationPath)
+
+    def add(self, key, sourcePath):
+        """ Add a file to the store (the source file is not modified). """
+        if key in self._files:
+            self._files.move_to_end(key)
+            return
+        partialPath = self.directory / f"{uuid.uuid4().hex}.partial"
+        linkOrCopy(sourcePath, partialPath)
+        os.replace(partialPath, self.filePath(key))
+        self._added(key, self.filePath(key).stat().st_size)
+
+    def _added(self, key, size):
+        self._files[key] = size
+        self._files.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """ Remove least recently used files until the total size is within the limit. The most recent file is kept. """
+        while len(self._files) > 1 and self.totalSize > self.maximumSize:
+            key, _ = self._files.popitem(last=False)
+            logging.debug(f"Removing {key} from {self.directory}")
+            self.filePath(key).unlink(missing_ok=True)
+
+
+class BlobStore(LruFileStore):
+    """ Content-addressed storage of uploaded input files, so that the same image does not have to be uploaded again
+        when it is processed with multiple models. Each blob is identified by the SHA-256 hash of its content.
+    """
+
+    async def receive(self, blobHash, request, maximumUploadSize=0):
+        """ Stream the request body into a new blob. The body may be compressed (see requestBodyChunks),
+        the uncompressed content is verified to match the hash.
+        :raises UploadError: if the content does not match the hash or it is too large
+        """
+        if not self.isValidKey(blobHash):
+            raise UploadError(f"Invalid blob hash: {blobHash}")
+        if maximumUploadSize:
+            contentLength = request.headers.get("Content-Length")
+            if contentLength and contentLength.isdigit() and int(contentLength) > maximumUploadSize:
+                raise UploadError(f"Maximum upload size ({maximumUploadSize / 1024 / 1024:.0f}MB) is exceeded", 413)
+        partialPath = self.directory / f"{uuid.uuid4().hex}.partial"
+        sha256 = hashlib.sha256()
+        size = 0
+
+        def writeChunk(file, chunk):
+            file.write(chunk)
+            sha256.update(chunk)
+
+        try:
+            with await run_in_threadpool(open, partialPath, "wb") as file:
+                async for chunk in requestBodyChunks(request):
+                    size += len(chunk)
+                    if maximumUploadSize and size > maximumUploadSize:
+                        raise UploadError(f"Maximum upload size ({maximumUploadSize / 1024 / 1024:.0f}MB) is exceeded", 413)
+                    await run_in_threadpool(writeChunk, file, chunk)
+            if sha256.hexdigest() != blobHash:
+                raise UploadError(f"Content of the uploaded blob does not match its hash ({blobHash})")
+            os.replace(partialPath, self.filePath(blobHash))
+        finally:
+            if partialPath.exists():
+                partialPath.unlink()
+        self._added(blobHash, size)
+
+
+class UploadSession:
+    """ Blob that is being uploaded in multiple requests (see ResumableUploads). """
+
+    def __init__(self, blobHash, size, directory):
+        self.id = uuid.uuid4().hex
+        self.blobHash = blobHash
+        self.size = size
+        self.path = Path(directory) / f"{self.id}.partial"
+        self.offset = 0  # number of bytes received
+        self.sha256 = hashlib.sha256()  # hash of the received bytes
+        self.lastActivityTime = time.monotonic()
+        self.lock = asyncio.Lock()  # requests of the same session are processed one at a time
+
+    def info(self):
+        return {"upload": self.id, "blob": self.blobHash, "size": self.size, "offset": self.offset,
+                "complete": self.offset == self.size}
+
+
+class ResumableUploads:
+    """ Uploads of blobs in chunks, which can be resumed after the connection is lost: only the data that the server
+        has not received has to be sent again.
+
+        Protocol:
+        1. The client creates an upload session by specifying the hash and size of the blob.
+        2. The client sends the content in chunks, each specifying its offset (which must be the number of bytes
+           received so far). If a request fails then the client queries the offset and continues from there.
+        3. When all the data is received, the content is verified against the hash and the blob is added to the store.
+
+        Sessions that have no activity for sessionTimeout seconds are removed. Completed sessions are kept for
+        completedSessionTimeout seconds and reported as complete, so that a client that did not receive the response
+        to the last chunk (e.g., because the connection was lost) can query that the upload succeeded.
+    """
+
+    def __init__(self, blobStore, sessionTimeout=3600, completedSessionTimeout=600):
+        self.blobStore = blobStore
+        self.sessionTimeout = sessionTimeout
+        self.completedSessionTimeout = completedSessionTimeout
+        self._sessions = {}  # upload id -> UploadSession
+
+    def create(self, blobHash, size, maximumUploadSize=0):
+        """ Start a new upload.
+        :raises UploadError: if the hash or size is invalid
+        """
+        if not self.blobStore.isValidKey(blobHash):
+            raise UploadError(f"Invalid blob hash: {blobHash}")
+        if size <= 0:
+            raise UploadError(f"Invalid blob size: {size}")
+        if maximumUploadSize and size > maximumUploadSize:
+            raise UploadError(f"Maximum upload size ({maximumUploadSize / 1024 / 1024:.0f}MB) is exceeded", 413)
+        self.removeExpiredSessions()
+        session = UploadSession(blobHash, size, self.blobStore.directory)
+        session.path.touch()
+        self._sessions[session.id] = session
+        return session
+
+    def session(self, uploadId):
+        """ Returns None if the upload session is not found. """
+        return self._sessions.get(uploadId)
+
+    def remove(self, uploadId):
+        session = self._sessions.pop(uploadId, None)
+        if session:
+            session.path.unlink(missing_ok=True)
+
+    def removeExpiredSessions(self):
+        now = time.monotonic()
+        for session in list(self._sessions.values()):
+            timeout = self.completedSessionTimeout if session.offset == session.size else self.sessionTimeout
+            if not session.lock.locked() and now - session.lastActivityTime > timeout:
+                logging.debug(f"Upload session {session.id} expired")
+                self.remove(session.id)
+
+    async def append(self, session, offset, request):
+        """ Receive the next chunk of the blob from the request body (that may be compressed, see requestBodyChunks).
+        The chunk is only accepted if it is received completely, therefore the upload can be continued from
+        session.offset after an interrupted request.
+        :raises UploadError: if the offset is not the current offset of the session (status 409) or the content is
+          larger than the declared size or does not match the hash
+        """
+        async with session.lock:
+            session.lastActivityTime = time.monotonic()
+            if offset != session.offset:
+                raise UploadError(f"Upload offset {offset} does not match the received size {session.offset}", 409)
+            if session.offset == session.size:
+                # the client can see from the offset that the upload is complete
+                raise UploadError("Upload is already complete", 409)
+            sha256 = session.sha256.copy()
+            newOffset = session.offset
+
+            def writeChunk(file, chunk):
+                file.write(chunk)
+                sha256.update(chunk)
+
+            with await run_in_threadpool(open, session.path, "r+b") as file:
+                try:
+                    await run_in_threadpool(file.seek, session.offset)
+                    async for chunk in requestBodyChunks(request):
+                        newOffset += len(chunk)
+                        if newOffset > session.size:
+                            raise UploadError(f"Uploaded content is larger than the specified size ({session.size} bytes)")
+                        await run_in_threadpool(writeChunk, file, chunk)
+                except BaseException:
+                    # Incomplete chunk (e.g., the connection was lost), discard the data received in this request
+                    await run_in_threadpool(file.truncate, session.offset)
+                    raise
+
+            # The whole chunk is received
+            session.offset = newOffset
+            session.sha256 = sha256
+            session.lastActivityTime = time.monotonic()
+            if session.offset < session.size:
+                return
+            if session.sha256.hexdigest() != session.blobHash:
+                self.remove(session.id)
+                raise UploadError(f"Content of the uploaded blob does not match its hash ({session.blobHash})")
+            os.replace(session.path, self.blobStore.filePath(session.blobHash))
+            self.blobStore._added(session.blobHash, session.size)
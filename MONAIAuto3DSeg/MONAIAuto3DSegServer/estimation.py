@@ -0,0 +1,171 @@
+import math
+
+from MONAIAuto3DSegLib.nrrd_io import nrrdVoxelSpacing
+
+
+# Approximate number of voxels of the sample images that were used for measuring segmentationTimeSecGPU and
+# segmentationTimeSecCPU values in Models.json (a typical abdominal CT). Estimates are calibrated by actual
+# processing times, therefore this value only matters until the first job of a model is completed.
+REFERENCE_NUMBER_OF_VOXELS = 512 * 512 * 250
+
+# Used if processing time of the model is not specified in Models.json
+DEFAULT_SEGMENTATION_TIME_SEC = 300.0
+
+# Memory used by the inference process before loading any image (Python, PyTorch, MONAI, and the network weights)
+BASELINE_MEMORY_MB = 2000.0
+
+# Memory used by network activations while processing one voxel of the sliding window region of interest
+ROI_BYTES_PER_VOXEL = 400.0
+
+# Used if the model configuration does not specify the region of interest size
+DEFAULT_ROI_SIZE = [224, 224, 144]
+
+
+class ProcessingTimeEstimator:
+    """ Estimates processing time of jobs from the segmentation time of the model (specified in Models.json)
+        scaled by the number of voxels of the input image. The processing time per voxel of each model is calibrated
+        using the measured processing times of completed jobs.
+    """
+
+    # Weight of the most recent measurement in the calibrated processing time per voxel
+    CALIBRATION_WEIGHT = 0.3
+
+    def __init__(self, gpu=False):
+        self.gpu = gpu
+        self._secondsPerVoxel = {}  # model id -> calibrated processing time per voxel
+
+    def _initialSecondsPerVoxel(self, model):
+        segmentationTimeSec = model.get("segmentationTimeSecGPU" if self.gpu else "segmentationTimeSecCPU")
+        if not segmentationTimeSec:
+            segmentationTimeSec = DEFAULT_SEGMENTATION_TIME_SEC
+        return segmentationTimeSec / REFERENCE_NUMBER_OF_VOXELS
+
+    def estimate(self, model, numberOfVoxels=None):
+        """ Estimate processing time (in seconds).
+        :param model: model description dict (see ModelDatabase.models)
+        :param numberOfVoxels: number of voxels of the input image, if unknown then the reference image size is used
+        """
+        if not numberOfVoxels:
+            numberOfVoxels = REFERENCE_NUMBER_OF_VOXELS
+        secondsPerVoxel = self._secondsPerVoxel.get(model["id"])
+        if secondsPerVoxel is None:
+            secondsPerVoxel = self._initialSecondsPerVoxel(model)
+        return secondsPerVoxel * numberOfVoxels
+
+    def update(self, model, numberOfVoxels, processingTime):
+        """ Calibrate the estimator using the measured processing time of a job. """
+        if not numberOfVoxels or processingTime <= 0:
+            return
+        measuredSecondsPerVoxel = processingTime / numberOfVoxels
+        secondsPerVoxel = self._secondsPerVoxel.get(model["id"])
+        if secondsPerVoxel is None:
+            self._secondsPerVoxel[model["id"]] = measuredSecondsPerVoxel
+        else:
+            self._secondsPerVoxel[model["id"]] = ((1.0 - self.CALIBRATION_WEIGHT) * secondsPerVoxel
+                                                  + self.CALIBRATION_WEIGHT * measuredSecondsPerVoxel)
+
+
+def spatialSizes(header):
+    """ Image size along the spatial axes, from a header returned by parseNrrdHeader. """
+    sizes = header["sizes"]
+    spaceDirections = header.get("space directions")
+    if isinstance(spaceDirections, list) and len(spaceDirections) == len(sizes):
+        sizes = [size for size, direction in zip(sizes, spaceDirections) if direction is not None]
+    return sizes
+
+
+def numberOfVoxels(header):
+    """ Number of voxels along the spatial axes, from a header returned by parseNrrdHeader. """
+    return math.prod(spatialSizes(header))
+
+
+def inferenceGeometry(header, modelConfig, numberOfInputs=1, numberOfClasses=None):
+    """ Get sizes of the arrays that are allocated during inference, for estimating memory usage.
+    :param header: header of the (first) input image, returned by parseNrrdHeader
+    :param modelConfig: training configuration of the model (see ModelDatabase.modelConfig)
+    :param numberOfInputs: number of input images (channels)
+    :param numberOfClasses: number of output classes, used if not specified in the model configuration
+    """
+    sizes = spatialSizes(header)
+    spacing = nrrdVoxelSpacing(header)
+    resampleResolution = modelConfig.get("resample_resolution")
+    resampledSizes = list(sizes)
+    if resampleResolution is not None and spacing is not None and len(spacing) == len(sizes) == len(resampleResolution):
+        for axis, (size, axisSpacing, resolution) in enumerate(zip(sizes, spacing, resampleResolution)):
+            # Images are not resampled along an axis if the spacing is already close to the resample resolution
+            if not (0.75 * resolution <= axisSpacing <= 1.25 * resolution):
+                resampledSizes[axis] = math.ceil(size * axisSpacing / resolution)
+    return {
+        "numberOfVoxels": math.prod(sizes),
+        "numberOfResampledVoxels": math.prod(resampledSizes),
+        "numberOfChannels": numberOfInputs,
+        "numberOfClasses": modelConfig.get("output_classes", numberOfClasses) or 2,
+        "sigmoid": bool(modelConfig.get("sigmoid", False)),
+        "numberOfRoiVoxels": math.prod(modelConfig.get("roi_size") or DEFAULT_ROI_SIZE),
+    }
+
+
+class MemoryEstimator:
+    """ Estimates peak memory usage of inference jobs from the input image size, the model's resample resolution,
+        number of output classes, and sliding window region of interest size (see inferenceGeometry).
+
+        The peak is reached when network output (logits) of the resampled image is converted into predictions,
+        so the dominant term is twice the size of the logits array. The estimate of each model is corrected by
+        the ratio of the measured and estimated peak memory usage of completed jobs.
+    """
+
+    # Weight of the most recent measurement in the calibrated correction factor
+    CALIBRATION_WEIGHT = 0.3
+
+    def __init__(self):
+        self._correctionFactors = {}  # model id -> measured / estimated peak memory usage
+
+    @staticmethod
+    def _uncorrectedEstimate(geometry):
+        bytesPerValue = 4  # float32
+        predictionChannels = geometry["numberOfClasses"] if geometry.get("sigmoid") else 1
+        sizeBytes = (
+            # input images: loaded, converted to tensor, resampled, normalized
+            2 * geometry["numberOfVoxels"] * geometry["numberOfChannels"] * bytesPerValue
+            + 2 * geometry["numberOfResampledVoxels"] * geometry["numberOfChannels"] * bytesPerValue
+            # logits and predictions
+            + 2 * geometry["numberOfResampledVoxels"] * geometry["numberOfClasses"] * bytesPerValue
+            # predictions resampled to the input image geometry: one channel per class for sigmoid models,
+            # a single label channel (argmax of the softmax) otherwise
+            + geometry["numberOfVoxels"] * predictionChannels * bytesPerValue
+            # network activations in the sliding window
+            + geometry["numberOfRoiVoxels"] * ROI_BYTES_PER_VOXEL)
+        return BASELINE_MEMORY_MB + sizeBytes / 1024 / 1024
+
+    def estimate(self, model, geometry=None):
+        """ Estimate peak memory usage (in MB).
+        :param model: model description dict (see ModelDatabase.models)
+        :param geometry: array sizes returned by inferenceGeometry, if unknown then the reference image size is used
+        """
+        if geometry is None:
+            geometry = self.referenceGeometry(model)
+        return self._correctionFactors.get(model["id"], 1.0) * self._uncorrectedEstimate(geometry)
+
+    def update(self, model, geometry, peakMemory):
+        """ Calibrate the estimator using the measured peak memory usage (in MB) of a job. """
+        if geometry is None or not peakMemory:
+            return
+        measuredCorrectionFactor = peakMemory / self._uncorrectedEstimate(geometry)
+        correctionFactor = self._correctionFactors.get(model["id"])
+        if correctionFactor is None:
+            self._correctionFactors[model["id"]] = measuredCorrectionFactor
+        else:
+            self._correctionFactors[model["id"]] = ((1.0 - self.CALIBRATION_WEIGHT) * correctionFactor
+                                                    + self.CALIBRATION_WEIGHT * measuredCorrectionFactor)
+
+    @staticmethod
+    def referenceGeometry(model):
+        segmentNames = model.get("segmentNames") or []
+        return {
+            "numberOfVoxels": REFERENCE_NUMBER_OF_VOXELS,
+            "numberOfResampledVoxels": REFERENCE_NUMBER_OF_VOXELS,
+            "numberOfChannels": len(model.get("inputs") or [None]),
+            "numberOfClasses": len(segmentNames) + 1,
+            "sigmoid": False,
+            "numberOfRoiVoxels": math.prod(DEFAULT_ROI_SIZE),
+        }
@@ -0,0 +1,528 @@
+import asyncio
+import importlib.util
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+
+from MONAIAuto3DSegLib.progress import estimateRemainingTime, parseFrameMessage, parseStageMessage
+from MONAIAuto3DSegServer.blobs import linkOrCopy
+from MONAIAuto3DSegServer.estimation import BASELINE_MEMORY_MB, MemoryEstimator, ProcessingTimeEstimator
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINAL_JOB_STATUSES = (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class JobPriority(str, Enum):
+    NORMAL = "normal"
+    HIGH = "high"
+
+
+class CacheStatus(str, Enum):
+    """ Whether the result of a job was computed or reused (reported to clients in the X-Cache response header). """
+    NONE = ""  # job is not cacheable
+    HIT = "hit"  # result was found in the result cache
+    MISS = "miss"  # result is computed
+    COALESCED = "coalesced"  # result of an identical job that was already in progress is reused
+
+
+class JobQueueFullError(RuntimeError):
+    def __init__(self, message, retryAfter=None):
+        super().__init__(message)
+        self.retryAfter = retryAfter  # suggested time to wait before submitting again (in seconds)
+
+
+def inferenceCommand(arguments):
+    """ Get command line for running the inference script with the specified arguments (dict). """
+    inferenceScriptPyFile = Path(__file__).parent.parent / "Scripts" / "auto3dseg_segresnet_inference.py"
+    command = [sys.executable, str(inferenceScriptPyFile)]
+    for name, value in arguments.items():
+        if value is None or value is False:
+            continue
+        option = "--" + name.replace("_", "-")
+        if value is True:
+            command.append(option)
+        else:
+            command.extend([option, value if isinstance(value, str) else json.dumps(value)])
+    return command
+
+
+async def runInferenceProcess(job):
+    """ Run the job by starting a new inference process. """
+    command = inferenceCommand(job.arguments)
+    logging.debug(f"Job {job.id} command: {command}")
+    # Standard error is not captured (it goes to the server console), as it contains progress bars
+    job.process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+    try:
+        async for line in job.process.stdout:
+            text = line.decode(errors="replace").rstrip()
+            job.processOutput(text)
+            print(text, flush=True)
+        returnCode = await job.process.wait()
+        if returnCode != 0:
+            raise subprocess.CalledProcessError(returnCode, command)
+    finally:
+        job.process = None
+
+
+def processMemory(pid):
+    """ Get the memory usage (resident set size, in MB) of a process, including its child processes.
+    Returns None if it is not available (psutil is not installed or the process exited).
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        process = psutil.Process(pid)
+        memoryBytes = process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+    except psutil.Error:
+        return None
+    return memoryBytes / 1024 / 1024
+
+
+async def monitorPeakMemory(job, interval=0.5):
+    """ Record the peak memory usage (resident set size, in MB) of the process of the job, including its child processes,
+    in job.peakMemory. If the process is a reused worker then only the increase over job.baseMemory is recorded.
+    Runs until it is cancelled.
+    """
+    if importlib.util.find_spec("psutil") is None:
+        logging.debug("psutil is not available, memory usage of jobs is not recorded")
+        return
+    while True:
+        if job.process and job.process.returncode is None:
+            memory = processMemory(job.process.pid)
+            if memory is not None:
+                job.peakMemory = max(job.peakMemory or 0.0, memory - (job.baseMemory or 0.0))
+        await asyncio.sleep(interval)
+
+
+@dataclass
+class Job:
+    """ Inference request that is processed in the background. All files of the job are stored in sessionDir.
+        Sequence jobs segment multiple frames (images) in one inference process, result of each frame is available
+        as soon as it is completed.
+    """
+    arguments: dict  # inference script arguments
+    sessionDir: str
+    outputFile: str  # result file (of the last frame, for sequence jobs)
+    modelName: str = ""
+    model: dict = field(default_factory=dict)  # model description (see ModelDatabase.models)
+    numberOfVoxels: int = None  # size of the input image, None if unknown
+    geometry: dict = None  # array sizes for memory usage estimation (see inferenceGeometry), None if unknown
+    clientId: str = ""  # identifies the client (token or address) for fair scheduling
+    cacheKey: str = None  # jobs with the same key produce the same result, None if the result must not be reused
+    cacheStatus: CacheStatus = CacheStatus.NONE
+    priority: JobPriority = JobPriority.NORMAL
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = JobStatus.QUEUED
+    stage: str = ""
+    progress: float = 0.0
+    stageStartTimes: list = field(default_factory=list)  # (stage, start time) of each processing stage
+    error: str = ""
+    estimatedProcessingTime: float = None
+    estimatedMemory: float = None  # estimated peak memory usage in MB
+    peakMemory: float = None  # measured peak memory usage in MB
+    baseMemory: float = None  # memory usage (MB) of a reused worker process when the job started, None if not reused
+    submitTime: float = field(default_factory=time.time)
+    startTime: float = None
+    endTime: float = None
+    process = None  # asyncio.subprocess.Process object that processes the job
+    task = None  # asyncio.Task object
+    runnerTask = None  # asyncio.Task that runs the job runner, cancelled if the job is cancelled before it has a process
+    completed = None  # asyncio.Event object, set when the job is finished (successfully or not)
+    leader = None  # identical job that is in progress, this job gets its result instead of being processed
+    traceSpan: object = None  # span of the job (see MONAIAuto3DSegLib.tracing), None if tracing is disabled
+    frameOutputFiles: list = None  # result file of each frame of a sequence job, None for single image jobs
+    completedFrames: int = 0  # number of frames of a sequence job whose result is available
+
+    @property
+    def finished(self):
+        return self.status in FINAL_JOB_STATUSES
+
+    def setStage(self, stage, progress):
+        """ Update progress reported by the inference process. Start time of each stage is recorded, sub-stages (e.g.,
+        "Inference (window 3/10)") are counted as part of the stage.
+        """
+        stageName = stage.split(" (")[0]
+        if not self.stageStartTimes or self.stageStartTimes[-1][0] != stageName:
+            self.stageStartTimes.append((stageName, time.time()))
+        if self.frameOutputFiles:
+            # Stage and progress are reported for the current frame, convert them to progress of the sequence
+            numberOfFrames = len(self.frameOutputFiles)
+            progress = (min(self.completedFrames, numberOfFrames - 1) + progress) / numberOfFrames
+            stage = f"Frame {min(self.completedFrames + 1, numberOfFrames)}/{numberOfFrames}: {stage}"
+        self.stage, self.progress = stage, progress
+
+    def processOutput(self, text):
+        """ Update the job from a line of inference process output (stage and frame completion messages). """
+        stage = parseStageMessage(text)
+        if stage:
+            self.setStage(*stage)
+            return
+        frameIndex = parseFrameMessage(text)
+        if frameIndex is not None and self.frameOutputFiles:
+            # Frames are processed in order
+            self.completedFrames = max(self.completedFrames, frameIndex + 1)
+
+    def remainingProcessingTime(self):
+        """ Estimated remaining processing time (in seconds) of a running or queued job. """
+        if self.status == JobStatus.RUNNING:
+            remainingTime = estimateRemainingTime(time.time() - self.startTime, self.progress)
+            if remainingTime is not None:
+                return remainingTime
+            return max(0.0, self.estimatedProcessingTime - (time.time() - self.startTime))
+        return self.estimatedProcessingTime
+
+
+class JobManager:
+    """ Runs inference jobs in the background, at most maxConcurrentJobs at a time.
+
+        When a processing slot becomes free, the next job is chosen from the queue by (in order of importance):
+        1. priority: high-priority jobs (urgent reads) are always processed first
+        2. fairness: jobs of clients that have fewer jobs running are preferred, so that a client that submits
+           many jobs cannot occupy all processing slots
+        3. shortest job first with aging: estimated processing time minus agingRate * waiting time, so that quick jobs
+           are processed before long ones, but long jobs are not postponed forever
+
+        Processing time is estimated from the model's typical segmentation time, scaled by the input image size
+        (see ProcessingTimeEstimator).
+
+        If memoryBudget is set then a job is only started if its estimated peak memory usage (see MemoryEstimator)
+        and that of the running jobs fit into the budget, otherwise it waits in the queue. A job that does not fit
+        into the budget even alone is started when no other jobs are running. Peak memory usage of each job is
+        measured to calibrate the estimation.
+
+        Jobs are processed by jobRunner, an async function that gets the job as argument and raises an exception
+        if processing fails. By default, a new inference process is started for each job.
+
+        Results of finished jobs are kept until the job is removed (typically after the client downloaded the result)
+        or until resultRetentionTime elapses.
+
+        If resultCache (LruFileStore) is set then results are also stored in the cache by the cacheKey of the job.
+        A job is not processed if its result is found in the cache. If an identical job (same cacheKey) is already
+        in progress then the job waits for that job and gets its result (the jobs are coalesced).
+    """
+
+    def __init__(self, maxConcurrentJobs=1, maxQueuedJobs=100, maxQueuedJobsPerClient=20, resultRetentionTime=3600,
+                 agingRate=1.0, memoryBudget=0, jobRunner=runInferenceProcess):
+        self.maxConcurrentJobs = maxConcurrentJobs
+        self.maxQueuedJobs = maxQueuedJobs
+        self.maxQueuedJobsPerClient = maxQueuedJobsPerClient
+        self.resultRetentionTime = resultRetentionTime
+        # Waiting time of a job reduces its estimated processing time in the scheduling order by this factor
+        self.agingRate = agingRate
+        # Maximum total estimated peak memory usage of running jobs (MB), 0 means no limit
+        self.memoryBudget = memoryBudget
+        self.jobRunner = jobRunner
+        self.processingTimeEstimator = ProcessingTimeEstimator()
+        self.memoryEstimator = MemoryEstimator()
+        self.resultCache = None
+        self.metrics = None  # ServerMetrics object that records finished jobs
+        self.jobs = {}  # job id -> Job, in submission order
+        # Result cache statistics
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.coalescedJobs = 0
+
+    def job(self, jobId):
+        """ Returns None if the job is not found. """
+        return self.jobs.get(jobId)
+
+    def queuedJobs(self):
+        return [job for job in self.jobs.values() if job.status == JobStatus.QUEUED]
+
+    def runningJobs(self):
+        return [job for job in self.jobs.values() if job.status == JobStatus.RUNNING]
+
+    def submit(self, job):
+        """ Add a job to the queue. Must be called from the event loop of the server.
+        :raises JobQueueFullError: if the job cannot be accepted now, retryAfter attribute contains the suggested
+          time (in seconds) before trying again
+        """
+        self.removeExpiredJobs()
+        job.completed = asyncio.Event()
+        if job.cacheKey and self.resultCache and self.resultCache.contains(job.cacheKey):
+            self.resultCache.link(job.cacheKey, job.outputFile)
+            job.cacheStatus = CacheStatus.HIT
+            self.cacheHits += 1
+            self._completeWithoutProcessing(job)
+            return job
+        leader = self._jobInProgress(job.cacheKey) if job.cacheKey else None
+        if leader:
+            # Coalesced jobs do not add to the server load, therefore queue limits are not checked
+            job.leader = leader
+            job.cacheStatus = CacheStatus.COALESCED
+            self.coalescedJobs += 1
+        else:
+            self._checkQueueLimits(job)
+            if job.cacheKey:
+                job.cacheStatus = CacheStatus.MISS
+                self.cacheMisses += 1
+        model = job.model or {"id": job.modelName}
+        job.estimatedProcessingTime = self.processingTimeEstimator.estimate(model, job.numberOfVoxels)
+        job.estimatedMemory = self.memoryEstimator.estimate(model, job.geometry)
+        if self.memoryBudget and job.estimatedMemory > self.memoryBudget and not job.leader:
+            logging.warning(f"Job {job.id} estimated memory usage ({job.estimatedMemory:.0f}MB) exceeds the memory budget"
+                            f" ({self.memoryBudget}MB), it will be processed when no other jobs are running")
+        self.jobs[job.id] = job
+        self._dispatchJobs()
+        return job
+
+    def _checkQueueLimits(self, job):
+        queuedJobs = [queuedJob for queuedJob in self.queuedJobs() if queuedJob.leader is None]
+        if len(queuedJobs) >= self.maxQueuedJobs:
+            raise JobQueueFullError(f"Maximum number of queued jobs ({self.maxQueuedJobs}) is reached",
+                                    self.estimatedQueueTime())
+        if len([queuedJob for queuedJob in queuedJobs if queuedJob.clientId == job.clientId]) >= self.maxQueuedJobsPerClient:
+            raise JobQueueFullError(f"Maximum number of queued jobs of a client ({self.maxQueuedJobsPerClient}) is reached",
+                                    self.estimatedQueueTime(job.clientId))
+
+    def _jobInProgress(self, cacheKey):
+        """ Get the job that is being processed (or waiting for processing) with the specified cache key. """
+        for job in self.jobs.values():
+            if job.cacheKey == cacheKey and not job.finished and job.leader is None:
+                return job
+        return None
+
+    def _completeWithoutProcessing(self, job):
+        """ Mark the job as succeeded, its output file must already exist. """
+        job.status = JobStatus.SUCCEEDED
+        job.progress = 1.0
+        job.startTime = job.endTime = time.time()
+        self.jobs[job.id] = job
+        job.completed.set()
+        self._recordFinishedJob(job)
+
+    def _recordFinishedJob(self, job):
+        """ Record metrics and end the trace span of a finished job. """
+        if self.metrics:
+            self.metrics.jobFinished(job)
+        if job.traceSpan:
+            if job.cacheStatus != CacheStatus.HIT:
+                # Waiting for a processing slot (or for an identical job, if coalesced)
+                job.traceSpan.tracer.startSpan("queue", parent=job.traceSpan, startTime=job.submitTime).end(job.startTime or job.endTime)
+            job.traceSpan.attributes.update({"job": job.id, "status": job.status.value, "cache": job.cacheStatus.value,
+                                             "peakMemory": job.peakMemory})
+            job.traceSpan.end(job.endTime, error=job.error or None)
+
+    def _releaseFollowers(self, leader):
+        """ Give the result of the finished job to the coalesced jobs that are waiting for it.
+        If the job did not succeed then the waiting jobs are processed instead.
+        """
+        newLeader = None
+        for job in self.queuedJobs():
+            if job.leader is not leader:
+                continue
+            job.leader = None
+            if leader.status == JobStatus.SUCCEEDED:
+                try:
+                    linkOrCopy(leader.outputFile, job.outputFile)
+                    self._completeWithoutProcessing(job)
+                    continue
+                except OSError as err:
+                    logging.warning(f"Failed to reuse result of job {leader.id} for job {job.id}: {err}")
+            # The first waiting job will be processed, the others wait for that
+            job.leader = newLeader
+            if newLeader is None:
+                newLeader = job
+
+    def _schedulingOrder(self):
+        """ Get queued jobs in the order they would be started now. """
+        now = time.time()
+        numberOfRunningJobsPerClient = {}
+        for job in self.runningJobs():
+            numberOfRunningJobsPerClient[job.clientId] = numberOfRunningJobsPerClient.get(job.clientId, 0) + 1
+        def schedulingKey(job):
+            return (
+                0 if job.priority == JobPriority.HIGH else 1,
+                numberOfRunningJobsPerClient.get(job.clientId, 0),
+                job.estimatedProcessingTime - self.agingRate * (now - job.submitTime),
+                job.submitTime)
+        return sorted([job for job in self.queuedJobs() if job.leader is None], key=schedulingKey)
+
+    def usedMemory(self):
+        """ Memory (in MB) reserved by the running jobs. """
+        return sum(max(job.estimatedMemory or 0.0, job.peakMemory or 0.0) for job in self.runningJobs())
+
+    def _fitsIntoMemoryBudget(self, job):
+        if not self.memoryBudget or not self.runningJobs():
+            return True
+        return self.usedMemory() + job.estimatedMemory <= self.memoryBudget
+
+    def _dispatchJobs(self):
+        """ Start the next jobs from the queue while there are free processing slots. """
+        while len(self.runningJobs()) < self.maxConcurrentJobs:
+            schedulingOrder = self._schedulingOrder()
+            if not schedulingOrder:
+                break
+            job = schedulingOrder[0]
+            if not self._fitsIntoMemoryBudget(job):
+                # The job waits until running jobs complete. Smaller jobs are not started instead of it,
+                # as that could postpone large jobs indefinitely.
+                break
+            job.status = JobStatus.RUNNING
+            job.startTime = time.time()
+            job.task = asyncio.create_task(self._runJob(job))
+
+    async def _runJob(self, job):
+        memoryMonitor = asyncio.create_task(monitorPeakMemory(job))
+        try:
+            if job.status == JobStatus.CANCELLED:
+                # cancel() was called before the job started
+                return
+            logging.debug(f"Job {job.id} started")
+            job.runnerTask = asyncio.create_task(self.jobRunner(job))
+            await job.runnerTask
+            if job.status == JobStatus.CANCELLED:
+                # cancel() was called while the job runner was completing, the result must not be used
+                return
+            job.status = JobStatus.SUCCEEDED
+            job.progress = 1.0
+            model = job.model or {"id": job.modelName}
+            self.processingTimeEstimator.update(model, job.numberOfVoxels, time.time() - job.startTime)
+            peakMemory = job.peakMemory
+            if peakMemory and job.baseMemory is not None:
+                # Python, libraries, and models were already loaded in the worker when the job started, so only the
+                # increase was measured. The estimate includes them, as if the job was processed in a new process.
+                peakMemory += BASELINE_MEMORY_MB
+            self.memoryEstimator.update(model, job.geometry, peakMemory)
+            if job.cacheKey and self.resultCache:
+                self.resultCache.add(job.cacheKey, job.outputFile)
+        except asyncio.CancelledError:
+            job.status = JobStatus.CANCELLED
+        except Exception as err:
+            if job.status == JobStatus.CANCELLED:
+                # processing was interrupted by cancel()
+                return
+            logging.info(f"Job {job.id} failed: {err}")
+            job.status = JobStatus.FAILED
+            job.error = str(err)
+        finally:
+            memoryMonitor.cancel()
+            job.endTime = time.time()
+            job.completed.set()
+            self._recordFinishedJob(job)
+            self._releaseFollowers(job)
+            self._dispatchJobs()
+
+    def cancel(self, jobId):
+        """ Stop processing of the job. Results of the job are kept until the job is removed. """
+        job = self.jobs[jobId]
+        if job.finished:
+            return
+        wasQueued = job.status == JobStatus.QUEUED
+        job.status = JobStatus.CANCELLED
+        if wasQueued:
+            # Processing has not started yet
+            job.endTime = time.time()
+            job.completed.set()
+            self._recordFinishedJob(job)
+            self._releaseFollowers(job)
+            self._dispatchJobs()
+            return
+        if job.process and job.process.returncode is None:
+            job.process.kill()
+        elif job.process is None and job.runnerTask and not job.runnerTask.done():
+            # The job runner has not started a process yet (e.g., it is waiting for a worker or starting a process)
+            job.runnerTask.cancel()
+
+    def remove(self, jobId):
+        """ Cancel the job (if it is still in progress) and delete all its files. """
+        if jobId not in self.jobs:
+            return
+        self.cancel(jobId)
+        job = self.jobs.pop(jobId)
+        shutil.rmtree(job.sessionDir, ignore_errors=True)
+
+    def removeExpiredJobs(self):
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if job.finished and now - job.endTime > self.resultRetentionTime:
+                logging.debug(f"Removing expired job {job.id}")
+                self.remove(job.id)
+
+    def estimatedQueueTime(self, clientId=None):
+        """ Estimated time (in seconds) until all running and queued jobs (of the client, if specified) are completed. """
+        jobs = self.runningJobs() + [job for job in self.queuedJobs() if job.leader is None]
+        if clientId is not None:
+            # Jobs of other clients are processed in parallel or interleaved, count only the jobs of this client
+            jobs = [job for job in jobs if job.clientId == clientId]
+        return sum(job.remainingProcessingTime() for job in jobs) / max(1, self.maxConcurrentJobs)
+
+    def queueStatistics(self):
+        """ Get the current load of the server, which clients can use for choosing between multiple servers. """
+        return {
+            # Coalesced jobs are not counted, as they do not need processing
+            "queuedJobs": len([job for job in self.queuedJobs() if job.leader is None]),
+            "runningJobs": len(self.runningJobs()),
+            "maxConcurrentJobs": self.maxConcurrentJobs,
+            "estimatedQueueTime": self.estimatedQueueTime(),
+        }
+
+    def jobInfo(self, job):
+        """ Job status information that can be returned to the client. """
+        info = {
+            "id": job.id,
+            "model": job.modelName,
+            "status": job.status.value,
+            "priority": job.priority.value,
+            "stage": job.stage,
+            "progress": job.progress,
+            "submitTime": job.submitTime,
+            "startTime": job.startTime,
+            "endTime": job.endTime,
+            "error": job.error,
+            "estimatedProcessingTime": job.estimatedProcessingTime,
+            "estimatedMemory": job.estimatedMemory,
+            "peakMemory": job.peakMemory,
+            "cache": job.cacheStatus.value,
+            "queuePosition": None,
+            "eta": None,  # estimated remaining time in seconds
+        }
+        if job.frameOutputFiles:
+            # Results of completed frames can be downloaded while the job is running
+            info["numberOfFrames"] = len(job.frameOutputFiles)
+            info["completedFrames"] = job.completedFrames
+        if job.leader is not None:
+            # Progress of the job is the progress of the identical job that it waits for
+            leaderInfo = self.jobInfo(job.leader)
+            for key in ["status", "stage", "progress", "startTime", "queuePosition", "eta"]:
+                info[key] = leaderInfo[key]
+        elif job.status == JobStatus.QUEUED:
+            schedulingOrder = self._schedulingOrder()
+            queuePosition = schedulingOrder.index(job)
+            info["queuePosition"] = queuePosition
+            # Wait until the running jobs and the jobs ahead in the queue are processed, then process this job
+            jobsAhead = self.runningJobs() + schedulingOrder[:queuePosition]
+            waitingTime = sum(jobAhead.remainingProcessingTime() for jobAhead in jobsAhead) / max(1, self.maxConcurrentJobs)
+            info["eta"] = waitingTime + job.estimatedProcessingTime
+        elif job.status == JobStatus.RUNNING:
+            info["eta"] = job.remainingProcessingTime()
+        return info
+
+    def cacheStatistics(self):
+        """ Get result cache usage and hit/miss counters. """
+        numberOfRequests = self.cacheHits + self.coalescedJobs + self.cacheMisses
+        return {
+            "hits": self.cacheHits,
+            "coalesced": self.coalescedJobs,
+            "misses": self.cacheMisses,
+            "hitRate": (self.cacheHits + self.coalescedJobs) / numberOfRequests if numberOfRequests else None,
+            "numberOfResults": self.resultCache.numberOfFiles if self.resultCache else 0,
+            "size": self.resultCache.totalSize if self.resultCache else 0,
+        }
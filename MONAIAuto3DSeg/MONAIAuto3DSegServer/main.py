@@ -1,4 +1,4 @@
-# pip install python-multipart fastapi slowapi uvicorn[standard]
+# pip install python-multipart fastapi uvicorn[standard]
 
 # usage: uvicorn main:app --host example.com --port 8891
 # usage: uvicorn main:app --host localhost --port 8891
@@ -16,23 +16,122 @@ for path in paths:
     if not path in sys.path:
         sys.path.insert(0, path)
 
+from MONAIAuto3DSegLib.compression import compressChunks, readFileChunks, selectContentEncoding, supportedContentEncodings
+from MONAIAuto3DSegLib.label_runs import LABEL_RUNS_MEDIA_TYPE, encodeLabelRuns
 from MONAIAuto3DSegLib.model_database import ModelDatabase
+from MONAIAuto3DSegLib.nrrd_io import OUTPUT_ENCODINGS, DEFAULT_COMPRESSION_LEVEL, parseImageGeometry, readNrrd, readNrrdHeader
+from MONAIAuto3DSegLib.profiling import parseProfilers
+from MONAIAuto3DSegLib.tracing import JsonFileSpanExporter, TraceContextMiddleware, Tracer, childSpan
+from MONAIAuto3DSegServer.blobs import BlobStore, LruFileStore, ResumableUploads
+from MONAIAuto3DSegServer.estimation import inferenceGeometry, numberOfVoxels
+from MONAIAuto3DSegServer.jobs import Job, JobManager, JobPriority, JobStatus, JobQueueFullError
+from MONAIAuto3DSegServer.metrics import METRICS_MEDIA_TYPE, MetricsMiddleware, ServerMetrics
+from MONAIAuto3DSegServer.uploads import (INPUT_FILES_REQUEST_BODY, SEQUENCE_INPUT_FILES_REQUEST_BODY, MissingBlobsError,
+                                          UploadError, receiveInputFiles, receiveSequenceInputFiles)
+from MONAIAuto3DSegServer.worker_pool import WorkerPool
 
-import shutil
 import asyncio
-import subprocess
-from fastapi import FastAPI, UploadFile, Request
-from fastapi.responses import FileResponse, JSONResponse
+import json
+import math
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from fastapi import Body, FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.background import BackgroundTasks
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 
-limiter = Limiter(key_func=lambda request: "request_per_route_per_minute")
-app = FastAPI()
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+@asynccontextmanager
+async def lifespan(app):
+    # Start the inference workers when the server starts and stop them when the server shuts down
+    jobManager.processingTimeEstimator.gpu = gpuAvailable()
+    workerPool = None
+    if settings.workers > 0:
+        workerPool = WorkerPool(settings.workers, settings.modelCacheSize, settings.modelCacheMemory)
+        await workerPool.start()
+        jobManager.jobRunner = workerPool.runJob
+        jobManager.maxConcurrentJobs = settings.workers
+    app.state.workerPool = workerPool
+    app.state.blobStore = BlobStore(settings.blobStoreDir, settings.blobStoreSize * 1024 * 1024) if settings.blobStoreSize > 0 else None
+    app.state.resumableUploads = ResumableUploads(app.state.blobStore) if app.state.blobStore else None
+    if settings.resultCacheSize > 0:
+        jobManager.resultCache = LruFileStore(settings.resultCacheDir, settings.resultCacheSize * 1024 * 1024)
+    yield
+    if workerPool:
+        await workerPool.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 modelDB = ModelDatabase()
+serverMetrics = ServerMetrics()
+app.add_middleware(MetricsMiddleware, metrics=serverMetrics)
+# Tracing is enabled by setting the trace file (see main())
+tracer = Tracer("server")
+app.add_middleware(TraceContextMiddleware, tracer=tracer)
+
+
+@dataclass
+class ServerSettings:
+    """ Server options, can be changed from the command line (see main()). """
+    # Results are sent over the network, therefore they are compressed by default (using multiple threads)
+    outputEncoding: str = "gzip"
+    compressionLevel: int = DEFAULT_COMPRESSION_LEVEL
+    # Only return the bounding box of non-zero labels
+    cropOutput: bool = True
+    # Number of inference worker processes, which keep models loaded in memory and process one job at a time.
+    # If 0 then a new process is started for each job.
+    workers: int = 1
+    # Maximum number of models and total memory size of models (in MB, 0 = unlimited) kept loaded in each worker
+    modelCacheSize: int = 2
+    modelCacheMemory: int = 4096
+    # Number of inference jobs that are processed at the same time if no workers are used (additional jobs are queued)
+    maxConcurrentJobs: int = 1
+    # Jobs are rejected if this many jobs are already waiting in the queue (in total or from the same client)
+    maxQueuedJobs: int = 100
+    maxQueuedJobsPerClient: int = 20
+    # Each second of waiting reduces the estimated processing time of a queued job by this many seconds when
+    # the next job is selected (prevents long jobs from waiting forever behind short ones)
+    agingRate: float = 1.0
+    # Jobs are only started if their estimated peak memory usage fits into this budget (MB), 0 means no limit
+    memoryBudget: int = 0
+    # Comma-separated list of clients (access tokens or network addresses) that may submit high priority jobs.
+    # High priority requested by other clients is ignored (their jobs get normal priority). Empty = nobody.
+    highPriorityClients: str = ""
+    # Comma-separated list of access tokens that identify clients for fair scheduling and per-client queue limits
+    # (tokens in highPriorityClients are also accepted). Other clients are identified by their network address.
+    clientTokens: str = ""
+    # Requests with larger body are rejected (in MB, 0 = unlimited)
+    maxUploadSize: int = 4096
+    # Uploaded input files are kept (up to this total size, in MB) so that clients do not have to upload the same
+    # image again for processing with another model. 0 = disabled.
+    blobStoreSize: int = 10240
+    blobStoreDir: str = os.path.join(tempfile.gettempdir(), "MONAIAuto3DSegServerBlobs")
+    # Results are kept (up to this total size, in MB) so that repeated requests for the same model, input, and options
+    # do not run the inference again. 0 = disabled.
+    resultCacheSize: int = 4096
+    resultCacheDir: str = os.path.join(tempfile.gettempdir(), "MONAIAuto3DSegServerResults")
+    # Results are deleted if they are not downloaded within this time (in seconds)
+    resultRetentionTime: int = 3600
+    # If set then requests that are part of a client trace and all jobs are recorded as trace spans in this file,
+    # including the stages of the inference (see MONAIAuto3DSegLib.tracing). Empty = disabled.
+    traceFile: str = ""
+    # Profile processing stages of each job ("torch", "cprofile", or "torch,cprofile"; empty = disabled). Chrome trace,
+    # pstats, and summary files are saved in a subfolder of profileDir, named by the job id (they are not removed
+    # automatically).
+    profile: str = ""
+    profileDir: str = os.path.join(tempfile.gettempdir(), "MONAIAuto3DSegServerProfiles")
+
+
+settings = ServerSettings()
+jobManager = JobManager(maxConcurrentJobs=settings.maxConcurrentJobs, maxQueuedJobs=settings.maxQueuedJobs,
+                        maxQueuedJobsPerClient=settings.maxQueuedJobsPerClient,
+                        resultRetentionTime=settings.resultRetentionTime, agingRate=settings.agingRate,
+                        memoryBudget=settings.memoryBudget)
+jobManager.metrics = serverMetrics
 
 # deciding which dependencies to choose
 if "python-real" in Path(sys.executable).name:
@@ -46,12 +145,47 @@ else:
 logging.debug(f"Using {dependencyHandler.__class__.__name__} as dependency handler")
 
 
-def upload(file, session_dir, identifier):
-    extension = "".join(Path(file.filename).suffixes)
-    file_location = str(Path(session_dir) / f"{identifier}{extension}")
-    with open(file_location, "wb+") as file_object:
-        file_object.write(file.file.read())
-    return file_location
+def gpuAvailable():
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        return False
+
+
+def clientList(text):
+    """Get the set of clients from a comma-separated list (see settings.highPriorityClients)"""
+    return {client.strip() for client in text.split(",") if client.strip()}
+
+
+def requestToken(request):
+    """Get the access token from the Authorization header of the request (empty if not provided)"""
+    authorization = request.headers.get("Authorization", "")
+    return authorization[len("Bearer "):] if authorization.lower().startswith("bearer ") else authorization
+
+
+def clientId(request):
+    """Identify the client for fair scheduling: by access token if it is a known token (listed in settings.clientTokens
+    or settings.highPriorityClients), otherwise by network address. Unknown tokens are not used, as otherwise a client
+    could bypass the per-client queue limit by sending a different Authorization header with each request."""
+    token = requestToken(request)
+    if token and token in clientList(settings.clientTokens) | clientList(settings.highPriorityClients):
+        return token
+    return request.client.host if request.client else ""
+
+
+def allowedPriority(request, priority):
+    """High priority is only granted to clients listed in settings.highPriorityClients, as otherwise any client could
+    get its jobs processed before everyone else's. Other clients' jobs are processed with normal priority."""
+    if priority != JobPriority.HIGH:
+        return priority
+    allowedClients = clientList(settings.highPriorityClients)
+    token = requestToken(request)
+    address = request.client.host if request.client else ""
+    if (token and token in allowedClients) or (address and address in allowedClients):
+        return priority
+    logging.info(f"High priority is not enabled for client {address}, job is submitted with normal priority")
+    return JobPriority.NORMAL
 
 
 @app.get("/monaiinfo")
@@ -64,9 +198,71 @@ async def models():
     return modelDB.models
 
 
+def modelPreprocessing(modelName):
+    """Get how input images are preprocessed by the model, None if the model configuration is not available.
+    Clients can use this information for downsampling images to the model resolution before uploading them."""
+    try:
+        modelConfig = modelDB.modelConfig(modelName)
+    except Exception as err:
+        logging.warning(f"Failed to get configuration of model {modelName}: {err}")
+        return None
+    return {
+        # Images are resampled to this spacing (in mm), None if the images are processed at their original spacing
+        "resampleResolution": modelConfig.get("resample_resolution"),
+        # Images are reoriented to RAS axis directions
+        "orientationRas": modelConfig.get("orientation_ras", False),
+        # Images are cropped to the region where intensity is above zero
+        "cropForeground": modelConfig.get("crop_foreground", True),
+    }
+
+
 @app.get("/modelinfo")
 async def getModelInfo(id: str):
-    return modelDB.model(id)
+    """Get model description and preprocessing geometry (see modelPreprocessing)"""
+    model = modelDB.model(id)
+    # Getting the configuration may require downloading the model
+    return {**model, "preprocessing": await run_in_threadpool(modelPreprocessing, id)}
+
+
+@app.get("/workers")
+async def workers(request: Request):
+    """Get state of inference workers and model cache hit/miss counters"""
+    workerPool = request.app.state.workerPool
+    if not workerPool:
+        return {"scheduler": None, "workers": []}
+    return workerPool.status()
+
+
+@app.get("/capabilities")
+async def capabilities():
+    """Get optional features that the server supports.
+    contentEncodings: compression methods that can be used in the Content-Encoding header of uploads (most preferred first)
+    resumableUploads: blobs can be uploaded in chunks (see /uploads endpoints)
+    resultFormats: formats in which segmentation results can be downloaded (see /jobs/{job_id}/result)
+    sequences: all frames of an image sequence can be segmented in a single job (see /sequences)
+    """
+    return {"contentEncodings": supportedContentEncodings(), "resumableUploads": app.state.blobStore is not None,
+            "resultFormats": RESULT_FORMATS, "sequences": app.state.blobStore is not None}
+
+
+@app.get("/queue")
+async def queue():
+    """Get the number of queued and running jobs and the estimated time (in seconds) until they are completed.
+    Clients that can use multiple servers send new jobs to the least loaded server."""
+    return jobManager.queueStatistics()
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Get server metrics in Prometheus text format: queue depth, job and stage durations per model, transferred bytes,
+    rejected requests, result and model cache hits and misses, and memory usage of workers and jobs."""
+    return Response(serverMetrics.format(jobManager, request.app.state.workerPool), media_type=METRICS_MEDIA_TYPE)
+
+
+@app.get("/cache")
+async def cache():
+    """Get result cache usage and hit/miss counters"""
+    return jobManager.cacheStatistics()
 
 
 @app.get("/labelDescriptions")
@@ -74,69 +270,546 @@ def getLabelsFile(id: str):
     return FileResponse(modelDB.modelPath(id).joinpath("labels.csv"), media_type = 'application/octet-stream', filename="labels.csv")
 
 
-@app.post("/infer")
-@limiter.limit("5/minute")
+def resultCacheKey(model, inputHashes, arguments):
+    """Get a key that identifies the result: jobs with the same model (including version), input file contents,
+    and processing options produce the same result"""
+    import hashlib
+    import json
+    options = {name: value for name, value in arguments.items()
+               if name not in ["model_file", "result_file", "trace_file", "traceparent", "profile", "profile_dir"] and not name.startswith("image_file")}
+    key = json.dumps({"model": model["id"], "inputs": inputHashes, "options": options}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def checkOutputGeometry(output_geometry):
+    if output_geometry:
+        try:
+            parseImageGeometry(output_geometry)
+        except ValueError as err:
+            raise UploadError(f"Invalid output_geometry: {err}")
+
+
+def inputGeometry(model_name, model, inputFiles):
+    """Get header of the first input file and array sizes for memory usage estimation (see inferenceGeometry).
+    Returns (None, None) if the input is not a NRRD file. It reads files and may load the model configuration, therefore
+    it should be called in a worker thread (run_in_threadpool) from async endpoints."""
+    try:
+        header = readNrrdHeader(inputFiles[0])
+    except Exception:
+        # not a NRRD file
+        return None, None
+    try:
+        modelConfig = modelDB.modelConfig(model_name)
+    except Exception as err:
+        logging.warning(f"Failed to get configuration of model {model_name}: {err}")
+        modelConfig = {}
+    return header, inferenceGeometry(header, modelConfig, len(inputFiles), len(model.get("segmentNames") or []) + 1)
+
+
+async def createJob(request, model_name, client_id="", priority=JobPriority.NORMAL, output_geometry=None):
+    """Receive input files of the request into a new session folder and create the inference job"""
+    # Check the model and options before receiving the input files
+    model = modelDB.model(model_name)
+    checkOutputGeometry(output_geometry)
+
+    session_dir = tempfile.mkdtemp(dir=tempfile.gettempdir())
+    logging.debug(session_dir)
+
+    # Span of the whole job (until processing is completed), child of the request span if the client sent trace context
+    jobSpan = tracer.startSpan("job", attributes={"model": model_name}) if tracer.enabled else None
+    try:
+        uploadStartTime = time.time()
+        with childSpan("receive input", parent=jobSpan):
+            inputFiles, inputHashes = await receiveInputFiles(request, session_dir, settings.maxUploadSize * 1024 * 1024,
+                                                 request.app.state.blobStore)
+        serverMetrics.stageCompleted(model_name, "upload", time.time() - uploadStartTime)
+
+        # logging.info("Input Files: ", inputFiles)
+
+        outputSegmentationFile = str(Path(session_dir) / "output-segmentation.nrrd")
+
+        modelPath = modelDB.modelPath(model_name)
+        modelPtFile = modelPath.joinpath("model.pt")
+
+        assert os.path.exists(modelPtFile)
+
+        # Inference script arguments
+        auto3DSegArguments = {
+            "model_file": str(modelPtFile),
+            "image_file": inputFiles[0],
+            "result_file": outputSegmentationFile,
+            "output_encoding": settings.outputEncoding,
+            "compression_level": settings.compressionLevel,
+            "crop_output": settings.cropOutput,
+            "post_processing": model.get("postProcessing"),
+            "output_geometry": output_geometry,
+        }
+        for inputIndex in range(1, len(inputFiles)):
+            auto3DSegArguments[f"image_file_{inputIndex + 1}"] = inputFiles[inputIndex]
+        if jobSpan:
+            # Processing steps of the inference script are recorded as children of the job span
+            auto3DSegArguments.update(trace_file=settings.traceFile, traceparent=jobSpan.traceparent)
+        jobId = uuid.uuid4().hex
+        if settings.profile:
+            auto3DSegArguments.update(profile=settings.profile, profile_dir=os.path.join(settings.profileDir, jobId))
+
+        # Image size is used for estimating processing time and memory usage
+        header, geometry = await run_in_threadpool(inputGeometry, model_name, model, inputFiles)
+
+        return Job(id=jobId, arguments=auto3DSegArguments, sessionDir=session_dir, outputFile=outputSegmentationFile,
+                   modelName=model_name, model=model, numberOfVoxels=numberOfVoxels(header) if header else None,
+                   geometry=geometry, clientId=client_id, priority=priority,
+                   cacheKey=resultCacheKey(model, inputHashes, auto3DSegArguments), traceSpan=jobSpan)
+    except Exception as err:
+        if jobSpan:
+            jobSpan.end(error=str(err))
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise
+
+
+async def createSequenceJob(request, model_name, client_id="", priority=JobPriority.NORMAL, output_geometry=None):
+    """Link the input files of all frames of an image sequence (referenced blobs) into a new session folder and create
+    a job that segments all the frames in one inference process"""
+    model = modelDB.model(model_name)
+    checkOutputGeometry(output_geometry)
+
+    session_dir = tempfile.mkdtemp(dir=tempfile.gettempdir())
+    logging.debug(session_dir)
+
+    jobSpan = tracer.startSpan("job", attributes={"model": model_name}) if tracer.enabled else None
+    try:
+        uploadStartTime = time.time()
+        with childSpan("receive input", parent=jobSpan):
+            frameInputs = await receiveSequenceInputFiles(request, session_dir, request.app.state.blobStore)
+        serverMetrics.stageCompleted(model_name, "upload", time.time() - uploadStartTime)
+
+        modelPtFile = modelDB.modelPath(model_name).joinpath("model.pt")
+        assert os.path.exists(modelPtFile)
+
+        # Arguments of each frame, the result is saved next to the input files of the frame
+        frames = []
+        for inputFiles, _ in frameInputs:
+            frame = {"image_file": inputFiles[0],
+                     "result_file": str(Path(inputFiles[0]).parent / "output-segmentation.nrrd")}
+            for inputIndex in range(1, len(inputFiles)):
+                frame[f"image_file_{inputIndex + 1}"] = inputFiles[inputIndex]
+            frames.append(frame)
+
+        # Inference script arguments (see segment_sequence)
+        auto3DSegArguments = {
+            "model_file": str(modelPtFile),
+            "frames": frames,
+            "output_encoding": settings.outputEncoding,
+            "compression_level": settings.compressionLevel,
+            "crop_output": settings.cropOutput,
+            "post_processing": model.get("postProcessing"),
+            "output_geometry": output_geometry,
+        }
+        if jobSpan:
+            jobSpan.setAttribute("numberOfFrames", len(frames))
+            auto3DSegArguments.update(trace_file=settings.traceFile, traceparent=jobSpan.traceparent)
+        jobId = uuid.uuid4().hex
+        if settings.profile:
+            auto3DSegArguments.update(profile=settings.profile, profile_dir=os.path.join(settings.profileDir, jobId))
+
+        # Frames of a sequence have the same size, processing time is proportional to the number of frames
+        header, geometry = await run_in_threadpool(inputGeometry, model_name, model, frameInputs[0][0])
+
+        # Results are not stored in the result cache, as frames are downloaded one by one as soon as they are completed
+        return Job(id=jobId, arguments=auto3DSegArguments, sessionDir=session_dir, outputFile=frames[-1]["result_file"],
+                   modelName=model_name, model=model, numberOfVoxels=numberOfVoxels(header) * len(frames) if header else None,
+                   geometry=geometry, clientId=client_id, priority=priority, traceSpan=jobSpan,
+                   frameOutputFiles=[frame["result_file"] for frame in frames])
+    except Exception as err:
+        if jobSpan:
+            jobSpan.end(error=str(err))
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise
+
+
+def errorResponse(err, status_code=500):
+    import traceback
+    return JSONResponse(
+        content={
+            "error": "An unexpected error occurred",
+            "message": str(err),
+            "traceback": traceback.format_exc()
+        },
+        status_code=status_code
+    )
+
+
+def queueFullResponse(err):
+    serverMetrics.requestRejected("queue_full")
+    retryAfter = max(1, math.ceil(err.retryAfter or 0))
+    return JSONResponse(content={"error": "Server is busy", "message": str(err), "retryAfter": retryAfter},
+                        status_code=429, headers={"Retry-After": str(retryAfter)})
+
+
+def uploadErrorResponse(err):
+    serverMetrics.requestRejected({409: "missing_blobs", 413: "upload_too_large", 415: "unsupported_encoding"}.get(err.statusCode, "invalid_upload"))
+    content = {"error": "Invalid upload", "message": str(err)}
+    if isinstance(err, MissingBlobsError):
+        # the client can upload the missing blobs and try again
+        content["missingBlobs"] = err.missingBlobs
+    return JSONResponse(content=content, status_code=err.statusCode)
+
+
+def invalidResultFormatResponse(result_format):
+    return JSONResponse(content={"error": "Invalid result format", "message": f"Result format {result_format} is not supported. Supported formats: {', '.join(RESULT_FORMATS)}"}, status_code=400)
+
+
+def jobNotFoundResponse(job_id):
+    return JSONResponse(content={"error": "Job not found", "message": f"Job {job_id} does not exist or it has expired"}, status_code=404)
+
+
+def cacheHeaders(job):
+    """Response headers that tell the client if the result was reused from the result cache or from an identical job"""
+    return {"X-Cache": job.cacheStatus.value.upper()} if job.cacheStatus else {}
+
+
+# Formats in which segmentation results can be downloaded:
+# nrrd: labelmap image file, runs: run-length encoded labels in the bounding box of the segmentation (see encodeLabelRuns)
+RESULT_FORMATS = ["nrrd", "runs"]
+
+
+def labelRunsContent(outputFile):
+    """Get result file content in label runs format. Returns None if it is not smaller than the result file."""
+    data, header = readNrrd(outputFile)
+    content = encodeLabelRuns(data, header)
+    return content if len(content) < os.path.getsize(outputFile) else None
+
+
+async def jobResultResponse(job, background_tasks=None, accept_encoding=None, result_format="nrrd", frame_index=None):
+    """Get response to a result request of a finished job, or of a completed frame of a sequence job (frame_index).
+    Uncompressed results are compressed during sending if the client accepts a supported content encoding.
+    If label runs format is requested but it would not be smaller than the NRRD file then the NRRD file is sent,
+    the client can tell the format from the Content-Type header."""
+    if frame_index is None:
+        outputFile = job.outputFile
+        resultAvailable = job.status == JobStatus.SUCCEEDED
+    else:
+        outputFile = job.frameOutputFiles[frame_index]
+        # Frames are available as soon as they are completed, even if processing of later frames failed
+        resultAvailable = frame_index < job.completedFrames and job.status != JobStatus.CANCELLED
+    if resultAvailable:
+        # Background tasks run after the response is sent, which gives the time of sending the result
+        if background_tasks is None:
+            background_tasks = BackgroundTasks()
+        downloadStartTime = time.time()
+        background_tasks.add_task(lambda: serverMetrics.stageCompleted(job.modelName, "download", time.time() - downloadStartTime))
+        if result_format == "runs":
+            content = await run_in_threadpool(labelRunsContent, outputFile)
+            if content is not None:
+                headers = cacheHeaders(job)
+                contentEncoding = selectContentEncoding(accept_encoding) if accept_encoding else None
+                if contentEncoding:
+                    content = await run_in_threadpool(lambda: b"".join(compressChunks([content], contentEncoding)))
+                    headers.update({"Content-Encoding": contentEncoding, "Vary": "Accept-Encoding"})
+                return Response(content, media_type=LABEL_RUNS_MEDIA_TYPE, background=background_tasks, headers=headers)
+        contentEncoding = selectContentEncoding(accept_encoding) if accept_encoding and settings.outputEncoding == "raw" else None
+        if contentEncoding:
+            return StreamingResponse(compressChunks(readFileChunks(outputFile), contentEncoding),
+                                     media_type='application/octet-stream', background=background_tasks,
+                                     headers={"Content-Encoding": contentEncoding, "Vary": "Accept-Encoding", **cacheHeaders(job)})
+        return FileResponse(outputFile, media_type='application/octet-stream', background=background_tasks,
+                            headers=cacheHeaders(job))
+    if job.status == JobStatus.FAILED:
+        return JSONResponse(content={"error": "Processing failed", "message": job.error}, status_code=500)
+    return JSONResponse(content={"error": f"Job is {job.status.value}", "message": "Result is not available",
+                                 **jobManager.jobInfo(job)}, status_code=409)
+
+
+@app.post("/blobs/missing")
+async def missingBlobs(request: Request, blobs: list[str] = Body(embed=True)):
+    """Get which of the specified blobs (SHA-256 hashes of input files) are not available on the server.
+    Only these need to be uploaded (PUT /blobs/{hash}) before they can be referenced in /infer and /jobs requests."""
+    blobStore = request.app.state.blobStore
+    if not blobStore:
+        return JSONResponse(content={"error": "Blob store is disabled", "message": "Input files must be uploaded in the request"}, status_code=404)
+    return {"missingBlobs": blobStore.missing(blobs)}
+
+
+@app.put("/blobs/{blob_hash}", openapi_extra={"requestBody": {"required": True, "content": {"application/octet-stream": {}}}})
+async def uploadBlob(request: Request, blob_hash: str):
+    """Upload an input file. The request body is the file content, blob_hash is its SHA-256 hash."""
+    blobStore = request.app.state.blobStore
+    if not blobStore:
+        return JSONResponse(content={"error": "Blob store is disabled", "message": "Input files must be uploaded in the request"}, status_code=404)
+    if blobStore.contains(blob_hash):
+        return JSONResponse(content={"blob": blob_hash}, status_code=200)
+    try:
+        await blobStore.receive(blob_hash, request, settings.maxUploadSize * 1024 * 1024)
+    except UploadError as err:
+        return uploadErrorResponse(err)
+    return JSONResponse(content={"blob": blob_hash}, status_code=201)
+
+
+def uploadNotFoundResponse(upload_id):
+    return JSONResponse(content={"error": "Upload not found", "message": f"Upload {upload_id} does not exist or it has expired"}, status_code=404)
+
+
+@app.post("/uploads")
+async def createUpload(request: Request, blob: str = Body(), size: int = Body()):
+    """Start a resumable upload of an input file. blob is the SHA-256 hash of the file content, size is its size in bytes.
+    The content is then sent in chunks (PATCH /uploads/{upload_id}). If the connection is lost, the client gets the
+    received size (GET /uploads/{upload_id}) and continues from there. When all the data is received, the file is
+    available as a blob (it can be referenced in /infer and /jobs requests)."""
+    blobStore = request.app.state.blobStore
+    if not blobStore:
+        return JSONResponse(content={"error": "Blob store is disabled", "message": "Input files must be uploaded in the request"}, status_code=404)
+    if blobStore.contains(blob):
+        return JSONResponse(content={"blob": blob, "complete": True}, status_code=200)
+    try:
+        session = request.app.state.resumableUploads.create(blob, size, settings.maxUploadSize * 1024 * 1024)
+    except UploadError as err:
+        return uploadErrorResponse(err)
+    return JSONResponse(content=session.info(), status_code=201)
+
+
+@app.get("/uploads/{upload_id}")
+async def uploadStatus(request: Request, upload_id: str):
+    """Get the number of bytes that the server has received (offset). Completed uploads are reported (complete: true)
+    for some time, so that the client can check the result of the last chunk if it did not receive the response."""
+    resumableUploads = request.app.state.resumableUploads
+    session = resumableUploads.session(upload_id) if resumableUploads else None
+    if not session:
+        return uploadNotFoundResponse(upload_id)
+    return session.info()
+
+
+@app.patch("/uploads/{upload_id}", openapi_extra={"requestBody": {"required": True, "content": {"application/octet-stream": {}}}})
+async def uploadChunk(request: Request, upload_id: str):
+    """Send the next chunk of the file. The Upload-Offset header must be the number of bytes received so far,
+    otherwise the chunk is rejected (status 409, the response contains the expected offset).
+    The chunk may be compressed (Content-Encoding header), the offset refers to the uncompressed content.
+    A chunk is only accepted if it is received completely."""
+    resumableUploads = request.app.state.resumableUploads
+    session = resumableUploads.session(upload_id) if resumableUploads else None
+    if not session:
+        return uploadNotFoundResponse(upload_id)
+    offset = request.headers.get("Upload-Offset", "")
+    if not offset.isdigit():
+        return JSONResponse(content={"error": "Invalid upload", "message": "Upload-Offset header is missing or invalid"}, status_code=400)
+    try:
+        await resumableUploads.append(session, int(offset), request)
+    except UploadError as err:
+        if err.statusCode == 409:
+            # the client can continue from the offset that the server expects
+            return JSONResponse(content={"error": "Invalid upload", "message": str(err), "offset": session.offset}, status_code=409)
+        return uploadErrorResponse(err)
+    return session.info()
+
+
+@app.delete("/uploads/{upload_id}")
+async def cancelUpload(request: Request, upload_id: str):
+    """Cancel an upload and discard the received data"""
+    resumableUploads = request.app.state.resumableUploads
+    if not resumableUploads or not resumableUploads.session(upload_id):
+        return uploadNotFoundResponse(upload_id)
+    resumableUploads.remove(upload_id)
+    return {"upload": upload_id, "cancelled": True}
+
+
+@app.post("/infer", openapi_extra=INPUT_FILES_REQUEST_BODY)
 async def infer(
     request: Request,
     background_tasks: BackgroundTasks,
-    image_file: UploadFile,
     model_name: str,
-    image_file_2: UploadFile = None,
-    image_file_3: UploadFile = None,
-    image_file_4: UploadFile = None
+    output_geometry: str = None,
+    result_format: str = "nrrd"
 ):
-    import tempfile
-    session_dir = tempfile.mkdtemp(dir=tempfile.gettempdir())
-    background_tasks.add_task(shutil.rmtree, session_dir, ignore_errors=False)
+    """Run inference and return the result in the response. The request is kept open until processing is completed,
+    therefore for long computations the /jobs endpoints are recommended.
+    Input images are uploaded as multipart/form-data fields: image_file, image_file_2, image_file_3, image_file_4,
+    or previously uploaded blobs are referenced in a JSON body: {"image_file": {"blob": hash, "filename": name}, ...}.
+    If output_geometry is specified (JSON string, see parseImageGeometry) then the segmentation is resampled to that
+    voxel grid. This allows uploading a downsampled image and still getting the result in the original voxel grid.
+    result_format: nrrd (labelmap file) or runs (run-length encoded labels, typically much smaller), see /jobs/{job_id}/result."""
+    if result_format not in RESULT_FORMATS:
+        return invalidResultFormatResponse(result_format)
+    job = None
+    try:
+        job = await createJob(request, model_name, clientId(request), output_geometry=output_geometry)
+        jobManager.submit(job)
+        background_tasks.add_task(jobManager.remove, job.id)
+        await job.completed.wait()
+        return await jobResultResponse(job, background_tasks, request.headers.get("Accept-Encoding"), result_format)
+    except JobQueueFullError as err:
+        if job.traceSpan:
+            job.traceSpan.end(error=str(err))
+        shutil.rmtree(job.sessionDir, ignore_errors=True)
+        return queueFullResponse(err)
+    except UploadError as err:
+        return uploadErrorResponse(err)
+    except Exception as err:
+        logging.info(err)
+        if job:
+            jobManager.remove(job.id)
+        return errorResponse(err)
 
-    logging.debug(session_dir)
-    inputFiles = list()
-    inputFiles.append(upload(image_file, session_dir, "image_file"))
-    if image_file_2:
-        inputFiles.append(upload(image_file_2, session_dir, "image_file_2"))
-    if image_file_3:
-        inputFiles.append(upload(image_file_3, session_dir, "image_file_3"))
-    if image_file_4:
-        inputFiles.append(upload(image_file_4, session_dir, "image_file_4"))
-
-    # logging.info("Input Files: ", inputFiles)
-
-    outputSegmentationFile = str(Path(session_dir) / "output-segmentation.nrrd")
-
-    modelPath = modelDB.modelPath(model_name)
-    modelPtFile = modelPath.joinpath("model.pt")
-
-    assert os.path.exists(modelPtFile)
-
-    moduleDir = Path(__file__).parent.parent
-    inferenceScriptPyFile = os.path.join(moduleDir, "Scripts", "auto3dseg_segresnet_inference.py")
-    auto3DSegCommand = [sys.executable, str(inferenceScriptPyFile),
-                        "--model-file", str(modelPtFile),
-                        "--image-file", inputFiles[0],
-                        "--result-file", outputSegmentationFile]
-    for inputIndex in range(1, len(inputFiles)):
-        auto3DSegCommand.append(f"--image-file-{inputIndex + 1}")
-        auto3DSegCommand.append(inputFiles[inputIndex])
 
+@app.post("/jobs", openapi_extra=INPUT_FILES_REQUEST_BODY)
+async def submitJob(
+    request: Request,
+    model_name: str,
+    priority: JobPriority = JobPriority.NORMAL,
+    output_geometry: str = None
+):
+    """Submit an inference job. Returns immediately, job status can be queried by the returned job id.
+    Input images are uploaded as multipart/form-data fields: image_file, image_file_2, image_file_3, image_file_4,
+    or previously uploaded blobs are referenced in a JSON body: {"image_file": {"blob": hash, "filename": name}, ...}.
+    High priority jobs (priority=high) are processed before all normal priority jobs. High priority is only granted
+    to clients that are allowed to use it (see --high-priority-clients), other jobs get normal priority.
+    If output_geometry is specified then the segmentation is resampled to that voxel grid (see /infer)."""
+    job = None
     try:
-        logging.debug(auto3DSegCommand)
-        proc = await asyncio.create_subprocess_exec(*auto3DSegCommand)
-        await proc.wait()
-        if proc.returncode != 0:
-            raise subprocess.CalledProcessError(proc.returncode, auto3DSegCommand)
-        return FileResponse(outputSegmentationFile, media_type='application/octet-stream', background=background_tasks)
+        job = await createJob(request, model_name, clientId(request), allowedPriority(request, priority),
+                                output_geometry)
+        jobManager.submit(job)
+    except JobQueueFullError as err:
+        if job.traceSpan:
+            job.traceSpan.end(error=str(err))
+        shutil.rmtree(job.sessionDir, ignore_errors=True)
+        return queueFullResponse(err)
+    except UploadError as err:
+        return uploadErrorResponse(err)
     except Exception as err:
         logging.info(err)
-        shutil.rmtree(session_dir)
-        import traceback
-        return JSONResponse(
-            content={
-                "error": "An unexpected error occurred",
-                "message": str(err),
-                "traceback": traceback.format_exc()
-            },
-            status_code=500
-        )
+        if job:
+            shutil.rmtree(job.sessionDir, ignore_errors=True)
+        return errorResponse(err)
+    return JSONResponse(content=jobManager.jobInfo(job), status_code=202,
+                        headers={"Location": f"/jobs/{job.id}", **cacheHeaders(job)})
+
+
+@app.post("/sequences", openapi_extra=SEQUENCE_INPUT_FILES_REQUEST_BODY)
+async def submitSequenceJob(
+    request: Request,
+    model_name: str,
+    priority: JobPriority = JobPriority.NORMAL,
+    output_geometry: str = None
+):
+    """Submit a job that segments all frames of an image sequence (such as a cardiac or perfusion time series).
+    The model is loaded only once for all frames, and the result of each frame can be downloaded as soon as it is
+    completed (GET /jobs/{job_id}/frames/{frame_index}/result), while the next frames are processed.
+    Input images of the frames are previously uploaded blobs (see /blobs and /uploads endpoints), referenced in a JSON
+    body: {"frames": [{"image_file": {"blob": hash, "filename": name}, ...}, ...]}. Frames that have the same content
+    only need to be uploaded once.
+    Job status (GET /jobs/{job_id}, /jobs/{job_id}/events) contains numberOfFrames and completedFrames,
+    progress is the progress of the whole sequence. If output_geometry is specified then the segmentation of each frame
+    is resampled to that voxel grid (see /infer). Priority is handled the same way as for /jobs."""
+    if not request.app.state.blobStore:
+        return JSONResponse(content={"error": "Blob store is disabled", "message": "Sequences can only be processed if the server stores uploaded input files"}, status_code=404)
+    job = None
+    try:
+        job = await createSequenceJob(request, model_name, clientId(request),
+                                        allowedPriority(request, priority), output_geometry)
+        jobManager.submit(job)
+    except JobQueueFullError as err:
+        if job.traceSpan:
+            job.traceSpan.end(error=str(err))
+        shutil.rmtree(job.sessionDir, ignore_errors=True)
+        return queueFullResponse(err)
+    except UploadError as err:
+        return uploadErrorResponse(err)
+    except Exception as err:
+        logging.info(err)
+        if job:
+            shutil.rmtree(job.sessionDir, ignore_errors=True)
+        return errorResponse(err)
+    return JSONResponse(content=jobManager.jobInfo(job), status_code=202, headers={"Location": f"/jobs/{job.id}"})
+
+
+@app.get("/jobs/{job_id}")
+async def getJob(job_id: str):
+    """Get status, stage, progress, and estimated remaining time of a job"""
+    job = jobManager.job(job_id)
+    if not job:
+        return jobNotFoundResponse(job_id)
+    return jobManager.jobInfo(job)
+
+
+# Job status is checked this often (in seconds) for changes that are sent to event stream subscribers
+JOB_EVENT_CHECK_INTERVAL = 0.5
+# An event is sent at least this often (in seconds), even if the job status has not changed, to refresh the estimated
+# remaining time and to allow the client to detect lost connections
+JOB_EVENT_KEEPALIVE_INTERVAL = 2.0
+
+
+async def jobEventStream(job):
+    """Async generator of server-sent events that contain the job status information (see JobManager.jobInfo).
+    An event is sent when status, stage, progress, or queue position changes. The stream ends when the job is finished."""
+    lastState = None
+    lastEventTime = 0.0
+    while True:
+        info = jobManager.jobInfo(job)
+        state = (info["status"], info["stage"], info["progress"], info["queuePosition"], info.get("completedFrames"))
+        if state != lastState or time.monotonic() - lastEventTime >= JOB_EVENT_KEEPALIVE_INTERVAL:
+            yield f"event: status\ndata: {json.dumps(info)}\n\n"
+            lastState = state
+            lastEventTime = time.monotonic()
+        if job.finished:
+            return
+        try:
+            await asyncio.wait_for(job.completed.wait(), JOB_EVENT_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+@app.get("/jobs/{job_id}/events")
+async def getJobEvents(job_id: str):
+    """Stream job status updates as server-sent events (text/event-stream), until the job is finished.
+    Each "status" event contains the same information as GET /jobs/{job_id}: queue position while the job is queued,
+    then processing stage (including sliding window progress of the inference), progress, and estimated remaining time.
+    For sequence jobs, an event is sent when a frame is completed (completedFrames), so that its result can be downloaded."""
+    job = jobManager.job(job_id)
+    if not job:
+        return jobNotFoundResponse(job_id)
+    return StreamingResponse(jobEventStream(job), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{job_id}/result")
+async def getJobResult(request: Request, job_id: str, result_format: str = "nrrd"):
+    """Download result of a completed job.
+    result_format: nrrd (labelmap file, application/octet-stream) or runs (application/x-monaiauto3dseg-label-runs,
+    run-length encoded labels in the bounding box of the segmentation). The NRRD file is sent if label runs would not
+    be smaller, the format of the response is indicated by its Content-Type."""
+    if result_format not in RESULT_FORMATS:
+        return invalidResultFormatResponse(result_format)
+    job = jobManager.job(job_id)
+    if not job:
+        return jobNotFoundResponse(job_id)
+    if job.frameOutputFiles:
+        return JSONResponse(content={"error": "Sequence job", "message": f"Results of sequence jobs are downloaded by frame: /jobs/{job_id}/frames/{{frame_index}}/result"}, status_code=400)
+    return await jobResultResponse(job, accept_encoding=request.headers.get("Accept-Encoding"), result_format=result_format)
+
+
+@app.get("/jobs/{job_id}/frames/{frame_index}/result")
+async def getJobFrameResult(request: Request, job_id: str, frame_index: int, result_format: str = "nrrd"):
+    """Download result of a completed frame of a sequence job (frame_index starts from 0). Frames are completed in order,
+    the number of completed frames is reported in the job status (completedFrames). Result formats are the same as
+    in /jobs/{job_id}/result. Status 409 is returned if the frame is not completed yet."""
+    if result_format not in RESULT_FORMATS:
+        return invalidResultFormatResponse(result_format)
+    job = jobManager.job(job_id)
+    if not job:
+        return jobNotFoundResponse(job_id)
+    if not job.frameOutputFiles or not 0 <= frame_index < len(job.frameOutputFiles):
+        return JSONResponse(content={"error": "Frame not found", "message": f"Job {job_id} does not have frame {frame_index}"}, status_code=404)
+    return await jobResultResponse(job, accept_encoding=request.headers.get("Accept-Encoding"), result_format=result_format,
+                                   frame_index=frame_index)
+
+
+@app.delete("/jobs/{job_id}")
+async def deleteJob(job_id: str):
+    """Cancel the job (if it is not completed yet) and delete its results"""
+    job = jobManager.job(job_id)
+    if not job:
+        return jobNotFoundResponse(job_id)
+    jobManager.remove(job_id)
+    return jobManager.jobInfo(job)
 
 
 def main(argv):
@@ -144,12 +817,93 @@ def main(argv):
     parser = argparse.ArgumentParser(description="MONAIAuto3DSeg server")
     parser.add_argument("-ip", "--host", type=str, metavar="PATH", required=False, default="localhost", help="host name")
     parser.add_argument("-p", "--port", type=int, metavar="PATH", required=True, help="port")
+    parser.add_argument("--output-encoding", type=str, choices=OUTPUT_ENCODINGS, default=settings.outputEncoding,
+                        help="encoding of the returned segmentation file")
+    parser.add_argument("--compression-level", type=int, default=settings.compressionLevel,
+                        help="compression level (1-9) of the returned segmentation file")
+    parser.add_argument("--crop-output", action=argparse.BooleanOptionalAction, default=settings.cropOutput,
+                        help="only return the bounding box of non-zero labels")
+    parser.add_argument("--workers", type=int, default=settings.workers,
+                        help="number of inference worker processes that keep models loaded (0 = new process for each job)")
+    parser.add_argument("--model-cache-size", type=int, default=settings.modelCacheSize,
+                        help="maximum number of models kept loaded in each worker")
+    parser.add_argument("--model-cache-memory", type=int, default=settings.modelCacheMemory,
+                        help="maximum total size of models kept loaded in each worker (MB, 0 = unlimited)")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=settings.maxConcurrentJobs,
+                        help="number of inference jobs that are processed at the same time if no workers are used")
+    parser.add_argument("--max-queued-jobs", type=int, default=settings.maxQueuedJobs,
+                        help="maximum number of jobs waiting for processing")
+    parser.add_argument("--max-queued-jobs-per-client", type=int, default=settings.maxQueuedJobsPerClient,
+                        help="maximum number of jobs of a single client waiting for processing")
+    parser.add_argument("--max-upload-size", type=int, default=settings.maxUploadSize,
+                        help="maximum size of uploaded input files in a request (MB), 0 means no limit")
+    parser.add_argument("--blob-store-size", type=int, default=settings.blobStoreSize,
+                        help="maximum total size of uploaded input files that are kept for reuse (MB), 0 disables reuse")
+    parser.add_argument("--blob-store-dir", type=str, default=settings.blobStoreDir,
+                        help="folder for storing uploaded input files that are kept for reuse")
+    parser.add_argument("--result-cache-size", type=int, default=settings.resultCacheSize,
+                        help="maximum total size of results that are kept for repeated requests (MB), 0 disables caching")
+    parser.add_argument("--result-cache-dir", type=str, default=settings.resultCacheDir,
+                        help="folder for storing results that are kept for repeated requests")
+    parser.add_argument("--memory-budget", type=int, default=settings.memoryBudget,
+                        help="maximum total estimated memory usage of running jobs (MB), 0 means no limit")
+    parser.add_argument("--high-priority-clients", type=str, default=settings.highPriorityClients,
+                        help="comma-separated access tokens or network addresses of clients that may submit high priority jobs")
+    parser.add_argument("--client-tokens", type=str, default=settings.clientTokens,
+                        help="comma-separated access tokens that identify clients for fair scheduling (other clients are identified by network address)")
+    parser.add_argument("--aging-rate", type=float, default=settings.agingRate,
+                        help="priority increase of queued jobs per second of waiting (in seconds of estimated processing time)")
+    parser.add_argument("--result-retention-time", type=int, default=settings.resultRetentionTime,
+                        help="time (in seconds) after results of completed jobs are deleted if not downloaded")
+    parser.add_argument("--trace-file", type=str, default=settings.traceFile,
+                        help="record timing of traced requests and of all jobs as trace spans in this file (JSON Lines)")
+    parser.add_argument("--profile", type=str, default=settings.profile,
+                        help="profile processing stages of each job: torch, cprofile, or torch,cprofile (slows down processing)")
+    parser.add_argument("--profile-dir", type=str, default=settings.profileDir,
+                        help="folder for storing profiling results (in a subfolder for each job)")
 
     args = parser.parse_args(argv)
 
+    settings.outputEncoding = args.output_encoding
+    settings.compressionLevel = args.compression_level
+    settings.cropOutput = args.crop_output
+    settings.workers = args.workers
+    settings.modelCacheSize = args.model_cache_size
+    settings.modelCacheMemory = args.model_cache_memory
+    settings.maxConcurrentJobs = args.max_concurrent_jobs
+    settings.maxQueuedJobs = args.max_queued_jobs
+    settings.maxQueuedJobsPerClient = args.max_queued_jobs_per_client
+    settings.agingRate = args.aging_rate
+    settings.memoryBudget = args.memory_budget
+    settings.highPriorityClients = args.high_priority_clients
+    settings.clientTokens = args.client_tokens
+    settings.maxUploadSize = args.max_upload_size
+    settings.blobStoreSize = args.blob_store_size
+    settings.blobStoreDir = args.blob_store_dir
+    settings.resultCacheSize = args.result_cache_size
+    settings.resultCacheDir = args.result_cache_dir
+    settings.resultRetentionTime = args.result_retention_time
+    settings.traceFile = args.trace_file
+    settings.profile = args.profile
+    settings.profileDir = args.profile_dir
+    try:
+        # Fail early if the profiler name is invalid, instead of failing each job
+        parseProfilers(settings.profile)
+    except ValueError as err:
+        parser.error(str(err))
+
+    jobManager.maxConcurrentJobs = settings.maxConcurrentJobs
+    jobManager.maxQueuedJobs = settings.maxQueuedJobs
+    jobManager.maxQueuedJobsPerClient = settings.maxQueuedJobsPerClient
+    jobManager.agingRate = settings.agingRate
+    jobManager.memoryBudget = settings.memoryBudget
+    jobManager.resultRetentionTime = settings.resultRetentionTime
+    tracer.exporter = JsonFileSpanExporter(settings.traceFile) if settings.traceFile else None
+
     import uvicorn
     # NB: reload=True causing issues on Windows (https://stackoverflow.com/a/70570250)
-    uvicorn.run("main:app", host=args.host, port=args.port, log_level="debug", reload=False)
+    # The app object is passed (instead of "main:app") so that the settings specified above are used.
+    uvicorn.run(app, host=args.host, port=args.port, log_level="debug", reload=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+import bisect
+import threading
+import time
+
+from MONAIAuto3DSegServer.jobs import CacheStatus
+
+
+# Media type of the Prometheus text exposition format
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRIC_NAME_PREFIX = "monaiauto3dseg_"
+
+# Histogram bucket upper bounds for durations (in seconds), from short requests to long CPU inference
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0]
+
+# Histogram bucket upper bounds for memory usage (in MB)
+MEMORY_BUCKETS = [256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = {name: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def formatMetric(name, metricType, description, samples):
+    """ Get a metric in Prometheus text format.
+    :param samples: list of (labels dict, value) or (name suffix, labels dict, value)
+    """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {metricType}"]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+        lines.append(f"{name}{suffix}{_formatLabels(labels)} {_formatValue(value)}")
+    return "\n".join(lines)
+
+
+class Counter:
+    """ Monotonically increasing value for each combination of label values. Thread-safe. """
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(labels.get(labelName, "") for labelName in self.labelNames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def format(self):
+        with self._lock:
+            samples = [(dict(zip(self.labelNames, key)), value) for key, value in sorted(self._values.items())]
+        return formatMetric(self.name, "counter", self.description, samples)
+
+
+class Histogram:
+    """ Distribution of observed values (count of values in each bucket, sum, and count) for each combination of
+        label values. Thread-safe.
+    """
+
+    def __init__(self, name, description, labelNames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self.buckets = sorted(buckets)
+        self._values = {}  # label values tuple -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(labelName, "") for labelName in self.labelNames)
+        with self._lock:
+            values = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            bucketIndex = bisect.bisect_left(self.buckets, value)
+            if bucketIndex < len(self.buckets):
+                values[bucketIndex] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def format(self):
+        samples = []
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                labels = dict(zip(self.labelNames, key))
+                cumulativeCount = 0
+                for upperBound, bucketCount in zip(self.buckets, values):
+                    cumulativeCount += bucketCount
+                    samples.append(("_bucket", {**labels, "le": _formatValue(upperBound)}, cumulativeCount))
+                samples.append(("_bucket", {**labels, "le": "+Inf"}, values[-1]))
+                samples.append(("_sum", labels, values[-2]))
+                samples.append(("_count", labels, values[-1]))
+        return formatMetric(self.name, "histogram", self.description, samples)
+
+
+def stageMetricName(stage):
+    """ Get stage name for metrics labels from a processing stage (e.g., "Inference (window 3/10)" -> "inference"). """
+    return stage.split(" (")[0].strip().lower().replace(" ", "_").replace("-", "_")
+
+
+class ServerMetrics:
+    """ Metrics of the inference server in Prometheus format, for monitoring and capacity planning.
+
+        Events (requests, finished jobs, rejected requests) are recorded as they happen. Current state
+        (queue, workers, caches) is collected when the metrics are requested.
+
+        Job durations are recorded by stage: upload (receiving the input files), queue (waiting for a processing slot),
+        processing stages reported by the inference script (loading_model, preprocessing, inference, post_processing,
+        saving), and download (sending the result).
+    """
+
+    def __init__(self):
+        prefix = METRIC_NAME_PREFIX
+        self.requests = Counter(prefix + "http_requests_total", "Number of HTTP requests", ("endpoint", "status"))
+        self.requestDuration = Histogram(prefix + "http_request_duration_seconds",
+                                         "Time from receiving the request until the response is sent", ("endpoint",))
+        self.receivedBytes = Counter(prefix + "http_received_bytes_total", "Size of received request bodies", ("endpoint",))
+        self.sentBytes = Counter(prefix + "http_sent_bytes_total", "Size of sent response bodies", ("endpoint",))
+        self.rejectedRequests = Counter(prefix + "rejected_requests_total",
+                                        "Number of requests that were rejected (queue full, invalid or too large upload)",
+                                        ("reason",))
+        self.jobs = Counter(prefix + "jobs_total", "Number of finished jobs", ("model", "status", "cache"))
+        self.stageDuration = Histogram(prefix + "job_stage_duration_seconds", "Duration of job processing stages",
+                                       ("model", "stage"))
+        self.jobDuration = Histogram(prefix + "job_duration_seconds",
+                                     "Time from submitting the job until processing is completed", ("model", "status"))
+        self.jobPeakMemory = Histogram(prefix + "job_peak_memory_megabytes",
+                                       "Peak memory usage of the process that processed the job", ("model",), MEMORY_BUCKETS)
+
+    def requestCompleted(self, endpoint, status, duration, receivedBytes, sentBytes):
+        self.requests.inc(endpoint=endpoint, status=status)
+        self.requestDuration.observe(duration, endpoint=endpoint)
+        self.receivedBytes.inc(receivedBytes, endpoint=endpoint)
+        self.sentBytes.inc(sentBytes, endpoint=endpoint)
+
+    def requestRejected(self, reason):
+        self.rejectedRequests.inc(reason=reason)
+
+    def stageCompleted(self, modelName, stage, duration):
+        self.stageDuration.observe(duration, model=modelName, stage=stage)
+
+    def jobFinished(self, job):
+        """ Record metrics of a finished job (processed, cancelled, or completed by reusing a result). """
+        self.jobs.inc(model=job.modelName, status=job.status.value, cache=job.cacheStatus.value or "none")
+        if job.cacheStatus in (CacheStatus.HIT, CacheStatus.COALESCED) or job.startTime is None or job.endTime is None:
+            # Result was not computed by this job
+            return
+        self.stageCompleted(job.modelName, "queue", job.startTime - job.submitTime)
+        stageStartTimes = job.stageStartTimes + [(None, job.endTime)]
+        for (stage, startTime), (_, endTime) in zip(stageStartTimes[:-1], stageStartTimes[1:]):
+            self.stageCompleted(job.modelName, stageMetricName(stage), endTime - startTime)
+        self.jobDuration.observe(job.endTime - job.submitTime, model=job.modelName, status=job.status.value)
+        if job.peakMemory:
+            self.jobPeakMemory.observe(job.peakMemory, model=job.modelName)
+
+    def format(self, jobManager, workerPool=None):
+        """ Get all metrics in Prometheus text format. """
+        prefix = METRIC_NAME_PREFIX
+        queueStatistics = jobManager.queueStatistics()
+        cacheStatistics = jobManager.cacheStatistics()
+        metrics = [
+            formatMetric(prefix + "queued_jobs", "gauge", "Number of jobs waiting for processing",
+                         [({}, queueStatistics["queuedJobs"])]),
+            formatMetric(prefix + "running_jobs", "gauge", "Number of jobs being processed",
+                         [({}, queueStatistics["runningJobs"])]),
+            formatMetric(prefix + "max_concurrent_jobs", "gauge", "Maximum number of jobs processed at the same time",
+                         [({}, queueStatistics["maxConcurrentJobs"])]),
+            formatMetric(prefix + "estimated_queue_time_seconds", "gauge",
+                         "Estimated time until all queued and running jobs are completed",
+                         [({}, queueStatistics["estimatedQueueTime"])]),
+            formatMetric(prefix + "used_memory_megabytes", "gauge", "Memory reserved by running jobs (estimated or measured)",
+                         [({}, jobManager.usedMemory())]),
+            formatMetric(prefix + "result_cache_requests_total", "counter", "Result cache lookups of cacheable jobs",
+                         [({"result": "hit"}, cacheStatistics["hits"]), ({"result": "coalesced"}, cacheStatistics["coalesced"]),
+                          ({"result": "miss"}, cacheStatistics["misses"])]),
+            formatMetric(prefix + "result_cache_size_bytes", "gauge", "Total size of results stored in the result cache",
+                         [({}, cacheStatistics["size"])]),
+        ]
+        if workerPool:
+            workerPoolStatus = workerPool.status()
+            modelCacheStatistics = workerPoolStatus["scheduler"]
+            metrics.append(formatMetric(prefix + "model_cache_requests_total", "counter",
+                                        "Jobs that found their model already loaded in a worker (hit) or had to load it (miss)",
+                                        [({"result": "hit"}, modelCacheStatistics["hits"]),
+                                         ({"result": "miss"}, modelCacheStatistics["misses"])]))
+            metrics.append(formatMetric(prefix + "model_cache_evictions_total", "counter",
+                                        "Models unloaded from workers to make room for other models",
+                                        [({}, modelCacheStatistics["evictions"])]))
+            metrics.append(formatMetric(prefix + "worker_busy", "gauge", "Whether the inference worker is processing a job",
+                                        [({"worker": worker["index"]}, int(worker["busy"])) for worker in workerPoolStatus["workers"]]))
+            workerMemory = self._workerMemory(workerPool)
+            if workerMemory:
+                metrics.append(formatMetric(prefix + "worker_memory_megabytes", "gauge",
+                                            "Memory usage (resident set size) of the inference worker process",
+                                            [({"worker": index}, memory) for index, memory in workerMemory.items()]))
+        metrics += [metric.format() for metric in [self.requests, self.requestDuration, self.receivedBytes, self.sentBytes,
+                                                   self.rejectedRequests, self.jobs, self.stageDuration, self.jobDuration,
+                                                   self.jobPeakMemory]]
+        return "\n".join(metrics) + "\n"
+
+    @staticmethod
+    def _workerMemory(workerPool):
+        """ Get memory usage (in MB) of each running worker process, including its child processes.
+        Returns an empty dict if psutil is not available.
+        """
+        try:
+            import psutil
+        except ImportError:
+            return {}
+        workerMemory = {}
+        for worker in workerPool.workers:
+            if not worker.isAlive:
+                continue
+            try:
+                process = psutil.Process(worker.process.pid)
+                memoryBytes = process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+                workerMemory[worker.index] = memoryBytes / 1024 / 1024
+            except psutil.Error:
+                pass
+        return workerMemory
+
+
+class MetricsMiddleware:
+    """ ASGI middleware that records duration, status, and transferred bytes of HTTP requests in ServerMetrics.
+        Requests are labelled by their route (e.g., /jobs/{job_id}), so that the number of label values is bounded.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        startTime = time.perf_counter()
+        transfer = {"received": 0, "sent": 0, "status": 500}
+
+        async def receiveAndCount():
+            message = await receive()
+            if message["type"] == "http.request":
+                transfer["received"] += len(message.get("body", b""))
+            return message
+
+        async def sendAndCount(message):
+            if message["type"] == "http.response.start":
+                transfer["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                transfer["sent"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receiveAndCount, sendAndCount)
+        finally:
+            route = scope.get("route")
+            endpoint = f"{scope['method']} {route.path}" if route is not None else "other"
+            self.metrics.requestCompleted(endpoint, str(transfer["status"]), time.perf_counter() - startTime,
+                                          transfer["received"], transfer["sent"])
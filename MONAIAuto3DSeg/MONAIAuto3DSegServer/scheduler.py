@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+
+class ModelAffinityScheduler:
+    """ Assigns jobs to idle inference workers, preferring workers that already have the model of the job loaded.
+
+        Worker selection for a job:
+        1. an idle worker that has the model loaded (cache hit)
+        2. an idle worker that has free space in its model cache (cache miss, the model is loaded without evicting another one)
+        3. an idle worker with a full cache (cache miss with eviction). Workers whose least recently used model is also
+           loaded in another worker are preferred, so that the set of models that are loaded in the pool is preserved.
+
+        Workers are expected to have `loadedModels` (list of loaded models, least recently used first)
+        and `modelCacheSize` attributes.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.idleWorkers = list(workers)
+        self._workerReleased = None  # asyncio.Condition, created when it is first needed to be bound to the event loop of the server
+        # Counters for tuning the number of workers and model cache size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _condition(self):
+        if self._workerReleased is None:
+            self._workerReleased = asyncio.Condition()
+        return self._workerReleased
+
+    async def acquireWorker(self, model):
+        """ Wait until a worker is available and reserve the most suitable one for processing the model. """
+        condition = self._condition()
+        async with condition:
+            await condition.wait_for(lambda: len(self.idleWorkers) > 0)
+            worker = self._selectWorker(model)
+            self.idleWorkers.remove(worker)
+            return worker
+
+    async def releaseWorker(self, worker):
+        """ Make the worker available for processing other jobs. """
+        condition = self._condition()
+        async with condition:
+            self.idleWorkers.append(worker)
+            condition.notify()
+
+    def _selectWorker(self, model):
+        warmWorkers = [worker for worker in self.idleWorkers if model in worker.loadedModels]
+        if warmWorkers:
+            self.hits += 1
+            return warmWorkers[0]
+
+        self.misses += 1
+        workersWithFreeCache = [worker for worker in self.idleWorkers if len(worker.loadedModels) < worker.modelCacheSize]
+        if workersWithFreeCache:
+            return min(workersWithFreeCache, key=lambda worker: len(worker.loadedModels))
+
+        self.evictions += 1
+        for worker in self.idleWorkers:
+            leastRecentlyUsedModel = worker.loadedModels[0]
+            if any(leastRecentlyUsedModel in otherWorker.loadedModels for otherWorker in self.workers if otherWorker is not worker):
+                return worker
+        worker = self.idleWorkers[0]
+        logging.debug(f"Model {worker.loadedModels[0]} will be unloaded from worker {worker.index} to load {model}")
+        return worker
+
+    def statistics(self):
+        numberOfRequests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / numberOfRequests if numberOfRequests else None,
+        }
@@ -0,0 +1,380 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+from fastapi.concurrency import run_in_threadpool
+
+from MONAIAuto3DSegLib.compression import decompressor
+from MONAIAuto3DSegLib.nrrd_io import parseNrrdHeader
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+
+# Names of the multipart form fields that contain the input images, in the order of model inputs
+INPUT_FILE_FIELD_NAMES = ["image_file", "image_file_2", "image_file_3", "image_file_4"]
+
+# Input files are validated when this much data is received (NRRD headers are typically a few hundred bytes)
+MAXIMUM_HEADER_SIZE = 65536
+
+# OpenAPI description of the request body that receiveInputFiles expects (the body is not parsed by FastAPI)
+INPUT_FILES_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {"schema": {
+                "type": "object",
+                "required": [INPUT_FILE_FIELD_NAMES[0]],
+                "properties": {name: {"type": "string", "format": "binary"} for name in INPUT_FILE_FIELD_NAMES},
+            }},
+            # References to previously uploaded blobs (see /blobs endpoints)
+            "application/json": {"schema": {
+                "type": "object",
+                "required": [INPUT_FILE_FIELD_NAMES[0]],
+                "properties": {name: {
+                    "type": "object",
+                    "required": ["blob", "filename"],
+                    "properties": {"blob": {"type": "string"}, "filename": {"type": "string"}},
+                } for name in INPUT_FILE_FIELD_NAMES},
+            }},
+        },
+    }
+}
+
+
+# OpenAPI description of the request body that receiveSequenceInputFiles expects
+SEQUENCE_INPUT_FILES_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": {
+                "type": "object",
+                "required": ["frames"],
+                "properties": {"frames": {
+                    "type": "array",
+                    "items": INPUT_FILES_REQUEST_BODY["requestBody"]["content"]["application/json"]["schema"],
+                }},
+            }},
+        },
+    }
+}
+
+
+class UploadError(Exception):
+    """ The uploaded request body is rejected. """
+    def __init__(self, message, statusCode=400):
+        super().__init__(message)
+        self.statusCode = statusCode
+
+
+class MissingBlobsError(UploadError):
+    """ Referenced blobs are not in the blob store (they have not been uploaded or they have been evicted). """
+    def __init__(self, missingBlobs):
+        super().__init__(f"Blobs are not available on the server: {', '.join(missingBlobs)}", 409)
+        self.missingBlobs = missingBlobs
+
+
+def inputFilePath(sessionDir, name, filename):
+    """ Get the path where an input file is stored in the session folder. """
+    extension = "".join(Path(filename).suffixes)
+    return str(Path(sessionDir) / f"{name}{extension}")
+
+
+def validateInputFileHeader(filename, data):
+    """ Check the beginning of an uploaded input file, before the rest of the file is received.
+    Only NRRD files are checked, other file formats are accepted without validation.
+    :param data: the first (up to MAXIMUM_HEADER_SIZE) bytes of the file
+    :raises UploadError: if the file cannot be used as input
+    """
+    if not filename.lower().endswith(".nrrd"):
+        return
+    try:
+        header = parseNrrdHeader(data)
+    except ValueError as err:
+        raise UploadError(f"Invalid input file {filename}: {err}")
+    if "data file" in header or "datafile" in header:
+        raise UploadError(f"Invalid input file {filename}: NRRD files with detached data are not supported")
+
+
+async def requestBodyChunks(request):
+    """ Async generator that yields the request body in chunks, decompressed according to its Content-Encoding.
+    :raises UploadError: if the content encoding is not supported or the compressed data is invalid
+    """
+    encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding in ["", "identity"]:
+        async for chunk in request.stream():
+            yield chunk
+        return
+    try:
+        streamDecompressor = decompressor(encoding)
+    except ValueError as err:
+        raise UploadError(str(err), 415)
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                # zstd decompressor does not accept any input after the end of the compressed data
+                continue
+            decompressedChunk = await run_in_threadpool(streamDecompressor.decompress, chunk)
+            if decompressedChunk:
+                yield decompressedChunk
+        decompressedChunk = streamDecompressor.flush()
+    except Exception as err:
+        raise UploadError(f"Invalid {encoding} compressed request body: {err}")
+    if decompressedChunk:
+        yield decompressedChunk
+    if not getattr(streamDecompressor, "eof", True):
+        raise UploadError("Compressed request body is incomplete")
+
+
+class _InputFileReceiver:
+    """ Collects events of the multipart parser, so that they can be processed asynchronously. """
+
+    def __init__(self):
+        self.events = []
+        self._headers = {}
+        self._headerField = b""
+        self._headerValue = b""
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self._onPartBegin,
+            "on_header_field": self._onHeaderField,
+            "on_header_value": self._onHeaderValue,
+            "on_header_end": self._onHeaderEnd,
+            "on_headers_finished": self._onHeadersFinished,
+            "on_part_data": self._onPartData,
+            "on_part_end": self._onPartEnd,
+        }
+
+    def _onPartBegin(self):
+        self._headers = {}
+
+    def _onHeaderField(self, data, start, end):
+        self._headerField += data[start:end]
+
+    def _onHeaderValue(self, data, start, end):
+        self._headerValue += data[start:end]
+
+    def _onHeaderEnd(self):
+        self._headers[self._headerField.lower()] = self._headerValue
+        self._headerField = b""
+        self._headerValue = b""
+
+    def _onHeadersFinished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("latin-1")
+        filename = options[b"filename"].decode("utf-8", errors="replace") if b"filename" in options else None
+        self.events.append(("begin", name, filename))
+
+    def _onPartData(self, data, start, end):
+        self.events.append(("data", data[start:end]))
+
+    def _onPartEnd(self):
+        self.events.append(("end",))
+
+
+class _InputFile:
+    """ Input file that is being written to disk. """
+
+    def __init__(self, name, filename, sessionDir):
+        self.filename = filename
+        self.path = inputFilePath(sessionDir, name, filename)
+        self.file = None
+        self.headerData = b""  # beginning of the file, kept until the file is validated
+        self.validated = False
+        self.sha256 = hashlib.sha256()  # hash of the content, for identifying identical inputs
+
+    async def write(self, data):
+        if not self.validated:
+            self.headerData += data
+            if len(self.headerData) < MAXIMUM_HEADER_SIZE and b"\n\n" not in self.headerData and b"\r\n\r\n" not in self.headerData:
+                # wait for more data
+                return
+            await self.validate()
+            data, self.headerData = self.headerData, b""
+        await run_in_threadpool(self._writeChunk, data)
+
+    def _writeChunk(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+
+    async def validate(self):
+        validateInputFileHeader(self.filename, self.headerData)
+        self.validated = True
+        self.file = await run_in_threadpool(open, self.path, "wb")
+
+    async def close(self):
+        if not self.validated:
+            # the whole file is smaller than the header size
+            await self.validate()
+            await run_in_threadpool(self._writeChunk, self.headerData)
+        await run_in_threadpool(self.file.close)
+        self.file = None
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+
+
+async def receiveInputFiles(request, sessionDir, maximumUploadSize=0, blobStore=None):
+    """ Receive input images from a multipart/form-data request body and save them into sessionDir.
+
+    The request body is streamed to disk in chunks, without blocking the event loop and without keeping the files
+    in memory. The body may be compressed (Content-Encoding: gzip or zstd). Each input file is validated as soon as its header is received, therefore invalid requests are rejected
+    before the full body is received.
+
+    If blobStore is specified then the request body may be a JSON object that references blobs that were uploaded
+    earlier instead of containing the files: {"image_file": {"blob": "<SHA-256 hash>", "filename": "input.nrrd"}, ...}
+
+    :param request: starlette.requests.Request object
+    :param maximumUploadSize: maximum size of the (uncompressed) request body in bytes, 0 means no limit
+    :param blobStore: BlobStore object that contains blobs that input file references may refer to
+    :return: list of input file paths and list of SHA-256 hashes of their content, in the order of model inputs
+    :raises UploadError: if the request body is not accepted
+    :raises MissingBlobsError: if referenced blobs are not in the blob store
+    """
+    contentType, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if contentType == b"application/json" and blobStore is not None:
+        return await _linkInputBlobs(request, sessionDir, blobStore)
+    boundary = options.get(b"boundary")
+    if contentType != b"multipart/form-data" or not boundary:
+        raise UploadError("Input files must be sent as multipart/form-data")
+
+    def checkSize(size):
+        if maximumUploadSize and size > maximumUploadSize:
+            raise UploadError(f"Maximum upload size ({maximumUploadSize / 1024 / 1024:.0f}MB) is exceeded", 413)
+
+    contentLength = request.headers.get("Content-Length")
+    if contentLength and contentLength.isdigit():
+        # Reject before receiving anything if the client specified the size
+        checkSize(int(contentLength))
+
+    receiver = _InputFileReceiver()
+    parser = multipart.MultipartParser(boundary, receiver.callbacks())
+    inputFiles = {}  # field name -> _InputFile
+    currentFile = None
+    receivedSize = 0
+    try:
+        async for chunk in requestBodyChunks(request):
+            receivedSize += len(chunk)
+            checkSize(receivedSize)
+            parser.write(chunk)
+            for event in receiver.events:
+                if event[0] == "begin":
+                    _, name, filename = event
+                    if name not in INPUT_FILE_FIELD_NAMES or filename is None:
+                        raise UploadError(f"Unexpected form field: {name}")
+                    if name in inputFiles:
+                        raise UploadError(f"Form field {name} is specified multiple times")
+                    currentFile = _InputFile(name, filename, sessionDir)
+                    inputFiles[name] = currentFile
+                elif event[0] == "data":
+                    await currentFile.write(event[1])
+                elif event[0] == "end":
+                    await currentFile.close()
+                    currentFile = None
+            receiver.events.clear()
+        parser.finalize()
+    except FormParserError as err:
+        raise UploadError(f"Invalid multipart request body: {err}")
+    finally:
+        for inputFile in inputFiles.values():
+            inputFile.abort()
+
+    if currentFile is not None:
+        raise UploadError("Request body is incomplete")
+    if INPUT_FILE_FIELD_NAMES[0] not in inputFiles:
+        raise UploadError(f"Required form field is missing: {INPUT_FILE_FIELD_NAMES[0]}")
+    logging.debug(f"Received {receivedSize} bytes: {[inputFile.path for inputFile in inputFiles.values()]}")
+    receivedFiles = [inputFiles[name] for name in INPUT_FILE_FIELD_NAMES if name in inputFiles]
+    return [inputFile.path for inputFile in receivedFiles], [inputFile.sha256.hexdigest() for inputFile in receivedFiles]
+
+
+async def _linkInputBlobs(request, sessionDir, blobStore):
+    """ Get input files from blobs that are referenced in the JSON request body. See receiveInputFiles. """
+    try:
+        references = _parseInputFileReferences(json.loads(await request.body()))
+    except ValueError:
+        raise UploadError("Invalid input file references")
+    missingBlobs = blobStore.missing([blobHash for blobHash, _ in references.values()])
+    if missingBlobs:
+        raise MissingBlobsError(missingBlobs)
+    return _linkInputFileReferences(references, sessionDir, blobStore)
+
+
+def _parseInputFileReferences(references):
+    """ Get input file references as a dict: field name -> (blob hash, filename).
+    :param references: {"image_file": {"blob": "<SHA-256 hash>", "filename": "input.nrrd"}, ...}
+    :raises UploadError: if the references are invalid
+    """
+    try:
+        references = {name: (reference["blob"], reference["filename"]) for name, reference in references.items()}
+    except (TypeError, KeyError, AttributeError):
+        raise UploadError("Invalid input file references")
+    unexpectedFieldNames = [name for name in references if name not in INPUT_FILE_FIELD_NAMES]
+    if unexpectedFieldNames:
+        raise UploadError(f"Unexpected fields: {', '.join(unexpectedFieldNames)}")
+    if INPUT_FILE_FIELD_NAMES[0] not in references:
+        raise UploadError(f"Required field is missing: {INPUT_FILE_FIELD_NAMES[0]}")
+    return references
+
+
+def _linkInputFileReferences(references, sessionDir, blobStore):
+    """ Link referenced blobs into sessionDir as input files (see _parseInputFileReferences), the blobs must exist.
+    :return: list of input file paths and list of SHA-256 hashes of their content, in the order of model inputs
+    """
+    inputFiles = []
+    inputHashes = []
+    for name in INPUT_FILE_FIELD_NAMES:
+        if name not in references:
+            continue
+        blobHash, filename = references[name]
+        path = inputFilePath(sessionDir, name, filename)
+        blobStore.link(blobHash, path)
+        with open(path, "rb") as f:
+            validateInputFileHeader(filename, f.read(MAXIMUM_HEADER_SIZE))
+        inputFiles.append(path)
+        inputHashes.append(blobHash)
+    return inputFiles, inputHashes
+
+
+async def receiveSequenceInputFiles(request, sessionDir, blobStore):
+    """ Get input files of each frame of an image sequence from blobs that are referenced in the JSON request body:
+    {"frames": [{"image_file": {"blob": "<SHA-256 hash>", "filename": "input.nrrd"}, ...}, ...]}
+
+    Input files of each frame are stored in a subfolder of sessionDir (frame-0000, frame-0001, ...).
+    Frames that have the same content are uploaded only once, as they reference the same blob.
+
+    :param request: starlette.requests.Request object
+    :param blobStore: BlobStore object that contains the referenced blobs
+    :return: list of (input file paths, SHA-256 hashes) of each frame, see receiveInputFiles
+    :raises UploadError: if the request body is not accepted
+    :raises MissingBlobsError: if referenced blobs are not in the blob store (all missing blobs of all frames are listed)
+    """
+    try:
+        frames = json.loads(await request.body())["frames"]
+        if not isinstance(frames, list):
+            raise TypeError("frames must be a list")
+    except (ValueError, TypeError, KeyError):
+        raise UploadError("Request body must contain a list of frames")
+    if not frames:
+        raise UploadError("Sequence does not contain any frames")
+    frameReferences = [_parseInputFileReferences(references) for references in frames]
+    missingBlobs = blobStore.missing(list(dict.fromkeys(
+        blobHash for references in frameReferences for blobHash, _ in references.values())))
+    if missingBlobs:
+        raise MissingBlobsError(missingBlobs)
+    frameInputFiles = []
+    for frameIndex, references in enumerate(frameReferences):
+        frameDir = Path(sessionDir) / f"frame-{frameIndex:04d}"
+        frameDir.mkdir()
+        frameInputFiles.append(_linkInputFileReferences(references, frameDir, blobStore))
+    return frameInputFiles
@@ -0,0 +1,113 @@
+# Inference worker process of the server. It keeps recently used models loaded in memory and processes
+# segmentation requests that it receives on the standard input (one JSON object per line).
+# Each request is answered by a single line on the standard output that starts with RESPONSE_PREFIX.
+#
+# usage: python worker.py --model-cache-size 2 --model-cache-memory 4096
+
+import json
+import logging
+import sys
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+paths = [str(Path(__file__).parent.parent), str(Path(__file__).parent.parent / "Scripts")]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+
+RESPONSE_PREFIX = "Worker response: "
+
+
+class ModelCache:
+    """ Least recently used cache of loaded models, limited by the number of models and by their total memory size. """
+
+    def __init__(self, loadModelFunction, maximumNumberOfModels=2, memoryBudgetMb=0):
+        """
+        :param loadModelFunction: function that loads a model from a model file
+        :param maximumNumberOfModels: maximum number of models kept in memory
+        :param memoryBudgetMb: maximum total size of models kept in memory, 0 means no limit
+        """
+        self.loadModelFunction = loadModelFunction
+        self.maximumNumberOfModels = max(1, maximumNumberOfModels)
+        self.memoryBudgetMb = memoryBudgetMb
+        self._models = OrderedDict()  # model file -> (loaded model, size in MB), most recently used is the last
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def loadedModelFiles(self):
+        return list(self._models.keys())
+
+    def get(self, modelFile):
+        if modelFile in self._models:
+            self.hits += 1
+            self._models.move_to_end(modelFile)
+            return self._models[modelFile][0]
+        self.misses += 1
+        # Free up space before loading, to reduce peak memory usage
+        self._evict(self.maximumNumberOfModels - 1, minimumNumberOfModels=0)
+        loadedModel = self.loadModelFunction(modelFile)
+        self._models[modelFile] = (loadedModel, self._modelSizeMb(loadedModel))
+        # The model that has just been loaded is kept even if it exceeds the memory budget alone
+        self._evict(self.maximumNumberOfModels, minimumNumberOfModels=1)
+        return loadedModel
+
+    def _evict(self, maximumNumberOfModels, minimumNumberOfModels):
+        """ Remove least recently used models until the limits are satisfied. """
+        def limitsExceeded():
+            if len(self._models) > maximumNumberOfModels:
+                return True
+            totalSizeMb = sum(sizeMb for _, sizeMb in self._models.values())
+            return self.memoryBudgetMb > 0 and totalSizeMb > self.memoryBudgetMb
+        evicted = False
+        while len(self._models) > minimumNumberOfModels and limitsExceeded():
+            modelFile, _ = self._models.popitem(last=False)
+            logging.info(f"Unloading model {modelFile}")
+            evicted = True
+        if evicted:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    @staticmethod
+    def _modelSizeMb(loadedModel):
+        model = loadedModel["model"]
+        sizeBytes = sum(tensor.numel() * tensor.element_size() for tensor in list(model.parameters()) + list(model.buffers()))
+        return sizeBytes / 1024 / 1024
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="MONAIAuto3DSeg inference server worker")
+    parser.add_argument("--model-cache-size", type=int, default=2, help="maximum number of models kept in memory")
+    parser.add_argument("--model-cache-memory", type=int, default=0,
+                        help="maximum total size of models kept in memory (MB), 0 means no limit")
+    args = parser.parse_args(argv)
+
+    import auto3dseg_segresnet_inference as inference
+
+    modelCache = ModelCache(inference.load_model, args.model_cache_size, args.model_cache_memory)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        response = {"id": request.get("id")}
+        try:
+            arguments = request["arguments"]
+            # Jobs that contain a list of frames segment an image sequence
+            process = inference.segment_sequence if "frames" in arguments else inference.main
+            process(**arguments, loaded_model=modelCache.get(arguments["model_file"]))
+            response["returnCode"] = 0
+        except Exception as err:
+            traceback.print_exc()
+            response["returnCode"] = 1
+            response["error"] = str(err)
+        response["loadedModels"] = modelCache.loadedModelFiles
+        print(RESPONSE_PREFIX + json.dumps(response), flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import sys
+from pathlib import Path
+
+from MONAIAuto3DSegServer.jobs import processMemory
+from MONAIAuto3DSegServer.scheduler import ModelAffinityScheduler
+from MONAIAuto3DSegServer.worker import RESPONSE_PREFIX
+
+
+class InferenceWorker:
+    """ Long-lived worker process (see worker.py) that processes inference jobs one at a time. """
+
+    def __init__(self, index, modelCacheSize=2, modelCacheMemory=0):
+        self.index = index
+        self.modelCacheSize = modelCacheSize
+        self.modelCacheMemory = modelCacheMemory
+        self.process = None  # asyncio.subprocess.Process object
+        self.loadedModels = []  # model files that are currently loaded in the worker process, least recently used first
+        self.currentJob = None
+
+    @property
+    def isAlive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        workerPyFile = Path(__file__).parent / "worker.py"
+        command = [sys.executable, str(workerPyFile),
+                   "--model-cache-size", str(self.modelCacheSize),
+                   "--model-cache-memory", str(self.modelCacheMemory)]
+        logging.debug(f"Starting inference worker {self.index}: {command}")
+        self.process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.loadedModels = []
+
+    async def stop(self):
+        if self.isAlive:
+            self.process.kill()
+            await self.process.wait()
+
+    async def run(self, job):
+        """ Process the job, returns when processing is completed. Raises an exception if processing failed. """
+        # Memory used by the worker (including cached models) is not part of the memory usage of the job
+        job.baseMemory = processMemory(self.process.pid) or 0.0
+        job.process = self.process  # allows cancelling the job by killing the process
+        request = {"id": job.id, "arguments": job.arguments}
+        self.process.stdin.write((json.dumps(request) + "\n").encode())
+        await self.process.stdin.drain()
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                await self.process.wait()
+                raise RuntimeError(f"Inference worker {self.index} stopped unexpectedly")
+            text = line.decode(errors="replace").rstrip()
+            if text.startswith(RESPONSE_PREFIX):
+                response = json.loads(text[len(RESPONSE_PREFIX):])
+                self.loadedModels = response["loadedModels"]
+                if response["returnCode"] != 0:
+                    raise RuntimeError(response.get("error", "Processing failed"))
+                return
+            job.processOutput(text)
+            print(text, flush=True)
+
+
+class WorkerPool:
+    """ Pool of inference worker processes, owned by the server.
+
+        Each worker keeps recently used models in memory, therefore the cost of starting Python, importing
+        libraries, and loading the model is only paid once and not for every job.
+        Workers that stopped (crashed or killed because their job was cancelled) are restarted automatically.
+        Jobs are routed to workers that already have the required model loaded (see ModelAffinityScheduler).
+    """
+
+    def __init__(self, numberOfWorkers=1, modelCacheSize=2, modelCacheMemory=0):
+        self.workers = [InferenceWorker(index, modelCacheSize, modelCacheMemory) for index in range(numberOfWorkers)]
+        self.scheduler = ModelAffinityScheduler(self.workers)
+
+    async def start(self):
+        for worker in self.workers:
+            await worker.start()
+
+    async def stop(self):
+        for worker in self.workers:
+            await worker.stop()
+
+    async def runJob(self, job):
+        """ Process the job in the next available worker. Can be used as JobManager.jobRunner. """
+        worker = await self.scheduler.acquireWorker(job.arguments["model_file"])
+        worker.currentJob = job
+        try:
+            if not worker.isAlive:
+                await worker.start()
+            await worker.run(job)
+        finally:
+            job.process = None
+            worker.currentJob = None
+            # Not interrupted by cancelling the job, otherwise the worker would not be returned to the pool
+            await asyncio.shield(self._releaseWorker(worker))
+
+    async def _releaseWorker(self, worker):
+        """ Restart the worker if it stopped (e.g., killed because its job was cancelled) and return it to the pool. """
+        if not worker.isAlive:
+            logging.info(f"Restarting inference worker {worker.index}")
+            await worker.stop()
+            await worker.start()
+        await self.scheduler.releaseWorker(worker)
+
+    def status(self):
+        """ Get state of workers and model cache statistics. """
+        return {
+            "scheduler": self.scheduler.statistics(),
+            "workers": [{
+                "index": worker.index,
+                "alive": worker.isAlive,
+                "busy": worker.currentJob is not None,
+                "currentJob": worker.currentJob.id if worker.currentJob else None,
+                "loadedModels": worker.loadedModels,
+                } for worker in self.workers],
+        }
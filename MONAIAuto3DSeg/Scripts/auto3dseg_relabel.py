@@ -0,0 +1,68 @@
+import json
+import sys
+import time
+from pathlib import Path
+
+import fire
+
+paths = [str(Path(__file__).parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.nrrd_io import writeNrrd, cropToNonZero, DEFAULT_COMPRESSION_LEVEL
+from MONAIAuto3DSegLib.probabilities import loadProbabilities, relabel
+
+
+def main(probabilities_file,
+         result_file,
+         threshold=None,
+         post_processing=None,
+         confidence_file=None,
+         output_encoding="raw",
+         compression_level=DEFAULT_COMPRESSION_LEVEL,
+         crop_output=False):
+    """Compute segmentation from probabilities saved by auto3dseg_segresnet_inference.py (--probabilities-file),
+    without running the model again.
+
+    :param threshold: minimum probability (0.0-1.0) of foreground classes. By default the most probable class is used.
+    :param post_processing: list of post-processing steps, as a JSON string (same format as in Models.json)
+    :param confidence_file: if specified then the probability of the chosen class is written into this file (0-255)
+    """
+    start_time = time.time()
+    timing_checkpoints = []  # list of (operation, time) tuples
+
+    if isinstance(post_processing, str):
+        post_processing = json.loads(post_processing)
+
+    def post_processing_step_completed(operation):
+        timing_checkpoints.append((f"Post-processing: {operation}", time.time()))
+
+    probabilities_data = loadProbabilities(probabilities_file)
+    timing_checkpoints.append(("Loading probabilities", time.time()))
+
+    seg, nrrd_header, confidence = relabel(probabilities_data, threshold, post_processing,
+                                           computeConfidence=confidence_file is not None,
+                                           stepCompletedCallback=post_processing_step_completed)
+    timing_checkpoints.append(("Relabel", time.time()))
+
+    if confidence_file:
+        writeNrrd(confidence_file, confidence, nrrd_header, encoding=output_encoding, compressionLevel=compression_level)
+        timing_checkpoints.append(("Save confidence", time.time()))
+
+    if crop_output:
+        seg, nrrd_header = cropToNonZero(seg, nrrd_header)
+    writeNrrd(result_file, seg, nrrd_header, encoding=output_encoding, compressionLevel=compression_level)
+    timing_checkpoints.append(("Save", time.time()))
+
+    print("Computation time log:")
+    previous_start_time = start_time
+    for timing_checkpoint in timing_checkpoints:
+        print(f"  {timing_checkpoint[0]}: {timing_checkpoint[1] - previous_start_time:.2f} seconds")
+        previous_start_time = timing_checkpoint[1]
+
+    print(f'ALL DONE, result saved in {result_file}')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
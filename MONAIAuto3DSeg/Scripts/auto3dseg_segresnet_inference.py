@@ -1,9 +1,14 @@
 import os
+import sys
+import json
 import numpy as np
 import fire
+import functools
+import math
 import time
 import torch
 from collections import OrderedDict
+from pathlib import Path
 
 import nrrd
 from monai.bundle import ConfigParser
@@ -19,7 +24,6 @@ from monai.transforms import (
     CropForegroundd,
     EnsureTyped,
     Invertd,
-    KeepLargestConnectedComponentd,
     Lambdad,
     LoadImaged,
     NormalizeIntensityd,
@@ -30,6 +34,129 @@ from monai.transforms import (
     ConcatItemsd,
 )
 
+paths = [str(Path(__file__).parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.nrrd_io import writeNrrd, cropToNonZero, nonZeroBoundingBox, resampleLabels, DEFAULT_COMPRESSION_LEVEL
+from MONAIAuto3DSegLib.postprocessing import applyPostProcessing
+from MONAIAuto3DSegLib.profiling import StageProfiler
+from MONAIAuto3DSegLib.probabilities import saveProbabilities
+from MONAIAuto3DSegLib.progress import PROCESSING_STAGES, formatFrameMessage, formatStageMessage
+from MONAIAuto3DSegLib.tracing import JsonFileSpanExporter, Tracer
+
+
+def voxel_volume_mm3(affine):
+    affine = np.asarray(affine, dtype=float).reshape(-1, 4, 4)[0]
+    return abs(np.linalg.det(affine[:3, :3]))
+
+
+# StageProfiler of the running main() call, None if profiling is not enabled (see profile_stages)
+_stage_profiler = None
+
+
+def report_stage(stage):
+    # Flush immediately, so that the process that reads the output can report progress
+    print(formatStageMessage(stage), flush=True)
+    if _stage_profiler is not None:
+        if stage == "Completed":
+            _stage_profiler.stop()
+        else:
+            _stage_profiler.startStage(stage)
+
+
+def profile_stages(func):
+    """Decorator of main() that implements the profile and profile_dir arguments: each processing stage (see
+    report_stage) is profiled separately and the results are saved in profile_dir (by default, next to the result file).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, profile=None, profile_dir=None, **kwargs):
+        global _stage_profiler
+        if not profile:
+            return func(*args, **kwargs)
+        if profile_dir is None:
+            result_file = kwargs["result_file"] if "result_file" in kwargs else args[2]
+            profile_dir = os.path.dirname(os.path.abspath(result_file))
+        _stage_profiler = StageProfiler(profile, profile_dir)
+        profiler = _stage_profiler
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Profilers must be stopped even if processing failed, as workers process further jobs in the same process
+            _stage_profiler = None
+            profiler.stop()
+            print(profiler.summary())
+            print(f"Profiling results saved in {profile_dir}")
+    return wrapper
+
+
+def save_trace(trace_file, traceparent, start_time, timing_checkpoints, attributes=None):
+    """Record the processing steps (see timing_checkpoints in main) as spans in the trace file.
+    The spans are children of the span specified by traceparent (e.g., the job on the inference server).
+    """
+    tracer = Tracer("inference", JsonFileSpanExporter(trace_file))
+    script_span = tracer.startSpan("inference script", parent=traceparent, attributes=attributes, startTime=start_time)
+    previous_time = start_time
+    for operation, checkpoint_time in timing_checkpoints:
+        tracer.startSpan(operation, parent=script_span, startTime=previous_time).end(checkpoint_time)
+        previous_time = checkpoint_time
+    script_span.end()
+
+
+def number_of_sliding_windows(image_size, roi_size, overlap):
+    # Same window placement as in MONAI sliding window inference (the image is padded to at least the ROI size)
+    count = 1
+    for size, roi in zip(image_size, roi_size):
+        size = max(size, roi)
+        interval = roi if roi == size else max(1, int(roi * (1 - overlap)))
+        count *= math.ceil((size - roi) / interval) + 1
+    return count
+
+
+class SlidingWindowProgress:
+    """Network wrapper that reports progress of sliding window inference.
+    Windows are processed one at a time (sw_batch_size=1), therefore each network call completes a window.
+    Progress is reported at most every report_interval seconds to avoid flooding the log.
+    """
+
+    def __init__(self, network, number_of_windows, report_interval=2.0):
+        self.network = network
+        self.number_of_windows = number_of_windows
+        self.report_interval = report_interval
+        self.completed_windows = 0
+        self.last_report_time = time.time()
+
+    def __call__(self, *args, **kwargs):
+        # Network evaluation is labelled in profiling results, the rest of the inference stage is window extraction
+        # and blending of the window outputs
+        with torch.profiler.record_function("sliding window network"):
+            output = self.network(*args, **kwargs)
+        # Window count may be exceeded if inference is repeated (e.g., on CPU after running out of GPU memory)
+        self.completed_windows = min(self.completed_windows + 1, self.number_of_windows)
+        if time.time() - self.last_report_time >= self.report_interval:
+            self.last_report_time = time.time()
+            inference_start, inference_end = PROCESSING_STAGES["Inference"], PROCESSING_STAGES["Post-processing"]
+            progress = inference_start + (inference_end - inference_start) * self.completed_windows / self.number_of_windows
+            print(formatStageMessage(f"Inference (window {self.completed_windows}/{self.number_of_windows})", progress), flush=True)
+        return output
+
+
+def get_sliding_inferrer(roi_size, reusable_objects=None):
+    """Get sliding window inferer for the ROI size.
+    If reusable_objects (dict) is specified then the inferer is stored in it and reused in subsequent calls.
+    The reused inferer caches the Gaussian importance map of the windows, so that it is computed only once
+    for all frames of a sequence.
+    """
+    if reusable_objects is None:
+        return SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
+                                         cache_roi_weight_map=False, progress=True)
+    key = ("sliding_inferrer", tuple(roi_size))
+    if key not in reusable_objects:
+        reusable_objects[key] = SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
+                                                          cache_roi_weight_map=True, progress=True)
+    return reusable_objects[key]
+
 
 def logits2pred(logits, sigmoid=False, dim=1):
     if isinstance(logits, (list, tuple)):
@@ -45,17 +172,43 @@ def logits2pred(logits, sigmoid=False, dim=1):
     return pred
 
 
-@torch.no_grad()
-def main(model_file,
-         image_file,
-         result_file,
-         save_mode=None,
-         image_file_2=None,
-         image_file_3=None,
-         image_file_4=None,
-         **kwargs):
-    start_time = time.time()
-    timing_checkpoints = []  # list of (operation, time) tuples
+def save_probabilities(probabilities_file, probabilities_dtype, logits, pred_labels, sigmoid, model_affine,
+                       original_affine, nrrd_header, label_merge=None, margin=3):
+    """Save per-class probabilities in the model voxel grid, cropped to the segmented region (with a small margin
+    to allow growing regions by lowering the threshold), only for classes that are present in the result.
+    """
+    if isinstance(logits, (list, tuple)):
+        logits = logits[0]
+    pred_labels = pred_labels.cpu().numpy()
+    bounding_box = nonZeroBoundingBox(pred_labels)
+    if bounding_box is None:
+        bounding_box = [(0, 1)] * pred_labels.ndim
+    crop_start = [max(start - margin, 0) for start, stop in bounding_box]
+    crop_stop = [min(stop + margin, size) for (start, stop), size in zip(bounding_box, pred_labels.shape)]
+    crop = tuple(slice(start, stop) for start, stop in zip(crop_start, crop_stop))
+    cropped_logits = logits[0][(slice(None),) + crop].float()
+    if sigmoid:
+        probabilities = torch.sigmoid(cropped_logits)
+        labels = np.arange(probabilities.shape[0])
+    else:
+        # All classes are needed for softmax, but only the background and the present classes are stored
+        probabilities = torch.softmax(cropped_logits, dim=0)
+        labels = np.union1d([0], np.unique(pred_labels))
+        probabilities = probabilities[torch.as_tensor(labels, device=probabilities.device)]
+    if probabilities_dtype == "uint8":
+        probabilities = (probabilities * 255).round_().to(torch.uint8)
+    else:
+        probabilities = probabilities.to(torch.float16)
+    saveProbabilities(probabilities_file, probabilities.cpu().numpy(), labels, crop_start,
+                      np.asarray(model_affine, dtype=float).reshape(-1, 4, 4)[0], np.asarray(original_affine, dtype=float),
+                      nrrd_header, sigmoid=sigmoid, labelMerge=label_merge)
+    print(f"Probabilities of {len(labels)} classes saved in {probabilities_file}")
+
+
+def load_model(model_file):
+    """Load the network from the model file into the device that is used for inference.
+    Returns a dict containing the network ("model"), its configuration ("config"), and the device ("device").
+    """
 
     # Checking for model file
 
@@ -73,7 +226,6 @@ def main(model_file,
 
     epoch = checkpoint.get("epoch", 0)
     best_metric = checkpoint.get("best_metric", 0)
-    sigmoid = config.get("sigmoid", False)
 
     model = ConfigParser(config["network"]).get_parsed_content()
     model.load_state_dict(state_dict, strict=True)
@@ -84,6 +236,68 @@ def main(model_file,
     model = model.to(device=device, memory_format=torch.channels_last_3d)  # gpu
     model.eval()
 
+    return {"model": model, "config": config, "device": device}
+
+
+@profile_stages
+@torch.no_grad()
+def main(model_file,
+         image_file,
+         result_file,
+         save_mode=None,
+         image_file_2=None,
+         image_file_3=None,
+         image_file_4=None,
+         output_encoding="raw",
+         compression_level=DEFAULT_COMPRESSION_LEVEL,
+         compression_threads=None,
+         crop_output=False,
+         post_processing=None,
+         probabilities_file=None,
+         probabilities_dtype="uint8",
+         output_geometry=None,
+         loaded_model=None,
+         trace_file=None,
+         traceparent=None,
+         reusable_objects=None,
+         **kwargs):
+    """Segment the input image(s) and save the result in result_file.
+    :param loaded_model: model returned by load_model. If not specified then the model is loaded from model_file.
+      Processes that segment many images (such as inference server workers) can keep models loaded in memory.
+    :param output_geometry: voxel grid of the result (see MONAIAuto3DSegLib.nrrd_io.parseImageGeometry), specified as
+      a JSON string. If the input image is a downsampled copy of the original image then the segmentation can be
+      returned in the voxel grid of the original image. By default the result has the voxel grid of the input image.
+    :param trace_file: if specified then the time of each processing step is recorded as trace spans in this file
+      (see MONAIAuto3DSegLib.tracing), as children of the span specified by traceparent (W3C trace context string).
+    :param profile: profile each processing stage using "torch" profiler, "cprofile", or both ("all" or "torch,cprofile").
+      Chrome trace (torch profiler), pstats (cProfile), and summary of the top operators of each stage are written
+      into profile_dir (by default, the folder of result_file). Implemented by profile_stages.
+    :param reusable_objects: dict for keeping objects that can be reused when segmenting multiple images of the same
+      size with the same model (see segment_sequence).
+    """
+    start_time = time.time()
+    timing_checkpoints = []  # list of (operation, time) tuples
+
+    # List of post-processing steps (see MONAIAuto3DSegLib.postprocessing), specified as a JSON string
+    if isinstance(post_processing, str):
+        post_processing = json.loads(post_processing)
+
+    def post_processing_step_completed(operation):
+        timing_checkpoints.append((f"Post-processing: {operation}", time.time()))
+
+    report_stage("Loading model")
+
+    preloaded_model = loaded_model is not None
+    if loaded_model is None:
+        loaded_model = load_model(model_file)
+    model = loaded_model["model"]
+    config = loaded_model["config"]
+    device = loaded_model["device"]
+    sigmoid = config.get("sigmoid", False)
+    timing_checkpoints.append(("Loading model", time.time()))
+
+    report_stage("Preprocessing")
+
     # If BRATS
     if save_mode == 'brats' or 'brats' in model_file:  # for brats case
 
@@ -136,8 +350,7 @@ def main(model_file,
         # sliding_inferrer
         roi_size = config["roi_size"]
         # roi_size = [224, 224, 144]
-        sliding_inferrer = SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
-                                                     cache_roi_weight_map=False, progress=True)
+        sliding_inferrer = get_sliding_inferrer(roi_size, reusable_objects)
 
         # process DATA
         batch_data = inf_transform([{"image": image_files}])
@@ -147,10 +360,13 @@ def main(model_file,
         data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=torch.channels_last_3d, device=device)
         timing_checkpoints.append(("Preprocessing", time.time()))
 
+        report_stage("Inference")
         print('Running Inference ...')
         with autocast(enabled=True):
-            logits = sliding_inferrer(inputs=data, network=model)
+            number_of_windows = number_of_sliding_windows(data.shape[2:], roi_size, sliding_inferrer.overlap)
+            logits = sliding_inferrer(inputs=data, network=SlidingWindowProgress(model, number_of_windows))
         timing_checkpoints.append(("Inference", time.time()))
+        report_stage("Post-processing")
 
         print(f"Logits {logits.shape}")
         # logits -> preds
@@ -165,6 +381,11 @@ def main(model_file,
             pred = logits2pred(logits, sigmoid=sigmoid)
         print(f"preds {pred.shape}")
         timing_checkpoints.append(("Logits", time.time()))
+        if probabilities_file:
+            save_probabilities(probabilities_file, probabilities_dtype, logits, pred[0].any(0).to(torch.uint8),
+                               sigmoid, batch_data["image"].affine, original_affine, nrrd.read_header(image_file),
+                               label_merge="brats")
+            timing_checkpoints.append(("Save probabilities", time.time()))
         logits = None
 
         # pred = pred.cpu() # convert to CPU if the next step (reverse interpolation) is OOM on GPU
@@ -189,6 +410,13 @@ def main(model_file,
         seg = p2
         print(f"Updated seg for BRATS {seg.shape}")
 
+        if post_processing:
+            # Channels are overlapping, therefore post-processing can only be done after merging them (at full resolution)
+            print('Post-processing')
+            seg_array = seg.cpu().numpy()
+            applyPostProcessing(seg_array, post_processing, voxel_volume_mm3(original_affine), post_processing_step_completed)
+            seg = torch.from_numpy(seg_array)
+
     # Other cases
     else:
 
@@ -272,8 +500,7 @@ def main(model_file,
         # sliding_inferrer
         roi_size = config["roi_size"]
         # roi_size = [224, 224, 144]
-        sliding_inferrer = SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
-                                                     cache_roi_weight_map=False, progress=True)
+        sliding_inferrer = get_sliding_inferrer(roi_size, reusable_objects)
 
         # process DATA
         batch_data = inf_transform([images_loaded])
@@ -283,10 +510,13 @@ def main(model_file,
         data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=torch.channels_last_3d, device=device)
         timing_checkpoints.append(("Preprocessing", time.time()))
 
+        report_stage("Inference")
         print('Running Inference ...')
         with autocast(enabled=True):
-            logits = sliding_inferrer(inputs=data, network=model)
+            number_of_windows = number_of_sliding_windows(data.shape[2:], roi_size, sliding_inferrer.overlap)
+            logits = sliding_inferrer(inputs=data, network=SlidingWindowProgress(model, number_of_windows))
         timing_checkpoints.append(("Inference", time.time()))
+        report_stage("Post-processing")
 
         print(f"Logits {logits.shape}")
         # logits -> preds
@@ -301,13 +531,26 @@ def main(model_file,
             pred = logits2pred(logits, sigmoid=sigmoid)
         print(f"preds {pred.shape}")
         timing_checkpoints.append(("Logits", time.time()))
+        if probabilities_file:
+            save_probabilities(probabilities_file, probabilities_dtype, logits, pred[0, 0].to(torch.uint8),
+                               sigmoid, batch_data["image"].affine, original_affine, nrrd.read_header(image_file))
+            timing_checkpoints.append(("Save probabilities", time.time()))
         logits = None
 
         # pred = pred.cpu() # convert to CPU if the next step (reverse interpolation) is OOM on GPU
         # invert loading transforms (uncrop, reverse-resample, etc)
-        post_transforms_list = [Invertd(keys="pred", orig_keys="image", transform=inf_transform, nearest_interp=True)]
-        post_transforms_list.append(KeepLargestConnectedComponentd(keys="pred", num_components=2)) if 'whole-head' in model_file else post_transforms_list
-        post_transforms = Compose(post_transforms_list)
+        if post_processing:
+            # Post-process before inverting the transforms, because the model resolution is often much lower than
+            # the input resolution, which makes post-processing much faster. Inverse resampling may still break or merge
+            # thin components (e.g., for anisotropic or rotated voxel grids), so the result is not guaranteed to be
+            # exactly the same as post-processing at input resolution.
+            print('Post-processing')
+            pred_array = pred[0, 0].cpu().numpy().astype(np.uint8)
+            applyPostProcessing(pred_array, post_processing, voxel_volume_mm3(batch_data["image"].affine), post_processing_step_completed)
+            pred[0, 0] = torch.from_numpy(pred_array).to(device=pred.device, dtype=pred.dtype)
+
+        post_transforms = Compose(
+            [Invertd(keys="pred", orig_keys="image", transform=inf_transform, nearest_interp=True)])
 
         batch_data["pred"] = convert_to_dst_type(pred, batch_data["image"], dtype=pred.dtype, device=pred.device)[
             0]  # make Meta tensor
@@ -321,9 +564,24 @@ def main(model_file,
     seg = seg.cpu().numpy().astype(np.uint8)
     timing_checkpoints.append(("Convert to array", time.time()))
 
-    # save result by copying all image metadata from the input, just replacing the voxel data
+    report_stage("Saving")
+
+    # save result by copying image geometry from the input, just replacing the voxel data
+    # output_encoding: "raw" is the fastest to write and read on a local disk, "gzip" (compressed by multiple threads)
+    # is preferable when the result is transferred over network
     nrrd_header = nrrd.read_header(image_file)
-    nrrd.write(result_file, seg, nrrd_header)
+    if output_geometry:
+        # Nearest neighbor interpolation, same as inverting the resampling of the model
+        seg, nrrd_header = resampleLabels(seg, nrrd_header, output_geometry)
+        print(f"Output resampled to {seg.shape}")
+        timing_checkpoints.append(("Resample output", time.time()))
+    if crop_output:
+        # Only write the bounding box of non-zero labels (origin is adjusted, so geometry remains exact)
+        seg, nrrd_header = cropToNonZero(seg, nrrd_header)
+        print(f"Output cropped to {seg.shape}")
+        timing_checkpoints.append(("Crop", time.time()))
+    writeNrrd(result_file, seg, nrrd_header, encoding=output_encoding, compressionLevel=compression_level,
+              numberOfThreads=compression_threads)
     timing_checkpoints.append(("Save", time.time()))
 
     print("Computation time log:")
@@ -332,9 +590,38 @@ def main(model_file,
         print(f"  {timing_checkpoint[0]}: {timing_checkpoint[1] - previous_start_time:.2f} seconds")
         previous_start_time = timing_checkpoint[1]
 
+    if trace_file:
+        save_trace(trace_file, traceparent, start_time, timing_checkpoints,
+                   {"model": os.path.basename(os.path.dirname(model_file)), "device": str(device),
+                    "model_preloaded": preloaded_model})
+
+    report_stage("Completed")
     print(f'ALL DONE, result saved in {result_file}')
 
 
+def segment_sequence(model_file, frames, loaded_model=None, profile_dir=None, **kwargs):
+    """Segment the frames of an image sequence (such as a cardiac or perfusion time series) using the same model.
+    The model is loaded only once and the sliding window inferer is reused between frames. When the result of a frame
+    is saved, a frame message is printed (see MONAIAuto3DSegLib.progress.formatFrameMessage), so that the result
+    can be used while the next frames are processed.
+    :param frames: list of dicts (or its JSON string) that contain the arguments of main() that are different for
+      each frame: image_file, result_file, and optionally image_file_2, image_file_3, image_file_4, probabilities_file.
+    :param profile_dir: profiling results of each frame are saved in a subfolder of this folder (frame-0000, ...)
+    :param kwargs: arguments of main() that are the same for all frames
+    """
+    if isinstance(frames, str):
+        frames = json.loads(frames)
+    if loaded_model is None:
+        loaded_model = load_model(model_file)
+    reusable_objects = {}
+    for frame_index, frame in enumerate(frames):
+        frame_arguments = {**kwargs, **frame}
+        if profile_dir:
+            frame_arguments["profile_dir"] = os.path.join(profile_dir, f"frame-{frame_index:04d}")
+        main(model_file, loaded_model=loaded_model, reusable_objects=reusable_objects, **frame_arguments)
+        print(formatFrameMessage(frame_index, len(frames)), flush=True)
+
+
 def _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds):
     if normalize_mode == "none":
         pass
@@ -354,4 +641,5 @@ def _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds):
 
 
 if __name__ == '__main__':
-    fire.Fire(main)
+    # Sequences are segmented if the list of frames is specified (--frames), otherwise a single image
+    fire.Fire(segment_sequence if "--frames" in sys.argv[1:] else main)
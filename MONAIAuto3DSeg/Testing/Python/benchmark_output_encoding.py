@@ -0,0 +1,101 @@
+"""Benchmark write and read time and file size of segmentation results for each output encoding.
+
+usage: python benchmark_output_encoding.py [--label-file path/to/segmentation.nrrd] [--repeat 3]
+
+If no label file is specified then a synthetic whole-body-like label map is used (512x512x400 voxels, 25 ellipsoids).
+Reading is done by pynrrd, which (similarly to 3D Slicer's NRRD reader) decompresses using a single thread.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import nrrd
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.nrrd_io import writeNrrd
+
+
+def syntheticLabelmap(shape=(512, 512, 400), numberOfLabels=25, seed=0):
+    rng = np.random.default_rng(seed)
+    labelmap = np.zeros(shape, dtype=np.uint8)
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    for label in range(1, numberOfLabels + 1):
+        center = [rng.uniform(0.2, 0.8) * size for size in shape]
+        radius = [rng.uniform(0.03, 0.15) * size for size in shape]
+        mask = sum(((axis - c) / r) ** 2 for axis, c, r in zip(grid, center, radius)) <= 1.0
+        labelmap[mask] = label
+    header = {
+        "space": "left-posterior-superior",
+        "space directions": np.diag([0.8, 0.8, 1.5]),
+        "space origin": np.array([-200.0, -200.0, -300.0]),
+    }
+    return labelmap, header
+
+
+def benchmark(labelmap, header, repeat):
+    configurations = [
+        ("raw", {"encoding": "raw"}),
+        ("gzip level 1, 1 thread", {"encoding": "gzip", "compressionLevel": 1, "numberOfThreads": 1}),
+        ("gzip level 1, all threads", {"encoding": "gzip", "compressionLevel": 1}),
+        ("gzip level 6, all threads", {"encoding": "gzip", "compressionLevel": 6}),
+        ("gzip level 9, all threads", {"encoding": "gzip", "compressionLevel": 9}),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as tempDir:
+        filename = os.path.join(tempDir, "segmentation.nrrd")
+
+        # Reference: previous implementation (pynrrd, single-threaded)
+        writeTimes, readTimes = [], []
+        for _ in range(repeat):
+            startTime = time.perf_counter()
+            nrrd.write(filename, labelmap, {**header, "encoding": "gzip"})
+            writeTimes.append(time.perf_counter() - startTime)
+            startTime = time.perf_counter()
+            nrrd.read(filename)
+            readTimes.append(time.perf_counter() - startTime)
+        results.append(("pynrrd gzip (previous)", min(writeTimes), min(readTimes), os.path.getsize(filename)))
+
+        for name, options in configurations:
+            writeTimes, readTimes = [], []
+            for _ in range(repeat):
+                startTime = time.perf_counter()
+                writeNrrd(filename, labelmap, header, **options)
+                writeTimes.append(time.perf_counter() - startTime)
+                startTime = time.perf_counter()
+                readLabelmap, _ = nrrd.read(filename)
+                readTimes.append(time.perf_counter() - startTime)
+            if not np.array_equal(readLabelmap, labelmap):
+                raise RuntimeError(f"Labelmap read back from file is different from the written labelmap ({name})")
+            results.append((name, min(writeTimes), min(readTimes), os.path.getsize(filename)))
+    return results
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark segmentation output encodings")
+    parser.add_argument("--label-file", type=str, required=False, help="label map NRRD file to benchmark with")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions (best time is reported)")
+    args = parser.parse_args(argv)
+
+    if args.label_file:
+        labelmap, header = nrrd.read(args.label_file)
+        labelmap = labelmap.astype(np.uint8)
+    else:
+        labelmap, header = syntheticLabelmap()
+
+    print(f"Label map size: {labelmap.shape}, {labelmap.nbytes / 1024 / 1024:.1f} MB, {os.cpu_count()} CPU cores")
+    print(f"{'Encoding':<28}{'Write (s)':>10}{'Read (s)':>10}{'Total (s)':>10}{'Size (MB)':>11}")
+    for name, writeTime, readTime, fileSize in benchmark(labelmap, header, args.repeat):
+        print(f"{name:<28}{writeTime:>10.3f}{readTime:>10.3f}{writeTime + readTime:>10.3f}{fileSize / 1024 / 1024:>11.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,304 @@
+"""Tests of storage of uploaded input files (MONAIAuto3DSegServer.blobs) and the /blobs and /uploads endpoints
+of the server.
+
+usage: python -m pytest Testing/Python/test_blobs.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from fastapi.testclient import TestClient
+
+from MONAIAuto3DSegServer.blobs import BlobStore, LruFileStore, ResumableUploads
+from MONAIAuto3DSegServer.uploads import UploadError
+
+# Python dependencies of the server are not installed when the module is imported
+with mock.patch("MONAIAuto3DSegLib.dependency_handler.NonSlicerPythonDependencies.setupPythonRequirements"):
+    from MONAIAuto3DSegServer import main
+
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class LruFileStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.sourceDir = Path(self.tempDir.name) / "source"
+        self.sourceDir.mkdir()
+        self.storeDir = Path(self.tempDir.name) / "store"
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def addFile(self, store, content):
+        key = sha256(content)
+        sourcePath = self.sourceDir / key
+        sourcePath.write_bytes(content)
+        store.add(key, sourcePath)
+        return key
+
+    def test_evictLeastRecentlyUsed(self):
+        store = LruFileStore(self.storeDir, maximumSize=25)
+        first = self.addFile(store, b"1" * 10)
+        second = self.addFile(store, b"2" * 10)
+        # Using the first file makes the second one the least recently used
+        store.link(first, self.sourceDir / "linked")
+        third = self.addFile(store, b"3" * 10)
+        self.assertEqual(store.missing([first, second, third]), [second])
+        self.assertFalse(store.filePath(second).exists())
+        self.assertEqual(store.totalSize, 20)
+        # Files that were linked from the store are not affected by eviction
+        self.assertEqual((self.sourceDir / "linked").read_bytes(), b"1" * 10)
+
+    def test_fileLargerThanMaximumSize(self):
+        store = LruFileStore(self.storeDir, maximumSize=25)
+        small = self.addFile(store, b"1" * 10)
+        large = self.addFile(store, b"2" * 30)
+        # The most recently added file is kept even if it alone exceeds the size limit
+        self.assertEqual(store.missing([small, large]), [small])
+        self.assertEqual(store.numberOfFiles, 1)
+
+    def test_existingFiles(self):
+        store = LruFileStore(self.storeDir, maximumSize=100)
+        key = self.addFile(store, b"content")
+        (self.storeDir / "interrupted.partial").write_bytes(b"incomplete")
+        store = LruFileStore(self.storeDir, maximumSize=100)
+        self.assertTrue(store.contains(key))
+        self.assertEqual(store.totalSize, len(b"content"))
+        self.assertFalse((self.storeDir / "interrupted.partial").exists())
+
+    def test_linkMissingFile(self):
+        store = LruFileStore(self.storeDir)
+        with self.assertRaises(KeyError):
+            store.link(sha256(b"missing"), self.sourceDir / "linked")
+
+
+class ChunkRequest:
+    """Request whose body is sent in the specified chunks. If an exception is specified then it is raised after
+    the chunks, as if the connection was lost."""
+
+    def __init__(self, chunks, exception=None):
+        self.headers = {}
+        self.chunks = chunks
+        self.exception = exception
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.exception:
+            raise self.exception
+
+
+class ResumableUploadsTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.blobStore = BlobStore(self.tempDir.name)
+        self.uploads = ResumableUploads(self.blobStore)
+        self.content = bytes(range(256)) * 40
+        self.blobHash = sha256(self.content)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    async def test_upload(self):
+        session = self.uploads.create(self.blobHash, len(self.content))
+        await self.uploads.append(session, 0, ChunkRequest([self.content[:1000], self.content[1000:4000]]))
+        self.assertEqual(session.offset, 4000)
+        self.assertFalse(session.info()["complete"])
+        await self.uploads.append(session, 4000, ChunkRequest([self.content[4000:]]))
+        self.assertTrue(session.info()["complete"])
+        self.assertEqual(self.blobStore.filePath(self.blobHash).read_bytes(), self.content)
+        # Completed sessions are kept for a while, so that the client can query the result
+        self.assertIs(self.uploads.session(session.id), session)
+        with self.assertRaises(UploadError) as context:
+            await self.uploads.append(session, len(self.content), ChunkRequest([]))
+        self.assertEqual(context.exception.statusCode, 409)
+
+    async def test_expiredSessions(self):
+        self.uploads = ResumableUploads(self.blobStore, sessionTimeout=3600, completedSessionTimeout=0)
+        completedSession = self.uploads.create(self.blobHash, len(self.content))
+        await self.uploads.append(completedSession, 0, ChunkRequest([self.content]))
+        incompleteSession = self.uploads.create(self.blobHash, len(self.content))
+        self.uploads.removeExpiredSessions()
+        self.assertIsNone(self.uploads.session(completedSession.id))
+        self.assertIs(self.uploads.session(incompleteSession.id), incompleteSession)
+
+    async def test_offsetMismatch(self):
+        session = self.uploads.create(self.blobHash, len(self.content))
+        await self.uploads.append(session, 0, ChunkRequest([self.content[:1000]]))
+        for offset in [0, 500, 2000]:
+            with self.subTest(offset=offset):
+                with self.assertRaises(UploadError) as context:
+                    await self.uploads.append(session, offset, ChunkRequest([self.content[offset:]]))
+                self.assertEqual(context.exception.statusCode, 409)
+                self.assertEqual(session.offset, 1000)
+        # The upload can be continued from the offset that the server expects
+        await self.uploads.append(session, session.offset, ChunkRequest([self.content[session.offset:]]))
+        self.assertEqual(self.blobStore.filePath(self.blobHash).read_bytes(), self.content)
+
+    async def test_interruptedChunk(self):
+        session = self.uploads.create(self.blobHash, len(self.content))
+        await self.uploads.append(session, 0, ChunkRequest([self.content[:1000]]))
+        # Part of the chunk is received, then the connection is lost
+        with self.assertRaises(ConnectionResetError):
+            await self.uploads.append(session, 1000, ChunkRequest([self.content[1000:3000]], ConnectionResetError()))
+        # Received data of the incomplete chunk is discarded
+        self.assertEqual(session.offset, 1000)
+        self.assertEqual(session.path.stat().st_size, 1000)
+        await self.uploads.append(session, 1000, ChunkRequest([self.content[1000:5000], self.content[5000:]]))
+        self.assertEqual(self.blobStore.filePath(self.blobHash).read_bytes(), self.content)
+
+    async def test_hashMismatch(self):
+        session = self.uploads.create(self.blobHash, len(self.content))
+        modifiedContent = bytes(len(self.content))
+        await self.uploads.append(session, 0, ChunkRequest([modifiedContent[:5000]]))
+        with self.assertRaises(UploadError) as context:
+            await self.uploads.append(session, 5000, ChunkRequest([modifiedContent[5000:]]))
+        self.assertIn("does not match its hash", str(context.exception))
+        self.assertFalse(self.blobStore.contains(self.blobHash))
+        self.assertFalse(session.path.exists())
+        self.assertIsNone(self.uploads.session(session.id))
+
+    async def test_contentLargerThanSize(self):
+        session = self.uploads.create(self.blobHash, len(self.content))
+        with self.assertRaises(UploadError):
+            await self.uploads.append(session, 0, ChunkRequest([self.content, b"extra"]))
+        self.assertEqual(session.offset, 0)
+        self.assertEqual(session.path.stat().st_size, 0)
+
+    def test_invalidSession(self):
+        with self.assertRaises(UploadError):
+            self.uploads.create("not-a-hash", len(self.content))
+        with self.assertRaises(UploadError):
+            self.uploads.create(self.blobHash, 0)
+        with self.assertRaises(UploadError) as context:
+            self.uploads.create(self.blobHash, len(self.content), maximumUploadSize=1000)
+        self.assertEqual(context.exception.statusCode, 413)
+
+
+class BlobEndpointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.blobStore = BlobStore(self.tempDir.name, maximumSize=1024 * 1024 * 1024)
+        main.app.state.blobStore = self.blobStore
+        # The server is not started (lifespan is not run), so no inference workers are started
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        main.app.state.blobStore = None
+        main.app.state.resumableUploads = None
+        self.tempDir.cleanup()
+
+    def test_upload(self):
+        content = b"image content" * 1000
+        blobHash = sha256(content)
+        response = self.client.put(f"/blobs/{blobHash}", content=content)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.blobStore.filePath(blobHash).read_bytes(), content)
+        # Uploading the same blob again does not store it again
+        response = self.client.put(f"/blobs/{blobHash}", content=content)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post("/blobs/missing", json={"blobs": [blobHash, sha256(b"other")]})
+        self.assertEqual(response.json()["missingBlobs"], [sha256(b"other")])
+
+    def test_compressedUpload(self):
+        content = b"image content" * 1000
+        blobHash = sha256(content)
+        response = self.client.put(f"/blobs/{blobHash}", content=gzip.compress(content),
+                                   headers={"Content-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 201)
+        # Hash of the uncompressed content is verified, the uncompressed content is stored
+        self.assertEqual(self.blobStore.filePath(blobHash).read_bytes(), content)
+
+    def test_hashMismatch(self):
+        blobHash = sha256(b"expected content")
+        response = self.client.put(f"/blobs/{blobHash}", content=b"other content")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("does not match its hash", response.json()["message"])
+        self.assertFalse(self.blobStore.contains(blobHash))
+        # No partial file is left behind
+        self.assertEqual(os.listdir(self.tempDir.name), [])
+
+    def test_invalidHash(self):
+        response = self.client.put("/blobs/not-a-hash", content=b"content")
+        self.assertEqual(response.status_code, 400)
+
+    def test_maximumUploadSize(self):
+        content = bytes(2 * 1024 * 1024)
+        blobHash = sha256(content)
+        with mock.patch.object(main.settings, "maxUploadSize", 1):
+            # Rejected by the declared size
+            response = self.client.put(f"/blobs/{blobHash}", content=content)
+            self.assertEqual(response.status_code, 413)
+            # Compressed content is small, it is rejected while it is decompressed
+            response = self.client.put(f"/blobs/{blobHash}", content=gzip.compress(content),
+                                       headers={"Content-Encoding": "gzip"})
+            self.assertEqual(response.status_code, 413)
+        self.assertFalse(self.blobStore.contains(blobHash))
+        self.assertEqual(os.listdir(self.tempDir.name), [])
+
+    def test_missingBlobsInJob(self):
+        modelName = main.modelDB.models[0]["id"]
+        missingHash = sha256(b"evicted image")
+        response = self.client.post("/jobs", params={"model_name": modelName},
+                                    content=json.dumps({"image_file": {"blob": missingHash, "filename": "image.nrrd"}}),
+                                    headers={"Content-Type": "application/json"})
+        # The client can upload the missing blobs and submit the job again
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["missingBlobs"], [missingHash])
+
+    def test_resumableUpload(self):
+        main.app.state.resumableUploads = ResumableUploads(self.blobStore)
+        content = b"image content" * 1000
+        blobHash = sha256(content)
+        response = self.client.post("/uploads", json={"blob": blobHash, "size": len(content)})
+        self.assertEqual(response.status_code, 201)
+        uploadId = response.json()["upload"]
+        response = self.client.patch(f"/uploads/{uploadId}", content=content[:5000], headers={"Upload-Offset": "0"})
+        self.assertEqual(response.json()["offset"], 5000)
+        # Chunk at a wrong offset is rejected, the response contains the expected offset
+        response = self.client.patch(f"/uploads/{uploadId}", content=content[3000:], headers={"Upload-Offset": "3000"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 5000)
+        response = self.client.patch(f"/uploads/{uploadId}", content=content[5000:], headers={"Upload-Offset": "5000"})
+        self.assertTrue(response.json()["complete"])
+        self.assertEqual(self.blobStore.filePath(blobHash).read_bytes(), content)
+
+    def test_lostResponseToLastChunk(self):
+        main.app.state.resumableUploads = ResumableUploads(self.blobStore)
+        content = b"image content" * 1000
+        blobHash = sha256(content)
+        response = self.client.post("/uploads", json={"blob": blobHash, "size": len(content)})
+        uploadId = response.json()["upload"]
+        # Response to the last chunk is not received by the client
+        self.client.patch(f"/uploads/{uploadId}", content=content, headers={"Upload-Offset": "0"})
+        # The client queries the offset and finds that the upload is complete
+        response = self.client.get(f"/uploads/{uploadId}")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["complete"])
+        self.assertEqual(response.json()["offset"], len(content))
+        # Sending the last chunk again is rejected, the response contains the final offset
+        response = self.client.patch(f"/uploads/{uploadId}", content=content, headers={"Upload-Offset": "0"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], len(content))
+        self.assertEqual(self.blobStore.filePath(blobHash).read_bytes(), content)
+
+
+if __name__ == "__main__":
+    unittest.main()
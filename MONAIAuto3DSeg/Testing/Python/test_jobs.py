@@ -0,0 +1,262 @@
+"""Tests of inference job scheduling (MONAIAuto3DSegServer.jobs.JobManager).
+
+usage: python -m pytest Testing/Python/test_jobs.py
+"""
+
+import asyncio
+import json
+import sys
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegServer.jobs import Job, JobManager, JobPriority, JobQueueFullError, JobStatus
+
+
+class ControlledJobRunner:
+    """Job runner that records the order in which jobs are started and completes a job when finish() is called"""
+
+    def __init__(self):
+        self.startedJobs = []
+        self._finished = {}
+
+    async def __call__(self, job):
+        self.startedJobs.append(job.modelName)
+        self._finished[job.modelName] = asyncio.Event()
+        await self._finished[job.modelName].wait()
+
+    def finish(self, modelName):
+        self._finished[modelName].set()
+
+
+class FakeResultCache:
+
+    def __init__(self):
+        self.addedKeys = []
+
+    def contains(self, key):
+        return False
+
+    def add(self, key, filename):
+        self.addedKeys.append(key)
+
+
+def createJob(name, clientId="client", priority=JobPriority.NORMAL, numberOfVoxels=None, geometry=None):
+    """Create a job, name is used as model name so that the job runner can identify the job"""
+    return Job(arguments={}, sessionDir="", outputFile="", modelName=name, model={"id": name, "segmentationTimeSecCPU": 100},
+               clientId=clientId, priority=priority, numberOfVoxels=numberOfVoxels, geometry=geometry, cacheKey=name)
+
+
+async def settle():
+    """Let started job tasks run until they wait for the job runner"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class JobSchedulingTest(unittest.IsolatedAsyncioTestCase):
+
+    def createJobManager(self, **kwargs):
+        self.runner = ControlledJobRunner()
+        self.jobManager = JobManager(jobRunner=self.runner, **kwargs)
+        return self.jobManager
+
+    async def asyncTearDown(self):
+        # Stop jobs that are still in progress before the event loop is closed
+        for job in list(self.jobManager.jobs.values()):
+            if not job.finished:
+                self.jobManager.cancel(job.id)
+                await job.completed.wait()
+        await settle()
+
+    async def finishJob(self, jobManager, name):
+        job = next(job for job in jobManager.jobs.values() if job.modelName == name)
+        self.runner.finish(name)
+        await job.completed.wait()
+        await settle()
+
+    async def test_highPriorityFirst(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=1)
+        for job in [createJob("running"), createJob("normal"), createJob("high", priority=JobPriority.HIGH)]:
+            jobManager.submit(job)
+        await settle()
+        await self.finishJob(jobManager, "running")
+        self.assertEqual(self.runner.startedJobs, ["running", "high"])
+
+    async def test_fairness(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=2)
+        jobManager.submit(createJob("busy1", clientId="busy"))
+        jobManager.submit(createJob("busy2", clientId="busy"))
+        # Submitted earlier, but its client already has a job running when a slot becomes free
+        jobManager.submit(createJob("busy3", clientId="busy"))
+        jobManager.submit(createJob("other", clientId="other"))
+        await settle()
+        await self.finishJob(jobManager, "busy1")
+        self.assertEqual(self.runner.startedJobs, ["busy1", "busy2", "other"])
+
+    async def test_shortestJobFirst(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=1, agingRate=0.0)
+        jobManager.submit(createJob("running"))
+        jobManager.submit(createJob("long", numberOfVoxels=10**9))
+        jobManager.submit(createJob("short", numberOfVoxels=10**6))
+        await settle()
+        await self.finishJob(jobManager, "running")
+        self.assertEqual(self.runner.startedJobs, ["running", "short"])
+
+    async def test_aging(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=1, agingRate=1.0)
+        jobManager.submit(createJob("running"))
+        longJob = jobManager.submit(createJob("long", numberOfVoxels=10**9))
+        jobManager.submit(createJob("short", numberOfVoxels=10**6))
+        # The long job has been waiting for longer than the difference of estimated processing times
+        longJob.submitTime -= longJob.estimatedProcessingTime
+        await settle()
+        await self.finishJob(jobManager, "running")
+        self.assertEqual(self.runner.startedJobs, ["running", "long"])
+
+    async def test_memoryAdmission(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=3)
+        geometry = jobManager.memoryEstimator.referenceGeometry({})
+        estimatedMemory = jobManager.memoryEstimator.estimate({"id": "large1"}, geometry)
+        # Budget fits one job, the second one waits even though there are free processing slots
+        jobManager.memoryBudget = 1.5 * estimatedMemory
+        runningJob = jobManager.submit(createJob("large1", geometry=geometry))
+        waitingJob = jobManager.submit(createJob("large2", geometry=geometry))
+        await settle()
+        self.assertEqual(self.runner.startedJobs, ["large1"])
+        self.assertEqual(waitingJob.status, JobStatus.QUEUED)
+        self.assertEqual(jobManager.usedMemory(), estimatedMemory)
+        # Measured memory usage above the estimate is taken into account
+        runningJob.peakMemory = 2 * estimatedMemory
+        self.assertEqual(jobManager.usedMemory(), 2 * estimatedMemory)
+        await self.finishJob(jobManager, "large1")
+        self.assertEqual(self.runner.startedJobs, ["large1", "large2"])
+
+    async def test_jobLargerThanMemoryBudget(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=2, memoryBudget=1)
+        job = jobManager.submit(createJob("large"))
+        await settle()
+        # Started because no other jobs are running
+        self.assertEqual(job.status, JobStatus.RUNNING)
+        await self.finishJob(jobManager, "large")
+        self.assertEqual(job.status, JobStatus.SUCCEEDED)
+
+    async def test_queueLimits(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=1, maxQueuedJobs=3, maxQueuedJobsPerClient=2)
+        jobManager.submit(createJob("running", clientId="a"))
+        jobManager.submit(createJob("a1", clientId="a"))
+        jobManager.submit(createJob("a2", clientId="a"))
+        with self.assertRaises(JobQueueFullError) as context:
+            jobManager.submit(createJob("a3", clientId="a"))
+        self.assertIn("of a client", str(context.exception))
+        # Remaining processing time of the client's running and queued jobs
+        self.assertGreater(context.exception.retryAfter, 0)
+        self.assertAlmostEqual(context.exception.retryAfter, jobManager.estimatedQueueTime("a"), delta=1.0)
+        jobManager.submit(createJob("b1", clientId="b"))
+        with self.assertRaises(JobQueueFullError) as context:
+            jobManager.submit(createJob("b2", clientId="b"))
+        self.assertNotIn("of a client", str(context.exception))
+        self.assertAlmostEqual(context.exception.retryAfter, jobManager.estimatedQueueTime(), delta=1.0)
+        self.assertEqual(len(jobManager.queuedJobs()), 3)
+
+    async def test_cancelQueuedJob(self):
+        jobManager = self.createJobManager(maxConcurrentJobs=1)
+        jobManager.submit(createJob("running"))
+        job = jobManager.submit(createJob("queued"))
+        jobManager.cancel(job.id)
+        self.assertEqual(job.status, JobStatus.CANCELLED)
+        await settle()
+        await self.finishJob(jobManager, "running")
+        self.assertEqual(self.runner.startedJobs, ["running"])
+
+    async def test_cancelJobWithoutProcess(self):
+        jobManager = self.createJobManager()
+        job = jobManager.submit(createJob("waiting"))
+        await settle()
+        # The job runner has not started a process (e.g., it is waiting for a worker), it must be stopped
+        jobManager.cancel(job.id)
+        await asyncio.wait_for(job.completed.wait(), timeout=5)
+        self.assertEqual(job.status, JobStatus.CANCELLED)
+        self.assertTrue(job.runnerTask.cancelled())
+
+    async def test_cancelWhileRunnerCompletes(self):
+        jobManager = self.createJobManager()
+        jobManager.resultCache = FakeResultCache()
+        job = jobManager.submit(createJob("completing", geometry=jobManager.memoryEstimator.referenceGeometry({})))
+        job.peakMemory = 100000.0
+        await settle()
+        self.runner.finish("completing")
+        while not job.runnerTask.done():
+            await asyncio.sleep(0)
+        # The job runner has returned, but the job has not been marked as succeeded yet
+        jobManager.cancel(job.id)
+        await job.completed.wait()
+        self.assertEqual(job.status, JobStatus.CANCELLED)
+        self.assertEqual(jobManager.resultCache.addedKeys, [])
+        self.assertEqual(jobManager.memoryEstimator._correctionFactors, {})
+
+    async def test_memoryCalibration(self):
+        jobManager = self.createJobManager()
+        geometry = jobManager.memoryEstimator.referenceGeometry({})
+        job = jobManager.submit(createJob("model", geometry=geometry))
+        estimatedMemory = job.estimatedMemory
+        job.peakMemory = 2 * estimatedMemory
+        await settle()
+        await self.finishJob(jobManager, "model")
+        self.assertAlmostEqual(jobManager.memoryEstimator.estimate({"id": "model"}, geometry), 2 * estimatedMemory)
+
+    async def test_memoryCalibrationOfReusedWorker(self):
+        from MONAIAuto3DSegServer.estimation import BASELINE_MEMORY_MB
+        jobManager = self.createJobManager()
+        geometry = jobManager.memoryEstimator.referenceGeometry({})
+        job = jobManager.submit(createJob("model", geometry=geometry))
+        estimatedMemory = job.estimatedMemory
+        # Only the increase over the memory usage of the worker at the start of the job is measured
+        job.baseMemory = 5000.0
+        job.peakMemory = estimatedMemory - BASELINE_MEMORY_MB
+        await settle()
+        await self.finishJob(jobManager, "model")
+        self.assertAlmostEqual(jobManager.memoryEstimator.estimate({"id": "model"}, geometry), estimatedMemory)
+
+
+class QueueFullResponseTest(unittest.TestCase):
+
+    def test_retryAfter(self):
+        # Python dependencies of the server are not installed when the module is imported
+        with mock.patch("MONAIAuto3DSegLib.dependency_handler.NonSlicerPythonDependencies.setupPythonRequirements"):
+            from MONAIAuto3DSegServer.main import queueFullResponse
+        response = queueFullResponse(JobQueueFullError("Queue is full", retryAfter=12.3))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "13")
+        self.assertEqual(json.loads(response.body)["retryAfter"], 13)
+        # Retry after at least one second, even if the queue is expected to be empty by now
+        response = queueFullResponse(JobQueueFullError("Queue is full", retryAfter=0.0))
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+
+class ClientIdTest(unittest.TestCase):
+
+    def request(self, address, authorization=None):
+        headers = {"Authorization": authorization} if authorization else {}
+        return SimpleNamespace(headers=headers, client=SimpleNamespace(host=address))
+
+    def test_clientId(self):
+        # Python dependencies of the server are not installed when the module is imported
+        with mock.patch("MONAIAuto3DSegLib.dependency_handler.NonSlicerPythonDependencies.setupPythonRequirements"):
+            from MONAIAuto3DSegServer import main
+        with mock.patch.object(main.settings, "clientTokens", "token1, token2"), \
+                mock.patch.object(main.settings, "highPriorityClients", "urgent"):
+            self.assertEqual(main.clientId(self.request("10.0.0.1", "Bearer token1")), "token1")
+            self.assertEqual(main.clientId(self.request("10.0.0.1", "Bearer urgent")), "urgent")
+            # Unknown tokens do not make a client distinct from other requests from the same address
+            self.assertEqual(main.clientId(self.request("10.0.0.1", "Bearer random")), "10.0.0.1")
+            self.assertEqual(main.clientId(self.request("10.0.0.2")), "10.0.0.2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Tests of the label runs result format (MONAIAuto3DSegLib.label_runs).
+
+usage: python -m pytest Testing/Python/test_label_runs.py
+"""
+
+import json
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.label_runs import LABEL_RUNS_MAGIC, decodeLabelRuns, encodeLabelRuns
+from MONAIAuto3DSegLib.nrrd_io import cropToNonZero
+
+
+def imageHeader():
+    return {
+        "space": "left-posterior-superior",
+        "space directions": np.array([[0.8, 0.0, 0.0], [0.0, 0.8, 0.0], [0.0, 0.0, 2.5]]),
+        "space origin": np.array([-100.0, -120.0, 30.0]),
+    }
+
+
+class LabelRunsTest(unittest.TestCase):
+
+    def assertRoundTrip(self, data):
+        header = imageHeader()
+        decodedData, decodedHeader = decodeLabelRuns(encodeLabelRuns(data, header))
+        # The bounding box of non-zero labels is returned
+        expectedData, expectedHeader = cropToNonZero(data, header)
+        self.assertEqual(decodedData.dtype, expectedData.dtype.newbyteorder("="))
+        np.testing.assert_array_equal(decodedData, expectedData)
+        self.assertEqual(decodedHeader["space"], expectedHeader["space"])
+        np.testing.assert_allclose(decodedHeader["space directions"], expectedHeader["space directions"])
+        np.testing.assert_allclose(decodedHeader["space origin"], expectedHeader["space origin"])
+
+    def labelmap(self, dtype, labels):
+        """Labelmap with random labels in a block, with runs of various lengths and adjacent runs of different labels"""
+        rng = np.random.default_rng(0)
+        data = np.zeros((40, 30, 20), dtype=dtype)
+        block = rng.choice(np.asarray(labels, dtype=dtype), size=(25, 18, 9))
+        # Long runs along the fastest axis
+        block[5:20, :, 3] = labels[-1]
+        data[7:32, 4:22, 5:14] = block
+        return data
+
+    def test_uint8(self):
+        self.assertRoundTrip(self.labelmap(np.uint8, [0, 1, 2, 255]))
+
+    def test_int16(self):
+        # Differences of labels overflow the voxel type
+        self.assertRoundTrip(self.labelmap(np.int16, [0, 1, -3, 32767, -32768]))
+
+    def test_float(self):
+        for dtype in [np.float32, np.float64]:
+            with self.subTest(dtype=dtype):
+                self.assertRoundTrip(self.labelmap(dtype, [0.0, 0.1, 1.0, 2.7, -1e6]))
+
+    def test_bigEndian(self):
+        self.assertRoundTrip(self.labelmap(np.dtype(">i2"), [0, 1, 300]))
+
+    def test_allZero(self):
+        data = np.zeros((10, 20, 30), dtype=np.uint8)
+        content = encodeLabelRuns(data, imageHeader())
+        header = json.loads(content[len(LABEL_RUNS_MAGIC):].split(b"\n")[0])
+        self.assertEqual(header["runs"], 0)
+        self.assertEqual(header["labels"], [])
+        self.assertRoundTrip(data)
+
+    def test_labelsInHeader(self):
+        content = encodeLabelRuns(self.labelmap(np.float32, [0.0, 0.5, 3.0]), imageHeader())
+        header = json.loads(content[len(LABEL_RUNS_MAGIC):].split(b"\n")[0])
+        self.assertEqual(header["labels"], [0.5, 3.0])
+
+    def test_invalidContent(self):
+        with self.assertRaises(ValueError):
+            decodeLabelRuns(b"NRRD0004\n")
+        with self.assertRaises(ValueError):
+            decodeLabelRuns(LABEL_RUNS_MAGIC + b"{}\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests of NRRD writing and parallel gzip compression (MONAIAuto3DSegLib.nrrd_io).
+
+usage: python -m pytest Testing/Python/test_nrrd_io.py
+"""
+
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import nrrd
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.nrrd_io import OUTPUT_ENCODINGS, compressGzipBlocks, readNrrd, writeNrrd
+
+
+HEADER = {
+    "space": "left-posterior-superior",
+    "space directions": np.array([[0.8, 0.0, 0.0], [0.0, 0.9, 0.1], [0.0, 0.0, 1.5]]),
+    "space origin": np.array([-10.0, 20.5, 3.0]),
+}
+
+
+class NrrdWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempDir.name, "image.nrrd")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def assertRoundTrip(self, data, encoding):
+        writeNrrd(self.filename, data, HEADER, encoding=encoding, numberOfThreads=2)
+        # pynrrd is an independent reader, readNrrd is used by the inference server
+        for readData, readHeader in [nrrd.read(self.filename), readNrrd(self.filename)]:
+            self.assertEqual(readData.shape, data.shape)
+            self.assertEqual(readData.dtype.newbyteorder("="), data.dtype.newbyteorder("="))
+            np.testing.assert_array_equal(readData, data)
+            np.testing.assert_allclose(np.asarray(readHeader["space directions"], dtype=float), HEADER["space directions"])
+            np.testing.assert_allclose(np.asarray(readHeader["space origin"], dtype=float), HEADER["space origin"])
+
+    def test_roundTrip(self):
+        rng = np.random.default_rng(0)
+        for encoding in OUTPUT_ENCODINGS:
+            for dtype in [np.uint8, np.int16, np.uint16, np.int32, np.float32, np.float64]:
+                with self.subTest(encoding=encoding, dtype=dtype):
+                    data = (rng.random((7, 5, 3)) * 100 - 20).astype(dtype)
+                    self.assertRoundTrip(data, encoding)
+
+    def test_roundTripArrayLayouts(self):
+        data = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        for encoding in OUTPUT_ENCODINGS:
+            with self.subTest(encoding=encoding):
+                self.assertRoundTrip(np.ascontiguousarray(data), encoding)
+                self.assertRoundTrip(np.asfortranarray(data), encoding)
+                self.assertRoundTrip(data[1:, ::2, :4], encoding)
+                self.assertRoundTrip(data.astype(">i2"), encoding)
+
+    def test_emptyArray(self):
+        for encoding in OUTPUT_ENCODINGS:
+            with self.subTest(encoding=encoding):
+                data = np.zeros((0, 5, 3), dtype=np.uint8)
+                writeNrrd(self.filename, data, HEADER, encoding=encoding)
+                readData, _ = readNrrd(self.filename)
+                self.assertEqual(readData.shape, data.shape)
+
+    def test_unsupportedEncoding(self):
+        with self.assertRaises(ValueError):
+            writeNrrd(self.filename, np.zeros((2, 2, 2), dtype=np.uint8), HEADER, encoding="bzip2")
+
+
+class CompressGzipBlocksTest(unittest.TestCase):
+
+    def test_roundTrip(self):
+        rng = np.random.default_rng(1)
+        data = rng.integers(0, 4, size=100000, dtype=np.uint8).tobytes()
+        # Block sizes that divide the data evenly, leave a partial last block, or exceed the data size
+        for blockSize in [1000, 4096, 65536, 1000000]:
+            for numberOfThreads in [1, 4]:
+                with self.subTest(blockSize=blockSize, numberOfThreads=numberOfThreads):
+                    compressed = b"".join(compressGzipBlocks(data, numberOfThreads=numberOfThreads, blockSize=blockSize))
+                    self.assertEqual(gzip.decompress(compressed), data)
+
+    def test_compressionLevels(self):
+        data = bytes(range(256)) * 1000
+        for compressionLevel in [0, 1, 6, 9]:
+            with self.subTest(compressionLevel=compressionLevel):
+                compressed = b"".join(compressGzipBlocks(data, compressionLevel=compressionLevel, blockSize=10000))
+                self.assertEqual(gzip.decompress(compressed), data)
+
+    def test_emptyBuffer(self):
+        for buffer in [b"", np.zeros((0, 3), dtype=np.int16)]:
+            compressed = b"".join(compressGzipBlocks(buffer))
+            self.assertEqual(gzip.decompress(compressed), b"")
+
+    def test_numpyArray(self):
+        data = np.arange(30000, dtype=np.int16).reshape(100, 300)
+        compressed = b"".join(compressGzipBlocks(data, blockSize=7000))
+        self.assertEqual(gzip.decompress(compressed), data.tobytes())
+
+
+if __name__ == "__main__":
+    unittest.main()
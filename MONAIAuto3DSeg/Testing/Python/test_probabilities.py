@@ -0,0 +1,130 @@
+"""Tests of re-labelling from saved probabilities (MONAIAuto3DSegLib.probabilities).
+
+usage: python -m pytest Testing/Python/test_probabilities.py
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.probabilities import _resampleToOutputGrid, relabel
+
+
+def rotationMatrix(angleDegrees):
+    angle = np.radians(angleDegrees)
+    return np.array([[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+
+
+def affine(directions, origin):
+    matrix = np.eye(4)
+    matrix[:3, :3] = directions
+    matrix[:3, 3] = origin
+    return matrix
+
+
+def probabilitiesData(probabilities, cropStart, modelAffine, originalAffine, outputShape, labels=None):
+    return {
+        "probabilities": probabilities,
+        "labels": np.arange(probabilities.shape[0]) if labels is None else np.asarray(labels),
+        "cropStart": np.asarray(cropStart, dtype=np.int64),
+        "modelAffine": modelAffine,
+        "originalAffine": originalAffine,
+        "outputShape": np.asarray(outputShape, dtype=np.int64),
+        "space": "left-posterior-superior",
+        "spaceDirections": originalAffine[:3, :3].T,
+        "spaceOrigin": originalAffine[:3, 3],
+        "sigmoid": False,
+        "labelMerge": "",
+    }
+
+
+def resampleFullVolume(modelGridImage, data, order):
+    """Reference implementation: resample the whole output voxel grid"""
+    outputToModel = np.linalg.inv(data["modelAffine"]) @ data["originalAffine"]
+    return ndimage.affine_transform(modelGridImage, matrix=outputToModel[:3, :3],
+                                    offset=outputToModel[:3, 3] - data["cropStart"],
+                                    output_shape=tuple(data["outputShape"]), order=order, mode="constant", cval=0)
+
+
+class ResampleToOutputGridTest(unittest.TestCase):
+
+    GEOMETRIES = {
+        "axis-aligned": (np.diag([2.0, 2.0, 3.0]), np.diag([0.7, 0.7, 1.0])),
+        "anisotropic": (np.diag([1.5, 1.5, 1.5]), np.diag([0.4, 0.9, 2.5])),
+        "rotated": (rotationMatrix(20) @ np.diag([2.0, 2.0, 2.0]), rotationMatrix(-15) @ np.diag([0.8, 0.6, 1.2])),
+        "flipped": (np.diag([-2.0, 2.0, 2.0]), np.diag([1.0, -1.0, 1.0])),
+    }
+
+    def test_sameAsFullVolume(self):
+        rng = np.random.default_rng(0)
+        outputShape = (60, 50, 40)
+        for name, (modelDirections, originalDirections) in self.GEOMETRIES.items():
+            originalAffine = affine(originalDirections, [5.13, -3.07, 2.21])
+            # Model grid covers the input image. Grids are shifted by a fraction of a voxel, so that no output voxel is
+            # exactly at the boundary of the model grid (where rounding errors decide whether it is inside or outside).
+            modelOrigin = originalAffine[:3, 3] - modelDirections @ np.array([3.37, 3.41, 3.29])
+            modelAffine = affine(modelDirections, modelOrigin)
+            for cropStart in [(0, 0, 0), (5, 7, 2), (20, 20, 15)]:
+                with self.subTest(geometry=name, cropStart=cropStart):
+                    labelMap = rng.integers(0, 4, size=(9, 6, 7)).astype(np.uint8)
+                    data = probabilitiesData(labelMap[np.newaxis], cropStart, modelAffine, originalAffine, outputShape)
+                    for order in [0, 1]:
+                        np.testing.assert_array_equal(_resampleToOutputGrid(labelMap, data, order),
+                                                      resampleFullVolume(labelMap, data, order))
+
+    def test_outsideOutputGrid(self):
+        labelMap = np.ones((4, 4, 4), dtype=np.uint8)
+        originalAffine = affine(np.eye(3), [0.0, 0.0, 0.0])
+        modelAffine = affine(np.eye(3) * 2.0, [500.0, 0.0, 0.0])
+        data = probabilitiesData(labelMap[np.newaxis], (0, 0, 0), modelAffine, originalAffine, (10, 10, 10))
+        resampled = _resampleToOutputGrid(labelMap, data, order=0)
+        self.assertEqual(resampled.shape, (10, 10, 10))
+        self.assertFalse(resampled.any())
+
+
+class RelabelTest(unittest.TestCase):
+
+    def test_relabel(self):
+        probabilities = np.zeros((3, 4, 4, 4), dtype=np.uint8)
+        probabilities[0] = 255
+        probabilities[:, 1:3, 1:3, 1:3] = [[[[0]]], [[[200]]], [[[55]]]]
+        data = probabilitiesData(probabilities, (2, 2, 2), affine(np.eye(3) * 2.0, [0.0, 0.0, 0.0]),
+                                 affine(np.eye(3), [0.0, 0.0, 0.0]), (20, 20, 20), labels=[0, 1, 5])
+        labelMap, header, confidence = relabel(data, computeConfidence=True)
+        self.assertEqual(labelMap.shape, (20, 20, 20))
+        self.assertEqual(set(np.unique(labelMap)), {0, 1})
+        # Model voxels 3-4 (in the full model grid) cover output voxels 5.5-9.5
+        self.assertTrue((labelMap[6:9, 6:9, 6:9] == 1).all())
+        self.assertEqual(labelMap[:5].sum(), 0)
+        self.assertEqual(confidence.shape, (20, 20, 20))
+        self.assertEqual(confidence[7, 7, 7], 200)
+        # Threshold above the probability of the most probable foreground class
+        labelMap, _, _ = relabel(data, threshold=0.9)
+        self.assertFalse(labelMap.any())
+        # Low threshold: the most probable foreground class is chosen, even if another class is above the threshold
+        labelMap, _, _ = relabel(data, threshold=0.1)
+        self.assertEqual(set(np.unique(labelMap)), {0, 1})
+
+    def test_relabelBackgroundOnly(self):
+        # Probabilities are saved only for the background if nothing was segmented
+        probabilities = np.full((1, 4, 4, 4), 255, dtype=np.uint8)
+        data = probabilitiesData(probabilities, (2, 2, 2), affine(np.eye(3) * 2.0, [0.0, 0.0, 0.0]),
+                                 affine(np.eye(3), [0.0, 0.0, 0.0]), (20, 20, 20), labels=[0])
+        for threshold in [None, 0.5]:
+            with self.subTest(threshold=threshold):
+                labelMap, _, confidence = relabel(data, threshold=threshold, computeConfidence=True)
+                self.assertEqual(labelMap.shape, (20, 20, 20))
+                self.assertFalse(labelMap.any())
+                self.assertEqual(confidence.shape, (20, 20, 20))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests of input files that are uploaded to the inference server (MONAIAuto3DSegLib.upload).
+
+usage: python -m pytest Testing/Python/test_upload.py
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import nrrd
+
+paths = [str(Path(__file__).parent.parent.parent)]
+for path in paths:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+from MONAIAuto3DSegLib.upload import InMemoryNrrdFile, UploadFile
+
+
+HEADER = {
+    "space": "left-posterior-superior",
+    "space directions": np.array([[0.8, 0.0, 0.0], [0.0, 0.9, 0.0], [0.0, 0.0, 1.5]]),
+    "space origin": np.array([-10.0, 20.5, 3.0]),
+}
+
+
+class InMemoryNrrdFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.data = rng.integers(-1000, 1000, size=(23, 17, 11)).astype(np.int16)
+        self.inputFile = InMemoryNrrdFile(self.data, HEADER, "input-volume0.nrrd")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_content(self):
+        content = b"".join(self.inputFile.chunks(chunkSize=1000))
+        self.assertEqual(len(content), self.inputFile.size)
+        self.assertEqual(self.inputFile.sha256(), hashlib.sha256(content).hexdigest())
+        for offset, size in [(0, 10), (100, 5000), (self.inputFile.size - 10, 100)]:
+            self.assertEqual(self.inputFile.read(offset, size), content[offset:offset + size])
+
+    def test_save(self):
+        path = os.path.join(self.tempDir.name, self.inputFile.filename)
+        self.inputFile.save(path)
+        self.assertEqual(Path(path).read_bytes(), b"".join(self.inputFile.chunks()))
+        data, header = nrrd.read(path)
+        np.testing.assert_array_equal(data, self.data)
+        np.testing.assert_allclose(header["space origin"], HEADER["space origin"])
+        # The saved file is uploaded with the same name and content hash, so the server can reuse the blob
+        uploadFile = UploadFile(path)
+        self.assertEqual(uploadFile.filename, self.inputFile.filename)
+        self.assertEqual(uploadFile.size, self.inputFile.size)
+        self.assertEqual(uploadFile.sha256(), self.inputFile.sha256())
+
+
+if __name__ == "__main__":
+    unittest.main()